@@ -36,6 +36,14 @@ def permission_denied(msg):
     """Permission denied."""
     return xmlrpclib.Fault(106, msg)
 
+def read_only(msg):
+    """Write attempted on a read-only (follower) server."""
+    return xmlrpclib.Fault(107, msg)
+
+def try_again(msg):
+    """Temporary condition, the request can be retried."""
+    return xmlrpclib.Fault(108, msg)
+
 class InvalidLoginError(SiptrackError):
     """Invalid username/password."""
     def __str__(self):
@@ -1,4 +1,5 @@
 from twisted.internet import threads
+from twisted.internet import task
 import time
 import zlib
 import xmlrpclib
@@ -13,6 +14,7 @@ except:
     json_decode = json.loads
 
 from siptrackdlib.objectregistry import object_registry
+from siptrackdlib import census
 
 from siptrackd_twisted import errors
 from siptrackd_twisted import log
@@ -68,6 +70,16 @@ class EntityDataCache(object):
     def flush(self):
         self.cache = {}
 
+    def census(self, step = census.STEP_SIZE):
+        """Return a deferred firing with the caches entries and bytes.
+
+        Counted in steps on the reactor, see census.MappingCensus.
+        """
+        cache_census = census.MappingCensus()
+        d = task.cooperate(cache_census.iterCount(self.cache, step)).whenDone()
+        d.addCallback(lambda _: cache_census.asDict())
+        return d
+
 class ListCreator(object):
     """Collect data to return to clients.
 
@@ -80,6 +92,12 @@ class ListCreator(object):
         data: class id unique data (list)
         parent: oid string or '' if no parent exists
         ctime: creation time of the object
+
+    If snapshot is True the data is collected from a snapshot of the
+    object tree taken when the ListCreator is created, so the pages
+    returned by iterBuild/iterSearch are consistent with each other
+    however long it takes to fetch them. The snapshot is closed when
+    the iteration ends.
     """
     attr_incl = {
         'attribute': True,
@@ -87,13 +105,26 @@ class ListCreator(object):
         'encrypted attribute': True
     }
 
-    def __init__(self, object_store, user):
+    def __init__(self, object_store, user, snapshot = False):
         self.object_store = object_store
         self.user = user
         self.included_nodes = {}
         self.prepared_data = []
         self.runtime = 0
         self.tottime = 0
+        self.snapshot = None
+        if snapshot:
+            self.snapshot = object_store.snapshot(
+                    capture = self._captureNodeData)
+
+    def _captureNodeData(self, node):
+        """Snapshot capture function, keeps the data of changed nodes."""
+        return entity_data_cache.getNodeData(node, self.user)
+
+    def _closeSnapshot(self):
+        if self.snapshot is not None:
+            self.snapshot.close()
+            self.snapshot = None
 
     def build(self, node, max_depth, include_parents, include_associations,
             include_references):
@@ -123,28 +154,31 @@ class ListCreator(object):
             include_parents: include all parents in the tree leading
                 up to the given oid
         """
-        tot_start = time.time()
-        start = time.time()
-        if max_depth > -1:
-            max_depth += 1
-        count = 0
-        data = []
-        for node in nodes:
-            for _data, _count in self._iterBuild(node, max_depth, include_parents,
-                                        include_associations, include_references):
-                count += _count
-                data.extend(_data)
-                if count >= 1000:
-                    self.runtime += time.time() - start
-                    yield self._packData(data)
-                    start = time.time()
-                    count = 0
-                    data = []
-        self.runtime += time.time() - start
-        if data:
-            yield self._packData(data)
-        self.tottime = time.time() - tot_start
-        log.debug('gatherer.iterBuild: RUNTIME: %s, TOTALTIME: %s, NODECOUNT: %s' % (self.runtime, self.tottime, len(self.included_nodes)))
+        try:
+            tot_start = time.time()
+            start = time.time()
+            if max_depth > -1:
+                max_depth += 1
+            count = 0
+            data = []
+            for node in nodes:
+                for _data, _count in self._iterBuild(node, max_depth, include_parents,
+                                            include_associations, include_references):
+                    count += _count
+                    data.extend(_data)
+                    if count >= 1000:
+                        self.runtime += time.time() - start
+                        yield self._packData(data)
+                        start = time.time()
+                        count = 0
+                        data = []
+            self.runtime += time.time() - start
+            if data:
+                yield self._packData(data)
+            self.tottime = time.time() - tot_start
+            log.debug('gatherer.iterBuild: RUNTIME: %s, TOTALTIME: %s, NODECOUNT: %s' % (self.runtime, self.tottime, len(self.included_nodes)))
+        finally:
+            self._closeSnapshot()
 
     def _iterBuild(self, node, max_depth, include_parents, include_associations,
             include_references):
@@ -159,7 +193,8 @@ class ListCreator(object):
             exclude = []
             max_depth = 0
         for depth, child in node.traverse(max_depth = max_depth,
-                include_self = True, include_depth = True, user = self.user):
+                include_self = True, include_depth = True, user = self.user,
+                snapshot = self.snapshot):
             if depth == max_depth:
                 if child.class_name in self.attr_incl:
                     self._addNodeAndAttributes(child)
@@ -182,38 +217,41 @@ class ListCreator(object):
             include_parents = True, include_associations = True,
             include_references = True):
         """Search for objects starting at oid."""
-        tot_start = time.time()
-        start = time.time()
-        match_oids = []
-        data = []
-        count = 0
-        for node in searcher:
-            count += 1
-            match_oids.append(node.oid)
-            if include_data:
-                for _data, _count in self._iterBuild(node, 1, include_parents,
-                                                    include_associations, include_references):
-                    data.extend(_data)
-                    count += _count
-                    if count >= 1000:
-                        self.runtime += time.time() - start
-                        yield self._packData([data, match_oids])
-                        start = time.time()
-                        match_oids = []
-                        data = []
-                        count = 0
-            if count >= 1000:
-                self.runtime += time.time() - start
+        try:
+            tot_start = time.time()
+            start = time.time()
+            match_oids = []
+            data = []
+            count = 0
+            for node in searcher:
+                count += 1
+                match_oids.append(node.oid)
+                if include_data:
+                    for _data, _count in self._iterBuild(node, 1, include_parents,
+                                                        include_associations, include_references):
+                        data.extend(_data)
+                        count += _count
+                        if count >= 1000:
+                            self.runtime += time.time() - start
+                            yield self._packData([data, match_oids])
+                            start = time.time()
+                            match_oids = []
+                            data = []
+                            count = 0
+                if count >= 1000:
+                    self.runtime += time.time() - start
+                    yield self._packData([data, match_oids])
+                    start = time.time()
+                    match_oids = []
+                    data = []
+                    count = 0
+            self.runtime += time.time() - start
+            if match_oids:
                 yield self._packData([data, match_oids])
-                start = time.time()
-                match_oids = []
-                data = []
-                count = 0
-        self.runtime += time.time() - start
-        if match_oids:
-            yield self._packData([data, match_oids])
-        self.tottime = time.time() - tot_start
-        log.debug('gatherer.iterSearch: RUNTIME: %s, TOTALTIME: %s, NODECOUNT: %s' % (self.runtime, self.tottime, len(self.included_nodes)))
+            self.tottime = time.time() - tot_start
+            log.debug('gatherer.iterSearch: RUNTIME: %s, TOTALTIME: %s, NODECOUNT: %s' % (self.runtime, self.tottime, len(self.included_nodes)))
+        finally:
+            self._closeSnapshot()
 
     def _packData(self, data):
         data = json_encode(data)
@@ -223,14 +261,22 @@ class ListCreator(object):
 
     def _addAssociations(self, node, include_parents):
         """Add a nodes associations to prepared_data."""
-        for assoc_node in node.associations:
+        if self.snapshot is None:
+            associations = node.associations
+        else:
+            associations = self.snapshot.associations(node)
+        for assoc_node in associations:
             if include_parents:
                 self._addParents(assoc_node)
             self._addNodeAndAttributes(assoc_node)
 
     def _addReferences(self, node, include_parents):
         """Add a nodes references to prepared_data."""
-        for ref_node in node.references:
+        if self.snapshot is None:
+            references = node.references
+        else:
+            references = self.snapshot.references(node)
+        for ref_node in references:
             if include_parents:
                 self._addParents(ref_node)
             self._addNodeAndAttributes(ref_node)
@@ -242,7 +288,7 @@ class ListCreator(object):
         node ordering in the returned data (so parents come before
         children).
         """
-        node = node.parent
+        node = self._parent(node)
         path = []
         while node:
             # If a node has already been added, and _addParents is being
@@ -252,15 +298,26 @@ class ListCreator(object):
 #                print 'EARLY BREAK, parent check', node
                 break
             path.insert(0, node)
-            node = node.parent
+            node = self._parent(node)
         for node in path:
             self._addNodeAndAttributes(node)
 
+    def _parent(self, node):
+        if self.snapshot is None:
+            return node.parent
+        return self.snapshot.parent(node)
+
     def _addNode(self, node):
         """Add a node and it's data to self.prepared_data."""
         if node.oid not in self.included_nodes:
             self.included_nodes[node.oid] = True
-            self.prepared_data.append(entity_data_cache.getNodeData(node, self.user))
+            data = None
+            if self.snapshot is not None:
+                # Changed after the snapshot was taken.
+                data = self.snapshot.data(node)
+            if data is None:
+                data = entity_data_cache.getNodeData(node, self.user)
+            self.prepared_data.append(data)
 
     def _addNodeAndAttributes(self, node):
 #        """Add a node and all it's attributes to self.prepared_data."""
@@ -272,7 +329,8 @@ class ListCreator(object):
         self._addNode(node)
         include = self.attr_incl.keys()
         for child in node.traverse(include_self = False, include = include,
-                no_match_break = True, user = self.user):
+                no_match_break = True, user = self.user,
+                snapshot = self.snapshot):
             if child.oid not in self.included_nodes:
                 self._addNode(child)
 
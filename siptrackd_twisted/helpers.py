@@ -52,6 +52,10 @@ def _check_exception(exc):
         return errors.permission_denied(exc.__str__())
     elif isinstance(exc, siptrackdlib.errors.NonExistent):
         return errors.client_error_nexists(exc.__str__())
+    elif isinstance(exc, siptrackdlib.errors.ReadOnly):
+        return errors.read_only(exc.__str__())
+    elif isinstance(exc, siptrackdlib.errors.OIDsExhausted):
+        return errors.try_again(exc.__str__())
     elif isinstance(exc, siptrackdlib.errors.SiptrackError):
         tbmsg = traceback.format_exc()
         log.msg(tbmsg)
@@ -2,20 +2,40 @@ import hashlib
 import random
 import time
 import errors
+import siptrackdlib.errors
 from twisted.internet import threads
 
 # Two days.
 DEFAULT_IDLE_TIMEOUT = 60 * 60 * 24 * 2
 # Two days.
 MAX_IDLE_TIMEOUT = 60 * 60 * 24 * 2
+# Ten minutes.
+ITERATOR_IDLE_TIMEOUT = 60 * 10
+MAX_ITERATORS = 20
 
 class DataIterators(object):
-    def __init__(self):
+    """The open data iterators of a session.
+
+    Iterators can keep an object tree snapshot open (see
+    gatherer.ListCreator), and every change to the tree is copied for
+    each open snapshot. Iterators that aren't used for idle_timeout
+    seconds are dropped, as is the least recently used one when a new
+    iterator would make more than max_iterators. Dropped iterators are
+    closed, which closes their snapshots.
+    """
+    def __init__(self, idle_timeout = ITERATOR_IDLE_TIMEOUT,
+            max_iterators = MAX_ITERATORS):
         self.iterators = {}
+        self.idle_timeout = idle_timeout
+        self.max_iterators = max_iterators
 
     def add(self, iterator):
+        self.expire()
+        while self.iterators and len(self.iterators) >= self.max_iterators:
+            self._drop(min(self.iterators,
+                key = lambda i_id: self.iterators[i_id]['access_time']))
         i_id = self.getID(iterator)
-        iter_data = {'iter': iterator}
+        iter_data = {'iter': iterator, 'access_time': time.time()}
         iter_data['data'], iter_data['has_data'] = self._getIterData(iterator)
         self.iterators[i_id] = iter_data
         return i_id
@@ -23,7 +43,25 @@ class DataIterators(object):
     def remove(self, iterator):
         i_id = self.getID(iterator)
         if i_id in self.iterators:
-            del self.iterators[i_id]
+            self._drop(i_id)
+
+    def expire(self):
+        """Drop iterators that have been idle for too long."""
+        now = time.time()
+        for i_id, iter_data in self.iterators.items():
+            if now - iter_data['access_time'] > self.idle_timeout:
+                self._drop(i_id)
+
+    def close(self):
+        """Drop all iterators."""
+        for i_id in self.iterators.keys():
+            self._drop(i_id)
+
+    def _drop(self, i_id):
+        iter_data = self.iterators.pop(i_id)
+        close = getattr(iter_data['iter'], 'close', None)
+        if close is not None:
+            close()
 
     def getID(self, iterator):
         return str(id(iterator))
@@ -49,6 +87,7 @@ class DataIterators(object):
         iter_data = self.iterators.get(i_id)
         if not iter_data:
             return False
+        iter_data['access_time'] = time.time()
         ret = {'next': i_id}
         ret['data'], has_data = self._getNextData(iter_data)
         if not has_data:
@@ -128,6 +167,8 @@ class SessionHandler(object):
                 expire.append(session_id)
         for session_id in expire:
             del self.sessions[session_id]
+        for session in self.sessions.itervalues():
+            session.data_iterators.expire()
 
     def _isTimeToExpire(self):
         now = time.time()
@@ -151,3 +192,31 @@ class SessionHandler(object):
         for session_id in session_ids:
             self.endSession(session_id)
 
+    def census(self):
+        """Return the number of open data iterators per session."""
+        ret = []
+        for session_id, session in self.sessions.iteritems():
+            ret.append({'id': session_id,
+                'data_iterators': len(session.data_iterators.iterators)})
+        return ret
+
+    def rebindSessions(self, object_store):
+        """Point sessions at their users in a fully reloaded object store.
+
+        A full reload replaces all nodes, sessions of users that no longer
+        exist are ended. Data iterators over the old nodes are dropped.
+        """
+        kill = []
+        for session_id in self.sessions:
+            session = self.sessions[session_id]
+            session.data_iterators.close()
+            session.data_iterators = DataIterators()
+            if not session.user:
+                continue
+            try:
+                session.user.user = object_store.getOID(session.user.oid)
+            except siptrackdlib.errors.NonExistent:
+                kill.append(session_id)
+        for session_id in kill:
+            del self.sessions[session_id]
+
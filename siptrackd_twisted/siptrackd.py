@@ -157,7 +157,6 @@ class SiptrackdRPC(baserpc.BaseRPC):
         """Fetch data from a oid (and it's children)."""
         if type(oids) != list:
             oids = [oids]
-        listcreator = gatherer.ListCreator(self.object_store, session.user)
         nodes = []
         for oid in oids:
             if oid in ['', 'ROOT']:
@@ -171,6 +170,9 @@ class SiptrackdRPC(baserpc.BaseRPC):
                 include_references = False
             node = self.object_store.getOID(oid, user = session.user)
             nodes.append(node)
+        # Page through a snapshot so later pages match the first one.
+        listcreator = gatherer.ListCreator(self.object_store, session.user,
+                snapshot = True)
         build_iter = listcreator.iterBuild(nodes, max_depth, include_parents,
                 include_associations, include_references)
         iter_id = session.data_iterators.add(build_iter)
@@ -236,9 +238,11 @@ class SiptrackdRPC(baserpc.BaseRPC):
         if oid in ['', 'ROOT']:
             oid = self.object_store.view_tree.oid
         root = self.object_store.getOID(oid, user = session.user)
+        listcreator = gatherer.ListCreator(self.object_store, session.user,
+                snapshot = True)
         searcher = root.search(search_pattern, attr_limit, include,
-                exclude, no_match_break, user = session.user)
-        listcreator = gatherer.ListCreator(self.object_store, session.user)
+                exclude, no_match_break, user = session.user,
+                snapshot = listcreator.snapshot)
         build_iter = listcreator.iterSearch(searcher, include_data, include_parents,
                 include_associations, include_references)
         iter_id = session.data_iterators.add(build_iter)
@@ -306,6 +310,26 @@ class SiptrackdRPC(baserpc.BaseRPC):
         gatherer.entity_data_cache.flush()
         return True
 
+    @helpers.ValidateSession(require_admin=True)
+    @defer.inlineCallbacks
+    def xmlrpc_get_census(self, session):
+        """Return node counts and approximate memory use.
+
+        Per node class and for the object store caches (see
+        ObjectStore.census), the gatherer data cache and the open data
+        iterators of each session. Counting runs in steps so it doesn't
+        hold up other requests.
+        """
+        ret = yield self.object_store.census()
+        ret['entity_data_cache'] = yield gatherer.entity_data_cache.census()
+        ret['sessions'] = self.session_handler.census()
+        defer.returnValue(ret)
+
+    @helpers.ValidateSession(require_admin=True)
+    def xmlrpc_get_stats(self, session):
+        """Return object store statistics (commit sizes/latency etc.)."""
+        return self.object_store.getStats()
+
     @helpers.ValidateSession(require_admin=True)
     def xmlrpc_get_oid_gatherer_data_cache(self, session, oid):
         ret = gatherer.entity_data_cache.cache.get(oid, False)
@@ -322,11 +346,18 @@ class SiptrackdRPC(baserpc.BaseRPC):
 
     @helpers.ValidateSession(require_admin=True)
     @defer.inlineCallbacks
-    def xmlrpc_reload_objectstore(self, session):
+    def xmlrpc_reload_objectstore(self, session, full = False):
+        """Reload the object store.
+
+        Only changes made by others since the last (re)load are applied,
+        unless full is set. Sessions are kept, a full reload moves them
+        over to the reloaded users.
+        """
         log.msg('Reloading object store by command')
         try:
-            yield self.object_store.reload()
-            self.session_handler.killAllSessions()
+            full = yield self.object_store.reload(full)
+            if full:
+                self.session_handler.rebindSessions(self.object_store)
         except Exception, e:
             log.msg('Reload failed: %s' % (e))
             tbmsg = traceback.format_exc()
@@ -339,8 +370,9 @@ class SiptrackdRPC(baserpc.BaseRPC):
 def object_store_reloader(session_handler, object_store, reload_interval):
     log.msg('Reloading object store by interval')
     try:
-        yield object_store.reload()
-        session_handler.killAllSessions()
+        full = yield object_store.reload()
+        if full:
+            session_handler.rebindSessions(object_store)
     except Exception, e:
         log.msg('Reload failed: %s' % (e))
         tbmsg = traceback.format_exc()
@@ -350,10 +382,49 @@ def object_store_reloader(session_handler, object_store, reload_interval):
     reactor.callLater(reload_interval, object_store_reloader, session_handler, object_store, reload_interval)
 
 @defer.inlineCallbacks
-def siptrackd_twisted_init(object_store, application):
+def object_store_snapshot_writer(object_store, snapshot_interval):
+    log.msg('Writing object store snapshot by interval')
+    try:
+        yield object_store.writeSnapshot()
+    except Exception, e:
+        log.msg('Snapshot failed: %s' % (e))
+        tbmsg = traceback.format_exc()
+        log.msg(tbmsg)
+    reactor.callLater(snapshot_interval, object_store_snapshot_writer, object_store, snapshot_interval)
+
+@defer.inlineCallbacks
+def object_store_shutdown_snapshot(object_store):
+    log.msg('Writing object store snapshot before shutdown')
+    try:
+        yield object_store.writeSnapshot()
+    except Exception, e:
+        log.msg('Snapshot failed: %s' % (e))
+
+@defer.inlineCallbacks
+def object_store_follower(session_handler, object_store, follow_interval):
+    try:
+        try:
+            yield object_store.applyJournal()
+        except siptrackdlib.errors.JournalTrimmed, e:
+            log.msg('Change journal trimmed, doing a full reload: %s' % (e))
+            full = yield object_store.reload(full = True)
+            if full:
+                session_handler.rebindSessions(object_store)
+    except Exception, e:
+        log.msg('Applying change journal failed: %s' % (e))
+        tbmsg = traceback.format_exc()
+        log.msg(tbmsg)
+    reactor.callLater(follow_interval, object_store_follower, session_handler, object_store, follow_interval)
+
+@defer.inlineCallbacks
+def siptrackd_twisted_init(session_handler, object_store, application,
+        follow_interval = None):
     log.msg('Loading object store, this might take a while')
     yield object_store.init()
     log.msg('Object store loading complete')
+    if follow_interval:
+        log.msg('Following storage change journal every %ss' % (follow_interval))
+        reactor.callLater(follow_interval, object_store_follower, session_handler, object_store, follow_interval)
     log.msg('Starting rpc listener')
     app.startApplication(application, False)
     log.msg('Running')
@@ -413,9 +484,13 @@ class SiptrackOpenSSLContextFactory(ssl.ContextFactory):
 
 def run_siptrackd_twisted(listen_port, ssl_port,
         ssl_private_key, ssl_certificate, storage, reload_interval,
-        searcher):
+        searcher, stream_preload = False, snapshot_path = None,
+        snapshot_interval = None, readonly = False, follow_interval = None,
+        journal_retention = siptrackdlib.root.DEFAULT_JOURNAL_RETENTION):
     log.msg('Creating object store')
-    object_store = siptrackdlib.ObjectStore(storage, searcher = searcher)
+    object_store = siptrackdlib.ObjectStore(storage, searcher = searcher,
+            stream_preload = stream_preload, snapshot_path = snapshot_path,
+            readonly = readonly, journal_retention = journal_retention)
     session_handler = sessions.SessionHandler()
 
     log.msg('Creating rpc interface')
@@ -611,11 +686,17 @@ def run_siptrackd_twisted(listen_port, ssl_port,
     application = service.Application('siptrackd')
     root_service.setServiceParent(application)
 
-    reactor.callWhenRunning(siptrackd_twisted_init, object_store, application)
+    reactor.callWhenRunning(siptrackd_twisted_init, session_handler,
+            object_store, application, follow_interval)
 
     if reload_interval:
         reactor.callLater(reload_interval, object_store_reloader, session_handler, object_store, reload_interval)
 
+    if snapshot_path:
+        if snapshot_interval:
+            reactor.callLater(snapshot_interval, object_store_snapshot_writer, object_store, snapshot_interval)
+        reactor.addSystemEventTrigger('before', 'shutdown', object_store_shutdown_snapshot, object_store)
+
     reactor.run()
     log.msg('Shutting down siptrackd server.')
 
@@ -777,11 +858,46 @@ def main(argv):
         action='store_true',
         help='readonly mode'
     )
+    parser.add_argument(
+        '--follower',
+        dest='follower',
+        action='store_true',
+        help='read-only follower mode, keeps up with changes made by other servers using the storage change journal'
+    )
+    parser.add_argument(
+        '--follow-interval',
+        dest='follow_interval',
+        default=5,
+        help='Interval in which a follower polls the storage change journal (s), default 5'
+    )
     parser.add_argument(
         '--reload-interval',
         dest='reload_interval',
         help='Interval in which to reload the object store (s)'
     )
+    parser.add_argument(
+        '--stream-preload',
+        dest='stream_preload',
+        action='store_true',
+        help='stream node data from storage while preloading, uses less memory'
+    )
+    parser.add_argument(
+        '--snapshot',
+        dest='snapshot_path',
+        metavar='FILE',
+        help='object store snapshot file, loaded at startup if current and written on shutdown'
+    )
+    parser.add_argument(
+        '--snapshot-interval',
+        dest='snapshot_interval',
+        help='Interval in which to write the object store snapshot (s)'
+    )
+    parser.add_argument(
+        '--journal-retention',
+        dest='journal_retention',
+        help='Number of change journal entries kept, none to never trim the journal, default %d' % (
+            siptrackdlib.root.DEFAULT_JOURNAL_RETENTION)
+    )
     parser.add_argument(
         '--searcher',
         dest='searcher',
@@ -842,6 +958,34 @@ def main(argv):
             print 'Invalid value for reload_interval: %s' % (args.reload_interval)
             return 1
 
+    if args.snapshot_interval:
+        try:
+            args.snapshot_interval = int(args.snapshot_interval)
+        except Exception, e:
+            print 'Invalid value for snapshot_interval: %s' % (args.snapshot_interval)
+            return 1
+
+    journal_retention = siptrackdlib.root.DEFAULT_JOURNAL_RETENTION
+    if args.journal_retention == 'none':
+        journal_retention = None
+    elif args.journal_retention:
+        try:
+            journal_retention = int(args.journal_retention)
+        except Exception, e:
+            journal_retention = -1
+        if journal_retention < 0:
+            print 'Invalid value for journal_retention: %s' % (args.journal_retention)
+            return 1
+
+    follow_interval = None
+    if args.follower:
+        args.readonly = True
+        try:
+            follow_interval = float(args.follow_interval)
+        except Exception, e:
+            print 'Invalid value for follow_interval: %s' % (args.follow_interval)
+            return 1
+
     storage_kwargs = {}
     storage_kwargs = {'readonly': args.readonly}
     storage_config = RawConfigParser()
@@ -896,7 +1040,9 @@ def main(argv):
     try:
         return run_siptrackd_twisted(args.listen_port, args.ssl_port,
                 args.ssl_private_key, args.ssl_certificate, storage, args.reload_interval,
-                searcher)
+                searcher, args.stream_preload, args.snapshot_path,
+                args.snapshot_interval, args.readonly, follow_interval,
+                journal_retention)
     except siptrackdlib.errors.SiptrackError, e:
         print 'ERROR:', e
 
@@ -6,10 +6,47 @@ from siptrackdlib.objectregistry import object_registry
 from siptrackdlib import treenodes
 from siptrackdlib import errors
 from siptrackdlib import storagevalue
+from siptrackdlib import interning
 
 from siptrackdlib import log
 
 class AttributeBase(treenodes.BaseNode):
+    __slots__ = ()
+
+    def _dropParentIndex(self, branch = None):
+        """Drop the parent nodes attribute name index.
+
+        Called whenever the name or placement of the attribute changes,
+        the index is rebuilt on the next getAttribute call. Parents that
+        haven't been loaded yet don't have an index.
+        """
+        if branch is None:
+            branch = self.branch
+        if branch and branch.parent and hasattr(branch.parent, 'hasExtData') \
+                and branch.parent.hasExtData():
+            branch.parent.ext_data._attr_index = None
+
+    def _created(self, user):
+        super(AttributeBase, self)._created(user)
+        self._dropParentIndex()
+
+    def _loaded(self, data = None):
+        super(AttributeBase, self)._loaded(data)
+        self._dropParentIndex()
+
+    def _remove(self, *args, **kwargs):
+        branch = self.branch
+        super(AttributeBase, self)._remove(*args, **kwargs)
+        self._dropParentIndex(branch)
+
+    def _relocate(self):
+        super(AttributeBase, self)._relocate()
+        self._dropParentIndex()
+
+    def relocate(self, new_parent, user = None):
+        self._dropParentIndex()
+        super(AttributeBase, self).relocate(new_parent, user)
+
     def regmatch(self, re_pattern, name = None):
         """See if the attributes value matches a regexp.
         
@@ -61,6 +98,7 @@ class Attribute(AttributeBase):
             bool   : True/False
         value : a value matching the attributes type.
     """
+    __slots__ = ('_name', '_atype', '_value')
     class_id = 'CA'
     class_name = 'attribute'
 
@@ -70,11 +108,17 @@ class Attribute(AttributeBase):
         self._atype = atype
         self._value = value
 
-    def getParentNode(self):
-        """Get the closest parent _non-attribute_ node."""
+    def getParentNode(self, snapshot = None):
+        """Get the closest parent _non-attribute_ node.
+
+        snapshot is an optional objecttree.TreeSnapshot to look in.
+        """
         parent = self
         while parent.class_id in ['CA', 'VA']:
-            parent = parent.parent
+            if snapshot is None:
+                parent = parent.parent
+            else:
+                parent = snapshot.parent(parent)
         return parent
 
     def _created(self, user):
@@ -86,8 +130,8 @@ class Attribute(AttributeBase):
     def _loaded(self, data = None):
         super(Attribute, self)._loaded(data)
         if data:
-            self._name = data['attr-name']
-            self._atype = data['attr-type']
+            self._name = interning.intern_text(data['attr-name'])
+            self._atype = interning.intern_text(data['attr-type'])
             self._value = data['attr-value']
             if self.atype == 'bool':
                 if self._value == 0:
@@ -107,8 +151,10 @@ class Attribute(AttributeBase):
         return self._name
 
     def _set_name(self, val):
+        self.object_store.checkWritable()
+        self.storageAction('write_data', {'name': 'attr-name', 'value': val})
         self._name = val
-        self.storageAction('write_data', {'name': 'attr-name', 'value': self._name})
+        self._dropParentIndex()
         self.setModified()
     name = property(_get_name, _set_name)
 
@@ -118,6 +164,7 @@ class Attribute(AttributeBase):
         return self._value
 
     def _set_value(self, val):
+        self.object_store.checkWritable()
         if self._atype == 'text':
             if type(val) not in [unicode, str]:
                 raise errors.SiptrackError('attribute value doesn\'t match type')
@@ -145,14 +192,19 @@ class Attribute(AttributeBase):
         self.setModified()
     value = property(_get_value, _set_value)
 
+    def _snapshotState(self):
+        """Name, type and value for objecttree.TreeSnapshot, see search."""
+        return (self._name, self._atype, self._value)
+
     def _get_atype(self):
         if not self._atype:
             raise errors.MissingData('missing attribute value')
         return self._atype
 
     def _set_atype(self, val):
+        self.object_store.checkWritable()
+        self.storageAction('write_data', {'name': 'attr-type', 'value': val})
         self._atype = val
-        self.storageAction('write_data', {'name': 'attr-type', 'value': self._atype})
         self.setModified()
     atype = property(_get_atype, _set_atype)
 
@@ -170,22 +222,25 @@ class VersionedAttribute(AttributeBase):
             bool   : True/False
         value : a value matching the attributes type.
     """
+    __slots__ = ()
     class_id = 'VA'
     class_name = 'versioned attribute'
+    _name = storagevalue.TextField('attr-name')
+    _atype = storagevalue.TextField('attr-type', '_atype_validator')
+    _values = storagevalue.Field('attr-values', '_values_validator')
+    _max_versions = storagevalue.NumField('attr-max-versions',
+            '_max_versions_validator')
 
     def __init__(self, oid, branch, name = None, atype = None,
             value = None, max_versions = None):
         super(VersionedAttribute, self).__init__(oid, branch)
-        self._name = storagevalue.StorageText(self, 'attr-name', name)
-        self._atype = storagevalue.StorageText(self, 'attr-type', atype,
-                self._atype_validator)
+        self._name.init(name)
+        self._atype.init(atype)
         values = []
         if value is not None:
             values = [value]
-        self._values = storagevalue.StorageValue(self, 'attr-values', values,
-                self._values_validator)
-        self._max_versions = storagevalue.StorageNum(self, 'attr-max-versions',
-                max_versions, self._max_versions_validator)
+        self._values.init(values)
+        self._max_versions.init(max_versions)
 
     def _atype_validator(self, value):
         if value not in ['text', 'binary', 'int', 'bool']:
@@ -218,11 +273,17 @@ class VersionedAttribute(AttributeBase):
         if type(value) not in [int, long] or value < 1:
             raise errors.SiptrackError('invalid max versions value for VersionedAttribute')
 
-    def getParentNode(self):
-        """Get the closest parent _non-attribute_ node."""
+    def getParentNode(self, snapshot = None):
+        """Get the closest parent _non-attribute_ node.
+
+        snapshot is an optional objecttree.TreeSnapshot to look in.
+        """
         parent = self
         while parent.class_id in ['VA', 'CA']:
-            parent = parent.parent
+            if snapshot is None:
+                parent = parent.parent
+            else:
+                parent = snapshot.parent(parent)
         return parent
 
     def _created(self, user):
@@ -239,6 +300,8 @@ class VersionedAttribute(AttributeBase):
         self._atype.preload(data)
         self._values.preload(data)
         self._max_versions.preload(data)
+        self._name.init(interning.intern_text(self._name.value))
+        self._atype.init(interning.intern_text(self._atype.value))
 
     def _remove(self, *args, **kwargs):
         oid = self.oid
@@ -250,6 +313,7 @@ class VersionedAttribute(AttributeBase):
         return self._name.get()
     def _set_name(self, val):
         self._name.set(val)
+        self._dropParentIndex()
         self.setModified()
     name = property(_get_name, _set_name)
 
@@ -261,7 +325,8 @@ class VersionedAttribute(AttributeBase):
     def _set_value(self, val):
         if not self._isValidValue(val):
             raise errors.SiptrackError('invalid value for VersionedAttribute')
-        values = self.values
+        # Copy the list, the stored one is only replaced by self.values.
+        values = list(self.values)
         values.append(val)
         if len(values) > self.max_versions:
             values.pop(0)
@@ -271,6 +336,10 @@ class VersionedAttribute(AttributeBase):
         self.setModified()
     value = property(_get_value, _set_value)
 
+    def _snapshotState(self):
+        """Name, type and value for objecttree.TreeSnapshot, see search."""
+        return (self.name, self.atype, self.value)
+
     def _get_values(self):
         return self._values.get()
     def _set_values(self, val):
@@ -313,8 +382,10 @@ class EncryptedAttribute(AttributeBase):
     As of writing only atype=text is supported.
     """
 
+    __slots__ = ('_pk', '_name', '_atype', '_value', 'user')
     class_id = 'ENCA'
     class_name = 'encrypted attribute'
+    _lock_data = storagevalue.Field('enca-lockdata')
 
     def __init__(self, oid, branch, name = None, atype = None, value = None):
         super(EncryptedAttribute, self).__init__(oid, branch)
@@ -323,7 +394,6 @@ class EncryptedAttribute(AttributeBase):
         self._name = name
         self._atype = atype
         self._value = value
-        self._lock_data = storagevalue.StorageValue(self, 'enca-lockdata')
 
 
     def _created(self, user):
@@ -337,8 +407,8 @@ class EncryptedAttribute(AttributeBase):
     def _loaded(self, data = None):
         super(EncryptedAttribute, self)._loaded(data)
         if data:
-            self._name = data['attr-name']
-            self._atype = data['attr-type']
+            self._name = interning.intern_text(data['attr-name'])
+            self._atype = interning.intern_text(data['attr-type'])
             self._value = data['attr-value']
         self._lock_data.preload(data)
 
@@ -363,11 +433,17 @@ class EncryptedAttribute(AttributeBase):
         return values
 
 
-    def getParentNode(self):
-        """Get the closest parent _non-attribute_ node."""
+    def getParentNode(self, snapshot = None):
+        """Get the closest parent _non-attribute_ node.
+
+        snapshot is an optional objecttree.TreeSnapshot to look in.
+        """
         parent = self
         while parent.class_id in ['VA', 'CA', 'ENCA']:
-            parent = parent.parent
+            if snapshot is None:
+                parent = parent.parent
+            else:
+                parent = snapshot.parent(parent)
         return parent
     
 
@@ -394,6 +470,7 @@ class EncryptedAttribute(AttributeBase):
 
 
     def setAttribute(self, user, val):
+        self.object_store.checkWritable()
         parent = self.getParentNode()
         self._pk = parent.password_key
 
@@ -435,8 +512,9 @@ class EncryptedAttribute(AttributeBase):
 
     @name.setter
     def name(self, val):
+        self.object_store.checkWritable()
+        self.storageAction('write_data', {'name': 'attr-name', 'value': val})
         self._name = val
-        self.storageAction('write_data', {'name': 'attr-name', 'value': self._name})
         self.setModified()
 
 
@@ -462,11 +540,12 @@ class EncryptedAttribute(AttributeBase):
 
     @atype.setter
     def atype(self, val):
-        self._atype = val
+        self.object_store.checkWritable()
         self.storageAction(
             'write_data',
-            {'name': 'attr-type', 'value': self._atype}
+            {'name': 'attr-type', 'value': val}
         )
+        self._atype = val
 
 
     @property
@@ -0,0 +1,184 @@
+"""Approximate memory use of the object store, see ObjectStore.census.
+
+Sizes are sums of sys.getsizeof: an object is counted along with the
+containers, strings and numbers it holds directly and, for nodes, the
+StorageValues they own. Other objects it refers to (other nodes,
+branches, the object store, caches) are not counted. Shared strings
+(interned oids, class ids and names) are counted once for every object
+holding them, so the numbers are on the high side.
+
+Byte counts are returned as floats, census results are passed over
+XML-RPC which can't carry ints above 2**31 - 1.
+"""
+
+import sys
+
+from siptrackdlib import objecttree
+from siptrackdlib import storagevalue
+from siptrackdlib.objectregistry import object_registry
+
+# Number of items counted before yielding to the reactor.
+STEP_SIZE = 1000
+
+_scalar_types = set([str, unicode, int, long, float, bool])
+
+def _scalar_size(value):
+    if type(value) in _scalar_types:
+        return sys.getsizeof(value)
+    return 0
+
+def value_size(value):
+    """Return the size of value and the scalars it contains.
+
+    Anything but scalars and lists, tuples, sets and dicts of them
+    counts as 0 (it isn't owned by whoever holds value).
+    """
+    vtype = type(value)
+    if vtype in _scalar_types:
+        return sys.getsizeof(value)
+    if vtype is dict:
+        size = sys.getsizeof(value)
+        for key, item in value.iteritems():
+            size += _scalar_size(key) + _scalar_size(item)
+        return size
+    if vtype in (list, tuple, set):
+        if value is objecttree.EMPTY:
+            return 0
+        size = sys.getsizeof(value)
+        for item in value:
+            size += _scalar_size(item)
+        return size
+    return 0
+
+# class -> names of the __slots__ of the class and its bases.
+_slot_names = {}
+
+def _get_slot_names(cls):
+    names = _slot_names.get(cls)
+    if names is None:
+        names = []
+        for base in cls.__mro__:
+            slots = base.__dict__.get('__slots__', ())
+            if isinstance(slots, basestring):
+                slots = (slots,)
+            for name in slots:
+                if name not in ('__weakref__', '__dict__'):
+                    names.append(name)
+        names = _slot_names[cls] = tuple(names)
+    return names
+
+def _attribute_values(obj):
+    """Yield the values of an objects __slots__ and __dict__."""
+    for name in _get_slot_names(type(obj)):
+        try:
+            yield getattr(obj, name)
+        except AttributeError:
+            pass
+    attributes = getattr(obj, '__dict__', None)
+    if attributes:
+        for value in attributes.itervalues():
+            yield value
+
+def node_size(node):
+    """Return the approximate size of a (loaded) node."""
+    size = sys.getsizeof(node)
+    attributes = getattr(node, '__dict__', None)
+    if attributes is not None:
+        size += sys.getsizeof(attributes)
+    for value in _attribute_values(node):
+        if isinstance(value, storagevalue.StorageValue):
+            size += sys.getsizeof(value)
+            for sv_value in _attribute_values(value):
+                size += value_size(sv_value)
+        else:
+            size += value_size(value)
+    return size
+
+def _branch_list_size(branches):
+    if branches is None or branches is objecttree.EMPTY:
+        return 0
+    if type(branches) is objecttree.BranchList:
+        return sys.getsizeof(branches) + sys.getsizeof(branches.items) + \
+                sys.getsizeof(branches.index)
+    if type(branches) is dict:
+        size = sys.getsizeof(branches)
+        for children in branches.itervalues():
+            size += _branch_list_size(children)
+        return size
+    return sys.getsizeof(branches)
+
+def branch_size(branch):
+    """Return the approximate size of a branch, without its ext_data."""
+    return sys.getsizeof(branch) + \
+            _branch_list_size(branch.branches) + \
+            _branch_list_size(branch.associations) + \
+            _branch_list_size(branch.references) + \
+            _branch_list_size(branch._child_index)
+
+class NodeCensus(object):
+    """Node counts and sizes per node class.
+
+    For every class: count is the number of nodes in the tree, loaded
+    the number of them that are loaded and bytes the approximate size
+    of their branches and loaded nodes.
+    """
+    def __init__(self):
+        self.classes = {}
+        self.branches = 0
+        self.bytes = 0
+
+    def add(self, branch):
+        node = branch._ext_data
+        class_id = branch.class_id
+        if class_id is None and node is not None:
+            class_id = node.class_id
+        counts = self.classes.get(class_id)
+        if counts is None:
+            counts = self.classes[class_id] = {'count': 0, 'loaded': 0,
+                    'bytes': 0}
+        size = branch_size(branch)
+        counts['count'] += 1
+        if node is not None:
+            counts['loaded'] += 1
+            size += node_size(node)
+        counts['bytes'] += size
+        self.branches += 1
+        self.bytes += size
+
+    def asDict(self):
+        classes = {}
+        for class_id, counts in self.classes.iteritems():
+            class_reference = object_registry.getClassById(class_id)
+            if class_reference is not None:
+                name = class_reference.class_name
+            else:
+                name = str(class_id)
+            classes[name] = {'count': counts['count'],
+                    'loaded': counts['loaded'],
+                    'bytes': float(counts['bytes'])}
+        return {'classes': classes, 'count': self.branches,
+                'bytes': float(self.bytes)}
+
+class MappingCensus(object):
+    """Entry count and approximate size of a dict."""
+    def __init__(self):
+        self.entries = 0
+        self.bytes = 0
+
+    def iterCount(self, mapping, step = STEP_SIZE):
+        """Count mapping, yields (None) after every step entries.
+
+        Works on a copy of the keys, the mapping can change between
+        steps.
+        """
+        self.bytes += sys.getsizeof(mapping)
+        for n, key in enumerate(mapping.keys()):
+            if n % step == step - 1:
+                yield None
+            if key not in mapping:
+                continue
+            self.entries += 1
+            self.bytes += sys.getsizeof(key) + value_size(mapping[key])
+
+    def asDict(self):
+        return {'entries': self.entries, 'bytes': float(self.bytes)}
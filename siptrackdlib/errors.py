@@ -9,6 +9,32 @@ class StorageError(SiptrackError):
     """Generic siptrackd storage error."""
     pass
 
+class SnapshotError(SiptrackError):
+    """Invalid or unusable object store snapshot."""
+    pass
+
+class JournalTrimmed(StorageError):
+    """Change journal entries that are needed have been trimmed."""
+    pass
+
+class OIDsExhausted(SiptrackError):
+    """No reserved oids left, retry once more have been reserved."""
+    def __str__(self):
+        if len(self.args) == 1:
+            ret = self.args[0]
+        else:
+            ret = 'out of reserved oids, please retry'
+        return ret
+
+class ReadOnly(SiptrackError):
+    """Write attempted on a read-only object store."""
+    def __str__(self):
+        if len(self.args) == 1:
+            ret = self.args[0]
+        else:
+            ret = 'object store is read-only'
+        return ret
+
 class AlreadyExists(SiptrackError):
     """Generic object already exists error."""
     def __str__(self):
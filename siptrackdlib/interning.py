@@ -0,0 +1,54 @@
+"""String interning for the load path.
+
+Loading a large object store creates the same strings over and over:
+every row read from storage carries its own copy of the oid, class id
+and node data names, and every attribute its own copy of common
+attribute names ("name", "description", "username"). Interning them
+keeps a single shared copy of each.
+
+intern_id is used for oids, class ids and node data names, which are
+always ascii. They are returned as (builtin) interned str objects, so
+loaded oids match the str oids handed out for new nodes, and are freed
+again when no longer used.
+
+intern_text is used for attribute names and types, which can be either
+str or unicode and keep their type. str values are interned like ids,
+unicode values are kept in a table for the lifetime of the process.
+The table holds distinct names only, but names are user supplied, so
+it is bounded: once it holds MAX_TEXT_TABLE values new ones are no
+longer added (and no longer shared), values already in it still are.
+"""
+
+# Max number of unicode values kept by intern_text.
+MAX_TEXT_TABLE = 100000
+
+_text_table = {}
+
+def intern_id(value):
+    """Return a shared str copy of an oid, class id or data name."""
+    if value is None:
+        return None
+    if type(value) is not str:
+        value = str(value)
+    return intern(value)
+
+def intern_text(value):
+    """Return a shared copy of a str or unicode value.
+
+    Other values are returned unchanged.
+    """
+    vtype = type(value)
+    if vtype is str:
+        return intern(value)
+    if vtype is unicode:
+        shared = _text_table.get(value)
+        if shared is None:
+            if len(_text_table) >= MAX_TEXT_TABLE:
+                return value
+            shared = _text_table[value] = value
+        return shared
+    return value
+
+def text_table_size():
+    """Return the number of values in the intern_text table."""
+    return len(_text_table)
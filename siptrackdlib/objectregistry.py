@@ -1,5 +1,6 @@
 from siptrackdlib import errors
 from siptrackdlib import log
+from siptrackdlib import objecttree
 
 class ObjectClass(object):
     """A class definition in the object registry.
@@ -20,13 +21,11 @@ class ObjectRegistry(object):
 
     The object registry is used to keep track of valid classes and
     what classes are valid children of a class.
-    It also allocates object ids and can be used to create new objects
-    based on the registry.
+    It can also be used to create new objects based on the registry.
     """
     def __init__(self):
         self.object_classes = {}
         self.object_classes_by_name = {}
-        self.next_oid = 0
 
     def registerClass(self, class_reference):
         """Register a new class.
@@ -71,34 +70,29 @@ class ObjectRegistry(object):
             return object_class.class_reference.class_id
         return None
 
-    def allocateOID(self):
-        """Allocate a new oid."""
-        ret = str(self.next_oid)
-        self.next_oid += 1
-        return ret
-
-    def revertOID(self):
-        """Revert an oid allocation."""
-        self.next_oid -= 1
-
     def createObject(self, class_id, parent_branch, *args, **kwargs):
         """Try to create a new object based on a registered class.
 
         This will try to create a new object of 'class_id' type, allocating
         it it's own oid. A new branch will also be created in the object
         tree to hold the object.
+        The oid is allocated by the object store the tree belongs to.
         """
         if class_id not in self.object_classes:
             raise errors.SiptrackError(
                     'trying to create object with invalid class id \'%s\'' % (class_id))
         object_class = self.object_classes[class_id]
-        oid = self.allocateOID()
-        branch = parent_branch.add(oid)
+        tree = parent_branch
+        if isinstance(parent_branch, objecttree.Branch):
+            tree = parent_branch.tree
+        oid_allocator = tree.ext_data.oid_allocator
+        oid = oid_allocator.allocate()
+        branch = parent_branch.add(oid, class_id = class_id)
         try:
             obj = object_class.class_reference(oid, branch, *args, **kwargs)
         except Exception as e:
             branch.remove(recursive = False, callback_data = None)
-            self.revertOID()
+            oid_allocator.revert()
             raise
         branch.ext_data = obj
         return obj
@@ -1,8 +1,89 @@
 import sys
 import time
+import weakref
 
 from siptrackdlib import errors
 from siptrackdlib import log
+from siptrackdlib import interning
+
+# Shared placeholder for empty branch, association and reference lists.
+# Most branches are leaves without associations, so the lists are only
+# created when the first item is added (see _list_add/_list_remove).
+EMPTY = ()
+# Lists that grow past this size are replaced with a BranchList.
+BRANCHLIST_THRESHOLD = 32
+
+class BranchList(object):
+    """An insertion ordered list of branches with O(1) removal.
+
+    Used for large child, association and reference lists. Removed
+    branches leave a None tombstone in self.items and are dropped from
+    self.index (branch -> position), the list is compacted when more
+    than half of it is tombstones. Iteration order is the same as for
+    a regular list. Compaction builds a new items list, so iterators
+    created before it are left alone.
+    """
+    __slots__ = ('items', 'index', 'count')
+
+    def __init__(self, branches = EMPTY):
+        self.items = []
+        self.index = {}
+        self.count = 0
+        for branch in branches:
+            self.append(branch)
+
+    def __iter__(self):
+        for branch in self.items:
+            if branch is not None:
+                yield branch
+
+    def __len__(self):
+        return self.count
+
+    def __nonzero__(self):
+        return self.count > 0
+
+    def __contains__(self, branch):
+        return branch in self.index
+
+    def append(self, branch):
+        self.index[branch] = len(self.items)
+        self.items.append(branch)
+        self.count += 1
+
+    def remove(self, branch):
+        try:
+            pos = self.index.pop(branch)
+        except KeyError:
+            raise ValueError('BranchList.remove(x): x not in list')
+        self.items[pos] = None
+        self.count -= 1
+        if len(self.items) > BRANCHLIST_THRESHOLD and \
+                self.count < len(self.items) / 2:
+            self._compact()
+
+    def _compact(self):
+        items = [branch for branch in self.items if branch is not None]
+        self.items = items
+        self.index = dict((branch, pos) for pos, branch in enumerate(items))
+
+def _list_add(seq, item):
+    """Append item to seq, returns the (possibly new) list."""
+    if seq is EMPTY:
+        return [item]
+    if type(seq) is list and len(seq) >= BRANCHLIST_THRESHOLD:
+        seq = BranchList(seq)
+    seq.append(item)
+    return seq
+
+def _list_remove(seq, item):
+    """Remove item from seq, returns the (possibly shared empty) list."""
+    if seq is EMPTY:
+        raise ValueError('list.remove(x): x not in list')
+    seq.remove(item)
+    if not seq:
+        return EMPTY
+    return seq
 
 class FilterInclude(object):
     """A traversal filter that always returns 1 (matched)."""
@@ -14,7 +95,7 @@ class FilterInclude(object):
 filter_include = FilterInclude()
 
 def traverse_tree_depth_first(root, include_root, max_depth, filter = None,
-        include_depth = False):
+        include_depth = False, children = None):
     """Depth-first iteration through a tree starting at 'root'.
 
     If include_root is true also returns the root object given, otherwise
@@ -32,6 +113,9 @@ def traverse_tree_depth_first(root, include_root, max_depth, filter = None,
      1 : include branch.
     Filters must also have a result attribute that contains the result
     of the last filter operation.
+
+    children can be a function that returns the child branches of a
+    branch, used instead of branch.branches (see TreeSnapshot).
     """
     if filter == None:
         filter = filter_include
@@ -50,7 +134,10 @@ def traverse_tree_depth_first(root, include_root, max_depth, filter = None,
     if max_depth != -1 and depth > max_depth:
         return
     iterators = []
-    cur_iterator = iter(root.branches)
+    if children is None:
+        cur_iterator = iter(root.branches)
+    else:
+        cur_iterator = iter(children(root))
     while cur_iterator != None:
         try:
             branch = cur_iterator.next()
@@ -59,11 +146,15 @@ def traverse_tree_depth_first(root, include_root, max_depth, filter = None,
                     yield (depth, branch)
                 else:
                     yield branch
-            if branch.branches and filter.result != -1 and \
+            if children is None:
+                branches = branch.branches
+            else:
+                branches = children(branch)
+            if branches and filter.result != -1 and \
                     (max_depth == -1 or depth < max_depth):
                 depth += 1
                 iterators.append(cur_iterator)
-                cur_iterator = iter(branch.branches)
+                cur_iterator = iter(branches)
         except StopIteration:
             if len(iterators) > 0:
                 cur_iterator = iterators.pop()
@@ -104,22 +195,32 @@ class Branch(object):
     A branch is a node in a tree. A branch can also have its own branches
     (sub-nodes). Each branch is identified globally by an object id (oid)
     that is stored for easy lookup in the tree.
+
+    Branches use __slots__ and share EMPTY for empty lists, there is
+    one per node in the tree.
     """
-    def __init__(self, tree, parent, oid, ext_data = None):
+    __slots__ = ('tree', 'parent', 'oid', 'class_id', 'branches',
+            'associations', 'references', '_ext_data', '_child_index')
+
+    def __init__(self, tree, parent, oid, ext_data = None, class_id = None):
         """Init.
 
         tree is the.. tree.
         parent is the parent branch.
         oid is the branches object id.
         ext_data is any external data to be stored.
+        class_id is the class id of the ext_data object, used to look up
+        children by class (see listChildrenByClass).
         """
         self.tree = tree
         self.parent = parent
         self.oid = oid
-        self.branches = []
-        self.associations = []
-        self.references = []
+        self.class_id = class_id
+        self.branches = EMPTY
+        self.associations = EMPTY
+        self.references = EMPTY
         self._ext_data = ext_data
+        self._child_index = None
 
     def __iter__(self):
         for branch in traverse_tree_depth_first(self, include_root = True):
@@ -136,7 +237,8 @@ class Branch(object):
         """
         self.tree = None
         self.parent = None
-        self.selfes = None
+        self.branches = None
+        self._child_index = None
         self.associations = None
         self.references = None
         if self._ext_data and hasattr(self._ext_data, '_treeFree'):
@@ -154,6 +256,8 @@ class Branch(object):
 
         Child branches will be moved to the parent branch.
         """
+        if self.tree.snapshots:
+            self.tree.preserve(self)
         affected_extdata = [self.ext_data]
         self.tree.remove_callback(self, callback_data)
         self.tree.removedBranch(self.oid)
@@ -162,7 +266,8 @@ class Branch(object):
             branch.relocate(self.parent)
             affected_extdata.append(branch.ext_data)
         self.branches = None
-        self.parent.branches.remove(self)
+        self._child_index = None
+        self.parent.removeChildBranch(self)
         self.parent = None
 
         for association in list(self.associations):
@@ -189,24 +294,113 @@ class Branch(object):
             ret = self._removeSingle(callback_data)
         return ret
 
+    def detach(self):
+        """Remove a single branch from the tree without any callbacks.
+
+        Used to mirror a removal that has already happened elsewhere
+        (in storage). Child branches are moved to the parent branch.
+        Returns the branches ext_data if it was loaded, otherwise None.
+        """
+        if self.tree.snapshots:
+            self.tree.preserve(self)
+        ext_data = self._ext_data
+        self.tree.removedBranch(self.oid)
+        for branch in list(self.branches):
+            branch.move(self.parent)
+        self.branches = None
+        self._child_index = None
+        self.parent.removeChildBranch(self)
+        self.parent = None
+        for association in list(self.associations):
+            self.disassociate(association)
+        self.associations = None
+        for reference in list(self.references):
+            reference.disassociate(self)
+        self.references = None
+        self.tree = None
+        self.oid = None
+        self._ext_data = None
+        return ext_data
+
     def relocate(self, new_parent):
         """Relocate a branch (give it a new parent)."""
-        self.parent.branches.remove(self)
-        new_parent.branches.append(self)
-        self.parent = new_parent
+        self.move(new_parent)
         self.tree.relocate_callback(self)
 
-    def addBranch(self, oid, ext_data = None):
+    def move(self, new_parent):
+        """Relocate a branch without calling the relocate callback."""
+        if self.tree.snapshots:
+            self.tree.preserve(self)
+        self.parent.removeChildBranch(self)
+        new_parent.addChildBranch(self)
+        self.parent = new_parent
+
+    def addBranch(self, oid, ext_data = None, class_id = None):
         """Create a new directly attached branch."""
         if self.tree.branchExists(oid):
             raise errors.SiptrackError(
                     'a branch with oid %s already exists' % (oid))
-        branch = Branch(self.tree, self, oid, ext_data)
-        self.branches.append(branch)
+        branch = Branch(self.tree, self, oid, ext_data, class_id)
+        self.addChildBranch(branch)
         self.tree.addedBranch(oid, branch)
         return branch
     add = addBranch
 
+    def addChildBranch(self, branch):
+        """Attach an existing branch to this branch."""
+        if self.tree.snapshots:
+            self.tree.preserve(self)
+        self.branches = _list_add(self.branches, branch)
+        index = self._child_index
+        if index is not None:
+            index[branch.class_id] = _list_add(
+                    index.get(branch.class_id, EMPTY), branch)
+
+    def removeChildBranch(self, branch):
+        """Detach a directly attached branch."""
+        if self.tree.snapshots:
+            self.tree.preserve(self)
+        self.branches = _list_remove(self.branches, branch)
+        index = self._child_index
+        if index is not None:
+            children = _list_remove(index[branch.class_id], branch)
+            if children:
+                index[branch.class_id] = children
+            else:
+                del index[branch.class_id]
+            if not self.branches:
+                self._child_index = None
+
+    def listChildrenByClass(self, class_ids):
+        """Return the directly attached branches with a class id in class_ids.
+
+        Branches are returned in the same order as in self.branches.
+        A class id -> children index is built the first time this is
+        called for a branch with at least BRANCHLIST_THRESHOLD children
+        and kept up to date after that.
+        Returns None if the index can't be used, either because the
+        branch has too few children to bother or because more than one
+        of class_ids has children (their relative order isn't kept).
+        """
+        if not self.branches:
+            return EMPTY
+        index = self._child_index
+        if index is None:
+            if len(self.branches) < BRANCHLIST_THRESHOLD:
+                return None
+            index = self._child_index = {}
+            for branch in self.branches:
+                index[branch.class_id] = _list_add(
+                        index.get(branch.class_id, EMPTY), branch)
+        found = EMPTY
+        for class_id in class_ids:
+            children = index.get(class_id)
+            if children:
+                if found:
+                    return None
+                found = children
+        return found
+
     def associate(self, other):
         """Associate a branch with another branch.
 
@@ -214,7 +408,9 @@ class Branch(object):
         will also keep a reference to this branch.
         """
         if other:
-            self.associations.append(other)
+            if self.tree.snapshots:
+                self.tree.preserve(self)
+            self.associations = _list_add(self.associations, other)
             other.reference(self)
 
     def reference(self, other):
@@ -223,16 +419,22 @@ class Branch(object):
         This is the inverse of an association.
         """
         if other:
-            self.references.append(other)
+            if self.tree.snapshots:
+                self.tree.preserve(self)
+            self.references = _list_add(self.references, other)
 
     def disassociate(self, other):
         """Remove an association to another branch."""
-        self.associations.remove(other)
+        if self.tree.snapshots:
+            self.tree.preserve(self)
+        self.associations = _list_remove(self.associations, other)
         other.dereference(self)
 
     def dereference(self, other):
         """Remove a reference to another branch."""
-        self.references.remove(other)
+        if self.tree.snapshots:
+            self.tree.preserve(self)
+        self.references = _list_remove(self.references, other)
 
     def traverse(self, include_self, max_depth, filter = None,
             include_depth = False):
@@ -256,6 +458,8 @@ class Branch(object):
         """
         if self._ext_data is None:
             self._ext_data = self.tree.load_data_callback(self)
+        elif self.tree.access_callback is not None:
+            self.tree.access_callback(self)
         return self._ext_data
 
     def _set_ext_data(self, value):
@@ -263,6 +467,13 @@ class Branch(object):
         self._ext_data = value
     ext_data = property(_get_ext_data, _set_ext_data)
 
+    def unload(self):
+        """Drop the branches external data.
+
+        It is loaded again from the tree the next time it's accessed.
+        """
+        self._ext_data = None
+
 class Tree(object):
     """A hierarchal tree containing branches.
 
@@ -284,11 +495,20 @@ class Tree(object):
 
         ext_data can contain, anything, for access by branches ext_data
         objects.
+
+        access_callback can be set to a function that is called with a
+        branch whenever its already loaded external data is accessed.
+
+        self.version is bumped for every change made while there are
+        open snapshots (see snapshot).
         """
         self.branches = []
         self.oid_mapping = {}
         self.callbacks = callbacks
         self.ext_data = ext_data
+        self.access_callback = None
+        self.version = 0
+        self.snapshots = weakref.WeakSet()
 
     def __iter__(self):
         for branch in traverse_tree_depth_first(self, include_root = False):
@@ -319,6 +539,10 @@ class Tree(object):
         the tree.
         """
         self.oid_mapping[oid] = branch
+        if self.snapshots:
+            self.version += 1
+            for snapshot in self.snapshots:
+                snapshot.added(branch)
 
     def removedBranch(self, oid):
         """Notification of branch removal.
@@ -328,17 +552,49 @@ class Tree(object):
         """
         del self.oid_mapping[oid]
 
-    def addBranch(self, oid, ext_data = None):
+    def addBranch(self, oid, ext_data = None, class_id = None):
         """Create a new directly attached branch."""
         if self.branchExists(oid):
             raise errors.SiptrackError(
                     'a branch with oid %s already exists' % (oid))
-        branch = Branch(self, self, oid, ext_data)
-        self.branches.append(branch)
+        branch = Branch(self, self, oid, ext_data, class_id)
+        self.addChildBranch(branch)
         self.addedBranch(oid, branch)
         return branch
     add = addBranch
 
+    def addChildBranch(self, branch):
+        """Attach an existing branch directly to the tree."""
+        if self.snapshots:
+            self.preserve(self)
+        self.branches.append(branch)
+
+    def removeChildBranch(self, branch):
+        """Detach a directly attached branch."""
+        if self.snapshots:
+            self.preserve(self)
+        self.branches.remove(branch)
+
+    def snapshot(self, capture = None):
+        """Return a TreeSnapshot, a read view of the tree as it is now.
+
+        capture is passed on to the snapshot, see TreeSnapshot.
+        The snapshot stays open until it is closed or no longer used.
+        """
+        snapshot = TreeSnapshot(self, capture)
+        self.snapshots.add(snapshot)
+        return snapshot
+
+    def preserve(self, branch):
+        """Notification of a branch or its ext_data about to change.
+
+        Must be called before the change is made, the open snapshots
+        keep a copy of the branch (see TreeSnapshot.preserve).
+        """
+        self.version += 1
+        for snapshot in self.snapshots:
+            snapshot.preserve(branch)
+
     def traverse(self, max_depth = -1, filter = None, include_depth = False):
         """Depth-first traversal of the tree and it's branches."""
         return traverse_tree_depth_first(self, include_root = False,
@@ -348,20 +604,41 @@ class Tree(object):
     def loadBranches(self, branches):
         """Bulk addition of branches.
 
-        'branches' is a list of (parent_oid, oid) pairs that will be
-        added to the tree. If parent_oid is 'ROOT' the tree will be used as
-        parent.
+        'branches' is a list of (parent_oid, oid) pairs or
+        (parent_oid, oid, class_id) rows that will be added to the tree,
+        any additional columns in each row are ignored. If parent_oid is
+        'ROOT' the tree will be used as parent. Oids and class ids are
+        interned.
+        Parents can be either existing branches or branches in the list.
+        """
+        for _ in self.iterLoadBranches(branches):
+            pass
+
+    def iterLoadBranches(self, branches, step = 10000):
+        """Generator version of loadBranches.
+
+        Yields (None) after every step branches, used to load large
+        trees in steps (see task.cooperate). The branches are only
+        attached to their parents at the end, once all have been added.
         """
-        start = time.time()
         created_branches = []
-        for parent_oid, oid in branches:
+        for row in branches:
+            parent_oid = interning.intern_id(row[0])
+            oid = interning.intern_id(row[1])
+            class_id = None
+            if len(row) > 2:
+                class_id = interning.intern_id(row[2])
             if self.branchExists(oid):
                 raise errors.SiptrackError(
                     'a branch with oid %s already exists' % (oid))
-            branch = Branch(self, parent_oid, oid)
+            branch = Branch(self, parent_oid, oid, class_id = class_id)
             self.addedBranch(oid, branch)
             created_branches.append(branch)
-        for branch in self.oid_mapping.itervalues():
+            if len(created_branches) % step == 0:
+                yield None
+        for n, branch in enumerate(created_branches):
+            if n % step == step - 1:
+                yield None
             if type(branch.parent) in [str, unicode]:
                 if branch.parent == 'ROOT':
                     parent = self
@@ -373,7 +650,7 @@ class Tree(object):
 #                        'unable to locate parent %s for oid %s' % (branch.parent, branch.oid))
                 else:
                     branch.parent = parent
-                    parent.branches.append(branch)
+                    parent.addChildBranch(branch)
 
     def loadAssociations(self, associations):
         """Bulk addition of associations.
@@ -420,9 +697,208 @@ class Tree(object):
         This gets rid of the entire tree, releasing the branches etc.
         This is used to free up trees memory when it's use is finished.
         """
-        for branch in traverse_tree_reverse(self, False):
+        for _ in self.iterFree():
+            pass
+
+    def iterFree(self, step = 10000):
+        """Generator version of free, yields after every step branches."""
+        for snapshot in list(self.snapshots):
+            snapshot.close()
+        for n, branch in enumerate(traverse_tree_reverse(self, False)):
             branch.free()
+            if n % step == step - 1:
+                yield None
         self.branches = None
         self.oid_mapping = None
         self.callbacks = None
+        self.access_callback = None
         self.ext_data = None
+
+class _SavedBranch(object):
+    """The state of a branch when a TreeSnapshot was taken."""
+    __slots__ = ('branch', 'parent', 'branches', 'associations',
+            'references', 'ext_data', 'state', 'data')
+
+    def __init__(self, branch, parent, branches, associations, references,
+            ext_data):
+        self.branch = branch
+        self.parent = parent
+        self.branches = branches
+        self.associations = associations
+        self.references = references
+        self.ext_data = ext_data
+        self.state = None
+        self.data = None
+
+class TreeSnapshot(object):
+    """A read view of a tree frozen at the time it was created.
+
+    Nothing is copied up front. The tree calls preserve for every branch
+    that is about to change while the snapshot is open, and the first
+    time that happens for a branch the snapshot keeps a copy of its
+    parent, child, association and reference lists and its ext_data
+    object. Reads go to the copy if there is one, otherwise to the live
+    branch, which hasn't changed since the snapshot was taken. If the
+    tree version is still the same as when the snapshot was taken
+    nothing has changed at all and reads go straight to the tree.
+
+    ext_data objects are shared with the tree, so a copy is also kept
+    of their data:
+        ext_data._snapshotState(), if it exists, is stored and returned
+        by state() (see attribute.Attribute._snapshotState).
+        capture(ext_data) is called if a capture function was given,
+        the return value is returned by data(). This is used to keep a
+        copy of whatever a reader needs from the ext_data objects.
+
+    Branches added after the snapshot was taken are never returned.
+    Branches removed after it was taken are still returned, as are
+    their ext_data objects (which will have been marked as removed).
+
+    A snapshot must be closed when it is no longer needed, until then
+    every change to the tree also makes a copy.
+    """
+    def __init__(self, tree, capture = None):
+        self.tree = tree
+        self.capture = capture
+        self.version = tree.version
+        # branch -> _SavedBranch, None for branches added after the
+        # snapshot was taken.
+        self.saved = {}
+        # ext_data -> _SavedBranch, used to find the branches of
+        # removed nodes.
+        self.saved_ext_data = {}
+
+    def close(self):
+        """Stop tracking changes to the tree and drop all copies."""
+        if self.tree is not None:
+            self.tree.snapshots.discard(self)
+        self.tree = None
+        self.capture = None
+        self.saved = {}
+        self.saved_ext_data = {}
+
+    def added(self, branch):
+        """Notification of a new branch being added to the tree."""
+        if branch not in self.saved:
+            self.saved[branch] = None
+
+    def preserve(self, branch):
+        """Keep a copy of branch unless one has already been kept."""
+        if branch in self.saved:
+            return
+        if branch is self.tree:
+            self.saved[branch] = _SavedBranch(branch, None,
+                    list(branch.branches), EMPTY, EMPTY, None)
+            return
+        ext_data = branch.ext_data
+        saved = _SavedBranch(branch, branch.parent, tuple(branch.branches),
+                tuple(branch.associations), tuple(branch.references),
+                ext_data)
+        self.saved[branch] = saved
+        if ext_data is None:
+            return
+        self.saved_ext_data[ext_data] = saved
+        if hasattr(ext_data, '_snapshotState'):
+            saved.state = ext_data._snapshotState()
+        if self.capture:
+            try:
+                saved.data = self.capture(ext_data)
+            except Exception, e:
+                # Never let a reader break a write, the live data will
+                # be used for the branch instead.
+                log.msg('TreeSnapshot: capture failed for %s: %s' % (
+                    branch.oid, e))
+
+    def _saved(self, branch):
+        if self.tree.version == self.version:
+            return None
+        return self.saved.get(branch)
+
+    def _savedExtData(self, ext_data):
+        if self.tree.version == self.version:
+            return None
+        return self.saved_ext_data.get(ext_data)
+
+    def children(self, branch):
+        """Return the child branches of branch.
+
+        Returns a copy of the live list for unchanged branches, it can
+        still change while the caller is iterating over it.
+        """
+        saved = self._saved(branch)
+        if saved is None:
+            return tuple(branch.branches)
+        return saved.branches
+
+    def extData(self, branch):
+        """Return the ext_data of branch."""
+        saved = self._saved(branch)
+        if saved is None:
+            return branch.ext_data
+        return saved.ext_data
+
+    def branch(self, ext_data):
+        """Return the branch of an ext_data object (ext_data.branch)."""
+        saved = self._savedExtData(ext_data)
+        if saved is None:
+            return ext_data.branch
+        return saved.branch
+
+    def parent(self, ext_data):
+        """Return the ext_data of the parent branch of ext_data.
+
+        None is returned for branches directly attached to the tree.
+        """
+        branch = self.branch(ext_data)
+        saved = self._saved(branch)
+        if saved is None:
+            parent = branch.parent
+        else:
+            parent = saved.parent
+        if parent is None or parent is self.tree:
+            return None
+        return self.extData(parent)
+
+    def associations(self, ext_data):
+        """Return the ext_data of branches associated to ext_data."""
+        branch = self.branch(ext_data)
+        saved = self._saved(branch)
+        if saved is None:
+            branches = branch.associations
+        else:
+            branches = saved.associations
+        return [self.extData(other) for other in branches]
+
+    def references(self, ext_data):
+        """Return the ext_data of branches referencing ext_data."""
+        branch = self.branch(ext_data)
+        saved = self._saved(branch)
+        if saved is None:
+            branches = branch.references
+        else:
+            branches = saved.references
+        return [self.extData(other) for other in branches]
+
+    def state(self, ext_data):
+        """Return the kept ext_data._snapshotState() or None."""
+        saved = self._savedExtData(ext_data)
+        if saved is None:
+            return None
+        return saved.state
+
+    def data(self, ext_data):
+        """Return the kept capture(ext_data) value or None."""
+        saved = self._savedExtData(ext_data)
+        if saved is None:
+            return None
+        return saved.data
+
+    def traverse(self, branch, include_self, max_depth, filter = None,
+            include_depth = False):
+        """Depth-first traversal of branch and its children.
+
+        Like Branch.traverse but for the tree as it was when the
+        snapshot was taken.
+        """
+        return traverse_tree_depth_first(branch, include_self, max_depth,
+                filter, include_depth, children = self.children)
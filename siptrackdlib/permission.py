@@ -13,22 +13,22 @@ class Permission(treenodes.BaseNode):
     class_id = 'PERM'
     class_name = 'permission'
     require_admin = True
+    read_access = storagevalue.BoolField('read_access')
+    write_access = storagevalue.BoolField('write_access')
+    users = storagevalue.NodeListField('users', '_validateUsers')
+    groups = storagevalue.NodeListField('groups', '_validateGroups')
+    all_users = storagevalue.BoolField('all_users')
+    recursive = storagevalue.BoolField('recursive')
 
     def __init__(self, oid, branch, read_access = None, write_access = None,
             users = None, groups = None, all_users = None, recursive = None):
         super(Permission, self).__init__(oid, branch)
-        self.read_access = storagevalue.StorageBool(self,
-                'read_access', read_access)
-        self.write_access = storagevalue.StorageBool(self,
-                'write_access', write_access)
-        self.users = storagevalue.StorageNodeList(self,
-                'users', users, self._validateUsers)
-        self.groups = storagevalue.StorageNodeList(self,
-                'groups', groups, self._validateGroups)
-        self.all_users = storagevalue.StorageBool(self,
-                'all_users', all_users)
-        self.recursive = storagevalue.StorageBool(self,
-                'recursive', recursive)
+        self.read_access.init(read_access)
+        self.write_access.init(write_access)
+        self.users.init(users)
+        self.groups.init(groups)
+        self.all_users.init(all_users)
+        self.recursive.init(recursive)
 
     def _created(self, user):
         super(Permission, self)._created(user)
@@ -38,9 +38,8 @@ class Permission(treenodes.BaseNode):
         self.groups.commit()
         self.all_users.commit()
         self.recursive.commit()
-        # Clear the global permission cache when a new permission
-        # is created.
-        self.perm_cache.clear()
+        # Drop the cached permissions of the nodes we apply to.
+        self.perm_cache.invalidate(self.parent.branch)
 
     def _loaded(self, data = None):
         super(Permission, self)._loaded(data)
@@ -70,26 +69,20 @@ class Permission(treenodes.BaseNode):
             return True
         if not user:
             return False
-        for u in self.users.get():
-            if user.oid == u.oid:
-                return True
-        for g in self.groups.get():
-            for u in g.users.get():
-                if user.oid == u.oid:
-                    return True
-        return False
+        return self.perm_cache.matchesUser(self, user)
 
     def _remove(self, *args, **kwargs):
         super(Permission, self)._remove(*args, **kwargs)
-        # Clear the global permission cache when a permission
-        # is removed.
-        self.perm_cache.clear()
+        self.perm_cache.forgetPermission(self)
+        # Drop the cached permissions of the nodes we applied to.
+        self.perm_cache.invalidateOwner(self, self.object_store.object_tree)
 
     def _relocate(self, *args, **kwargs):
+        # Drop the cached permissions of the nodes we applied to, and
+        # of those we apply to now.
+        self.perm_cache.invalidateOwner(self, self.object_store.object_tree)
         super(Permission, self)._relocate(*args, **kwargs)
-        # Clear the global permission cache when a permission
-        # is moved.
-        self.perm_cache.clear()
+        self.perm_cache.invalidate(self.parent.branch)
 
 # Add the objects in this module to the object registry.
 o = object_registry.registerClass(Permission)
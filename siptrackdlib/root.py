@@ -1,16 +1,56 @@
+import sys
 import time
+import uuid
+import heapq
+import itertools
+import resource
 from twisted.internet import defer
+from twisted.internet import reactor
+from twisted.internet import task
+from twisted.internet import threads
 
 from siptrackdlib import objecttree
 from siptrackdlib import treenodes
+from siptrackdlib import census
 from siptrackdlib import view
 from siptrackdlib import password
 from siptrackdlib import errors
 from siptrackdlib import search
 from siptrackdlib import log
+from siptrackdlib import snapshot
+from siptrackdlib import interning
+from siptrackdlib import storagevalue
 from siptrackdlib.objectregistry import object_registry
+from siptrackdlib.storage import streaming
 
-STORE_VERSION = '2'
+STORE_VERSION = '4'
+
+# Attribute node classes, their values are indexed by the searcher as
+# part of their parent node.
+search_attr_classes = ['attribute', 'versioned attribute', 'encrypted attribute']
+
+# Number of node data rows read per storage query when writing a
+# snapshot.
+SNAPSHOT_PAGE_SIZE = 10000
+
+# Number of change journal entries kept below the latest entry, see
+# ObjectStore.trimJournal.
+DEFAULT_JOURNAL_RETENTION = 100000
+
+# Number of commits between journal trims, see ObjectStore.trimJournal.
+JOURNAL_TRIM_COMMITS = 1000
+
+# Max number of nodes read per node cache miss, the missed node plus
+# its unloaded siblings and children, see NodeCache.loaded.
+NODE_CACHE_PREFETCH = 100
+
+# Number of branches handled per step of a background reload, see
+# ObjectStore._backgroundReload.
+RELOAD_STEP_SIZE = 1000
+
+# Seconds the old tree is kept after a background reload before it is
+# freed, see ObjectStore._retireTree.
+RELOAD_GRACE_PERIOD = 300
 
 tree_callbacks = {
         'load_data': treenodes.load_data_callback,
@@ -18,11 +58,502 @@ tree_callbacks = {
         'relocate': treenodes.relocate_callback
 }
 
+class CommitStats(object):
+    """Size and latency counters for storage commits."""
+    def __init__(self):
+        self.commits = 0
+        self.actions = 0
+        self.time = 0.0
+        self.last_actions = 0
+        self.last_time = 0.0
+        self.max_actions = 0
+        self.max_time = 0.0
+        self.elided = 0
+        self.last_elided = 0
+
+    def update(self, actions, elapsed, elided = 0):
+        self.commits += 1
+        self.actions += actions
+        self.elided += elided
+        self.last_elided = elided
+        self.time += elapsed
+        self.last_actions = actions
+        self.last_time = elapsed
+        self.max_actions = max(self.max_actions, actions)
+        self.max_time = max(self.max_time, elapsed)
+
+    def asDict(self):
+        avg_time = 0.0
+        if self.commits:
+            avg_time = self.time / self.commits
+        return {
+            'commits': self.commits,
+            'actions': self.actions,
+            'time': self.time,
+            'avg_time': avg_time,
+            'last_actions': self.last_actions,
+            'last_time': self.last_time,
+            'max_actions': self.max_actions,
+            'max_time': self.max_time,
+            'elided': self.elided,
+            'last_elided': self.last_elided,
+        }
+
+class NodeCache(object):
+    """Bounded cache of nodes loaded on access.
+
+    Without preload nodes are loaded the first time their branch is
+    accessed (see treenodes.load_data_callback) and then stay loaded for
+    good. With a node cache they are loaded with their data read from
+    storage, and once more than size nodes have been loaded that way the
+    least recently used ones are evicted, down to 90% of size. Evicted
+    nodes are loaded again on their next access, their branches stay in
+    the tree.
+
+    Only nodes that can be dropped without losing anything are evicted:
+    no pending storage or searcher actions and nothing but their branch
+    referring to them (a node still in use elsewhere would otherwise end
+    up loaded twice). Nodes with pending actions are kept and tried
+    again later. Nodes referred to from elsewhere are held: they are
+    taken out of the LRU, so evict doesn't scan them over and over, and
+    put back on their next access. Long lived references to nodes are
+    avoided for that reason (attribute name indexes refer to branches,
+    see BaseNode.getAttribute). The permission nodes referred to by the
+    permission cache (treenodes.PermissionSet) are held for as long as
+    they are cached, there are few of them compared to other nodes.
+
+    Nodes are loaded from within the tree access that needs them, on the
+    reactor thread, where there is no deferred to wait for. The data is
+    read synchronously (storage.readOIDDataBlocking, on a connection of
+    the reactor thread's own next to the storage pool's), which stalls
+    the reactor for a round trip. That is the price of a bounded memory
+    footprint, to keep the number of round trips down a miss also reads
+    the data of the unloaded siblings and children of the missed node,
+    up to NODE_CACHE_PREFETCH nodes, listings and traversals then only
+    take a round trip every so many nodes. Prefetched data is kept until
+    the node is loaded, dropped if the node is changed by another object
+    store (see discard) and never kept if commits are in flight, data
+    read then could predate them.
+    """
+    def __init__(self, object_store, size):
+        self.object_store = object_store
+        self.size = size
+        self.low_water = max(size - size / 10, 1)
+        # branch -> access counter value of the last access.
+        self.last_access = {}
+        # Branches of loaded nodes that are referred to from elsewhere.
+        self.held = set()
+        # oid -> node data read ahead for a node that isn't loaded yet.
+        self.prefetched = {}
+        self.clock = 0
+        self.hits = 0
+        self.misses = 0
+        self.prefetch_hits = 0
+        self.evictions = 0
+        self.pinned = 0
+
+    def loaded(self, branch):
+        """Called when the node of branch is loaded.
+
+        Returns the node data to load it with.
+        """
+        data = self.prefetched.pop(branch.oid, None)
+        if data is None:
+            self.misses += 1
+            data = self._read(branch)
+        else:
+            self.prefetch_hits += 1
+        self.clock += 1
+        self.last_access[branch] = self.clock
+        if len(self.last_access) > self.size:
+            self.evict()
+        return data
+
+    def _read(self, branch):
+        """Read the data of branch and prefetch that of its neighbours."""
+        oids = [branch.oid]
+        if not self.object_store.commits_in_flight and \
+                len(self.prefetched) < self.size:
+            for other in itertools.chain(branch.parent.branches, branch.branches):
+                if len(oids) >= NODE_CACHE_PREFETCH:
+                    break
+                if other is not branch and not other.hasExtData() and \
+                        other.oid not in self.prefetched:
+                    oids.append(other.oid)
+        data_mapping = self.object_store.storage.readOIDDataBlocking(oids)
+        data = data_mapping.pop(branch.oid)
+        self.prefetched.update(data_mapping)
+        return data
+
+    def discard(self, oids):
+        """Drop prefetched data of oids, they have changed in storage."""
+        for oid in oids:
+            self.prefetched.pop(oid, None)
+
+    def accessed(self, branch):
+        """Tree access callback, called when a loaded node is accessed."""
+        if branch not in self.last_access:
+            if branch not in self.held:
+                return
+            # Back into the LRU, see evict.
+            self.held.discard(branch)
+        self.hits += 1
+        self.clock += 1
+        self.last_access[branch] = self.clock
+
+    def evict(self):
+        """Evict least recently used nodes down to the low water mark."""
+        count = len(self.last_access) - self.low_water
+        for branch in heapq.nsmallest(count, self.last_access,
+                key = self.last_access.get):
+            node = branch._ext_data
+            if node is not None:
+                if node.removed or node._storage_actions or \
+                        node._searcher_actions:
+                    self.pinned += 1
+                    self.clock += 1
+                    self.last_access[branch] = self.clock
+                    continue
+                # References held by the branch, node and getrefcount,
+                # plus those from the nodes own StorageValues.
+                if sys.getrefcount(node) > 3 + self._selfReferences(node):
+                    self.pinned += 1
+                    self.held.add(branch)
+                    del self.last_access[branch]
+                    continue
+                branch.unload()
+                self.evictions += 1
+            del self.last_access[branch]
+
+    def _selfReferences(self, node):
+        """Return the number of references a node holds to itself."""
+        refs = 0
+        for value in getattr(node, '__dict__', {}).itervalues():
+            if isinstance(value, storagevalue.StorageValue) and value.node is node:
+                refs += 1
+                if getattr(value._validator_cb, 'im_self', None) is node:
+                    refs += 1
+        return refs
+
+    def clear(self):
+        self.last_access = {}
+        self.held = set()
+        self.prefetched = {}
+
+    def asDict(self):
+        return {
+            'size': self.size,
+            'loaded': len(self.last_access),
+            'held': len(self.held),
+            'hits': self.hits,
+            'misses': self.misses,
+            'prefetched': len(self.prefetched),
+            'prefetch_hits': self.prefetch_hits,
+            'evictions': self.evictions,
+            'pinned': self.pinned,
+        }
+
+class OIDAllocator(object):
+    """Allocates oids for an object store.
+
+    Oids are handed out from blocks reserved in storage (see
+    storage.reserveOIDs), so several object stores (or processes)
+    sharing a storage never hand out the same oid, and allocating an oid
+    doesn't need to touch storage. A spare block is reserved in the
+    background as soon as the previous one is taken into use.
+
+    Oids are never handed out past the reservation and storage is never
+    written to from allocate (it runs on the reactor thread). If both
+    blocks run out before the background reservation is done (a large
+    batch of creates in a single reactor turn), OIDsExhausted is raised,
+    the request can be retried once the reservation is done. The block
+    size is doubled every time that happens, up to max_block_size, so
+    the spare block fits the next batch.
+    """
+    def __init__(self, storage, block_size = 1000, max_block_size = 64000):
+        self.storage = storage
+        self.block_size = block_size
+        self.max_block_size = max(block_size, max_block_size)
+        self.next_oid = 0
+        self.limit = 0
+        self.next_block = None
+        # Deferred of the reservation in progress, if any.
+        self.reserving = None
+
+    @defer.inlineCallbacks
+    def init(self):
+        """Reserve the first block of oids and start reserving a spare."""
+        self.next_oid = yield self.storage.reserveOIDs(self.block_size)
+        self.limit = self.next_oid + self.block_size
+        self.next_block = None
+        self._reserve()
+
+    def allocate(self):
+        """Allocate a new oid."""
+        if self.next_oid >= self.limit:
+            if not self.next_block:
+                self._exhausted()
+            self.next_oid, self.limit = self.next_block
+            self.next_block = None
+        oid = self.next_oid
+        self.next_oid += 1
+        if not self.next_block and not self.reserving:
+            self._reserve()
+        return str(oid)
+
+    def revert(self):
+        """Revert the last oid allocation."""
+        self.next_oid -= 1
+
+    def _exhausted(self):
+        if self.block_size < self.max_block_size:
+            self.block_size = min(self.block_size * 2, self.max_block_size)
+        if not self.reserving:
+            self._reserve()
+        log.msg('OIDAllocator: oid blocks exhausted, block size now %d' % (
+            self.block_size))
+        raise errors.OIDsExhausted()
+
+    def _reserve(self):
+        d = self.storage.reserveOIDs(self.block_size)
+        self.reserving = d
+        d.addCallbacks(self._cbReserve, self._ebReserve,
+                callbackArgs = (self.block_size,))
+        return d
+
+    def _cbReserve(self, start, size):
+        self.reserving = None
+        # The block size might have grown while reserving.
+        limit = start + size
+        if self.next_oid >= self.limit:
+            self.next_oid, self.limit = start, limit
+        else:
+            self.next_block = (start, limit)
+
+    def _ebReserve(self, failure):
+        self.reserving = None
+        log.msg('OIDAllocator: reserving oids failed: %s' % (failure.getErrorMessage()))
+
+def compact_actions(actions):
+    """Compact the list of storage actions queued for a node.
+
+    Returns a (actions, elided) tuple with the actions that need to
+    be committed and the number of actions that were dropped:
+      * If the node was both created and removed, nothing about it
+        needs to reach storage.
+      * Only the last write_data for each name is kept.
+      * Only the last relocate is kept, the current parent is used
+        when it's committed anyway.
+      * An associate and a disassociate of the same node cancel out.
+    affecting_node actions are always kept.
+    """
+    names = set([action['action'] for action in actions])
+    if 'create_node' in names and 'remove_node' in names:
+        ret = [action for action in actions \
+                if action['action'] == 'affecting_node']
+        return ret, len(actions) - len(ret)
+    keep = [True] * len(actions)
+    seen_writes = set()
+    seen_relocate = False
+    for pos in range(len(actions) - 1, -1, -1):
+        action = actions[pos]
+        if action['action'] == 'write_data':
+            name = action['args']['name']
+            if name in seen_writes:
+                keep[pos] = False
+            seen_writes.add(name)
+        elif action['action'] == 'relocate':
+            if seen_relocate:
+                keep[pos] = False
+            seen_relocate = True
+    pending_assoc = {}
+    for pos, action in enumerate(actions):
+        if action['action'] in ['associate', 'disassociate']:
+            other = action['args']['other']
+            prev = pending_assoc.pop(other, None)
+            if prev is not None and \
+                    actions[prev]['action'] != action['action']:
+                keep[prev] = False
+                keep[pos] = False
+            else:
+                pending_assoc[other] = pos
+    ret = [action for pos, action in enumerate(actions) if keep[pos]]
+    return ret, len(actions) - len(ret)
+
+class StorageBatch(object):
+    """Storage actions from a commit, grouped by kind.
+
+    Instead of running one statement per storage action, actions are
+    collected here and written using one batched statement per kind.
+    Batches are written in a fixed order: new oids, relocations, node
+    data, disassociations, associations and finally removals.
+    Every oid touched by the batch also gets a change journal entry,
+    tagged with the origin of the writing object store.
+    This gives the same end result as running the actions one by one,
+    with the following adjustments:
+      * Only the last write for each (oid, name) is written.
+      * Relocations use the current parent, so one per oid is enough.
+      * An association pair that was disassociated at some point is
+        deleted before (possibly) being inserted again, so
+        disassociate + associate still works.
+    """
+    def __init__(self, origin):
+        self.origin = origin
+        self.changed_oids = set()
+        self.add_oids = []
+        self.relocate_oids = {}
+        self.write_data = {}
+        self.disassociations = {}
+        self.associations = {}
+        self.remove_oids = []
+        self.actions = 0
+
+    def add(self, node, action, args):
+        self.actions += 1
+        self.changed_oids.add(node.oid)
+        if action == 'create_node':
+            parent_oid = 'ROOT'
+            parent = node.parent
+            if parent:
+                parent_oid = parent.oid
+            self.add_oids.append((parent_oid, node.oid, node.class_id))
+        elif action == 'remove_node':
+            self.relocate_oids.pop(node.oid, None)
+            self.remove_oids.append(node.oid)
+        elif action == 'relocate':
+            if node.branch:
+                self.relocate_oids[node.oid] = node.branch.parent.oid
+        elif action == 'associate':
+            self.changed_oids.add(args['other'])
+            self.associations[(node.oid, args['other'])] = True
+        elif action == 'disassociate':
+            self.changed_oids.add(args['other'])
+            pair = (node.oid, args['other'])
+            self.associations.pop(pair, None)
+            self.disassociations[pair] = True
+        elif action == 'write_data':
+            self.write_data[(node.oid, args['name'])] = args['value']
+
+    def write(self, storage, txn):
+        if self.add_oids:
+            storage.addOIDs(self.add_oids, txn)
+        if self.relocate_oids:
+            storage.relocateOIDs(self.relocate_oids.items(), txn)
+        if self.write_data:
+            rows = [(oid, name, value) for (oid, name), value in \
+                    self.write_data.iteritems()]
+            storage.writeDataMany(rows, txn)
+        if self.disassociations:
+            storage.disassociateMany(self.disassociations.keys(), txn)
+        if self.associations:
+            storage.associateMany(self.associations.keys(), txn)
+        if self.remove_oids:
+            storage.removeOIDs(self.remove_oids, txn)
+        if self.changed_oids:
+            storage.journalOIDs(list(self.changed_oids), self.origin, txn)
+
+class _StreamingPreLoader(object):
+    """Match node data streamed in oid order with the object tree.
+
+    Used by ObjectStore._streamPreLoad.
+    """
+    def __init__(self, object_store):
+        self.object_store = object_store
+        self.branches = sorted(object_store.object_tree.traverse(),
+                key = lambda branch: branch.oid)
+        self.pos = 0
+
+    def _skipTo(self, oid):
+        """Load all branches sorted before oid, they have no data."""
+        branches = self.branches
+        while self.pos < len(branches) and branches[self.pos].oid < oid:
+            self.object_store._preLoadBranch(branches[self.pos], {})
+            self.pos += 1
+
+    def load(self, batch):
+        branches = self.branches
+        for oid, data in batch:
+            self._skipTo(oid)
+            if self.pos < len(branches) and branches[self.pos].oid == oid:
+                self.object_store._preLoadBranch(branches[self.pos], data)
+                self.pos += 1
+            else:
+                # Either data for an oid that isn't in the tree, or
+                # storage sorts oids differently from us, in which case
+                # the node has already been passed an empty dict and
+                # will just be loaded twice.
+                branch = self.object_store.object_tree.getBranch(oid)
+                if branch and branch.hasExtData():
+                    self.object_store._preLoadBranch(branch, data)
+
+    def finish(self):
+        while self.pos < len(self.branches):
+            self.object_store._preLoadBranch(self.branches[self.pos], {})
+            self.pos += 1
+        self.branches = None
+
+class _LoadState(object):
+    """The parts of an object store that are replaced by a full reload.
+
+    Used by ObjectStore._backgroundReload to hold the tree being built,
+    see ObjectStore._swapState.
+    """
+    names = ('object_tree', 'view_tree', 'oid_class_mapping', 'journal_seq')
+
+    def __init__(self, object_tree):
+        self.object_tree = object_tree
+        self.view_tree = None
+        self.oid_class_mapping = {}
+        self.journal_seq = 0
+
+def _max_rss():
+    """Return the memory high-water mark of the process in MB.
+
+    A float, the stats are passed over XML-RPC which can't carry ints
+    above 2**31 - 1.
+    """
+    # ru_maxrss is in kilobytes on linux.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
 class ObjectStore(object):
-    def __init__(self, storage, preload = True, searcher = None):
+    def __init__(self, storage, preload = True, searcher = None,
+            stream_preload = False, snapshot_path = None, readonly = False,
+            node_cache_size = None,
+            journal_retention = DEFAULT_JOURNAL_RETENTION):
         self.preload = preload
+        self.readonly = readonly
+        # Oids of nodes that had writes rejected in readonly mode, they
+        # are resynced from storage by the next applyJournal.
+        self.resync_oids = set()
+        self.stream_preload = stream_preload
+        self.snapshot_path = snapshot_path
+        # Journal entries kept below the latest entry, 0 to keep none,
+        # None to never trim the journal.
+        self.journal_retention = journal_retention
+        self.commits_since_trim = 0
+        self.journal_trimming = False
         self.storage = storage
         self.searcher = searcher
+        self.commit_stats = CommitStats()
+        self.oid_allocator = OIDAllocator(storage)
+        # Limits the number of nodes loaded on access, see NodeCache.
+        self.node_cache = None
+        if node_cache_size:
+            self.node_cache = NodeCache(self, node_cache_size)
+        self.load_stats = {}
+        # Identifies changes made by this object store in the storage
+        # change journal.
+        self.origin = uuid.uuid4().hex
+        self.journal_seq = 0
+        # Storage deferreds of commits that haven't finished yet, see
+        # _backgroundReload.
+        self.commits_in_flight = set()
+        # Trees replaced by a background reload that haven't been freed
+        # yet -> deferred that fires once freed, see _retireTree.
+        self.old_trees = {}
+        self.journal_lock = defer.DeferredLock()
+        self.snapshot_writing = False
+        self.reloading = False
 #        if not searcher:
 #            self.searcher = search.MemorySearch()
 
@@ -30,15 +561,13 @@ class ObjectStore(object):
     def init(self):
         yield self._checkStorage()
         self.call_loaded = True
-        self.oid_class_mapping = yield self._loadOIDClassMapping()
-        self.object_tree = objecttree.Tree(tree_callbacks, self)
+        self._newObjectTree()
         self.object_registry = object_registry
+        if not self.readonly:
+            yield self.oid_allocator.init()
         exists = yield self.storage.OIDExists('0')
         if not exists:
-            # FIXME: with a global object registry things break down if
-            # someone tries to create multiple object stores. -- The oid
-            # allocator specifically. This should be fixed.
-            object_registry.next_oid = 0
+            self.oid_class_mapping = {}
             self.view_tree = object_registry.createObject(
                     view.ViewTree.class_id, self.object_tree)
             # This is usally done from <treenode>._created callback, but that
@@ -48,16 +577,9 @@ class ObjectStore(object):
 #            self.storage.addOID('ROOT', self.view_tree.oid,
 #                    view.ViewTree.class_id)
             self.oid_class_mapping[self.view_tree.oid] = view.ViewTree.class_id
+            self.journal_seq = yield self.storage.getJournalSeq()
         else:
-            print 'Populating object tree'
-            yield self._populateObjectTree()
-            print 'Object tree populated'
-            self.view_tree = self.getOID('0')
-        object_registry.next_oid = yield self._getNextOID()
-        if self.preload:
-            print 'Preloading objects'
-            yield self.preLoad()
-            print 'Objects preloaded'
+            yield self._loadStorage()
         self.event_triggers_enabled = True
         self.event_triggers = list(self.view_tree.listChildren(include = ['event trigger']))
         yield self.view_tree._initUserManager()
@@ -65,21 +587,383 @@ class ObjectStore(object):
             self.searcher._buildIndex(self)
 
     @defer.inlineCallbacks
-    def reload(self):
+    def reload(self, full = False):
         """Reload an object store.
 
-        Reload the object store from the backend, dropping all cached
-        nodes.
+        By default only the changes listed in the storage change journal
+        since the object store was loaded (or last reloaded) are applied,
+        see applyJournal. Existing nodes are kept and updated in place.
+
+        If full is set, or the incremental reload fails, the object
+        store is reloaded from the backend, dropping all cached nodes.
+        The new tree is built in the background while the current one
+        stays in use, see _backgroundReload.
+
+        Returns True if a full reload was done.
         """
-        self.object_tree.free()
-        self.oid_class_mapping = yield self._loadOIDClassMapping()
-        self.object_tree = objecttree.Tree(tree_callbacks, self)
-        yield self._populateObjectTree()
-        self.view_tree = self.getOID('0')
-        if self.preload:
-            yield self.preLoad()
-        yield self.view_tree._initUserManager()
+        if not full:
+            try:
+                yield self.applyJournal()
+            except Exception, e:
+                log.msg('ObjectStore: incremental reload failed, doing a full reload: %s' % (e))
+                full = True
+        if full:
+            if self.reloading:
+                log.msg('ObjectStore: full reload already running, skipping')
+            else:
+                self.reloading = True
+                try:
+                    yield self._backgroundReload()
+                finally:
+                    self.reloading = False
+        defer.returnValue(full)
+
+    def _swapState(self, state):
+        """Swap the tree (and related state) with the one in state.
+
+        Swapping twice restores the original state.
+        """
+        for name in _LoadState.names:
+            current = getattr(self, name)
+            setattr(self, name, getattr(state, name))
+            setattr(state, name, current)
+
+    @defer.inlineCallbacks
+    def _backgroundReload(self):
+        """Do a full reload without taking the object store offline.
+
+        A new tree is built and preloaded from storage next to the live
+        one, in steps in between which the reactor is free to serve
+        requests from the live tree. The new tree then catches up with
+        the journal, including changes committed through this object
+        store while it was loading, and is swapped in, there is no
+        return to the reactor between the last journal check and the
+        swap. Commits still in flight at the swap are waited for before
+        the journal is read a last time, their changes were made to the
+        old tree. The old tree is retired once we have returned, so callers
+        get a chance to move references to old nodes (sessions) over to
+        the new tree first, see _retireTree.
+
+        Nodes use the object store (getOID etc.) while they are being
+        loaded, so the new tree is swapped into the object store for
+        each load step and out again before returning to the reactor.
+        """
+        start = time.time()
+        start_rss = _max_rss()
+        build = _LoadState(objecttree.Tree(tree_callbacks, self))
+        build.journal_seq = yield self.storage.getJournalSeq()
+        idmap, associations, data_mapping = yield self._fetchRows(start,
+                with_data = False)
+        replayed = 0
+        try:
+            yield task.cooperate(self._iterBuild(build, idmap,
+                associations)).whenDone()
+            idmap = associations = None
+            if self.preload:
+                yield self._backgroundPreLoad(build)
+            while True:
+                last_seq, changed, rows = yield self._readJournalChanges(
+                        build.journal_seq, include_own = True)
+                if not changed:
+                    build.journal_seq = last_seq
+                    break
+                self._swapState(build)
+                try:
+                    self._applyChanges(changed, *rows)
+                finally:
+                    self._swapState(build)
+                build.journal_seq = last_seq
+                replayed += len(changed)
+        except:
+            build.object_tree.free()
+            raise
+        self._swapState(build)
+        # Commits started before the swap hold changes made to the old
+        # tree, they have to be replayed once they reach storage.
+        in_flight = list(self.commits_in_flight)
+        old_tree = build.object_tree
+        build = None
+        if self.node_cache:
+            self.node_cache.clear()
+            self.object_tree.access_callback = self.node_cache.accessed
+        self.event_triggers = list(self.view_tree.listChildren(include = ['event trigger']))
         treenodes.perm_cache.clear()
+        if self.searcher:
+            self.searcher.reloaded(self)
+        elapsed = time.time() - start
+        log.msg('ObjectStore: reloaded tree swapped in after %.2fs' % (elapsed))
+        yield self.view_tree._initUserManager()
+        # Commits that were in flight during the swap.
+        if in_flight:
+            yield defer.DeferredList(in_flight, consumeErrors = True)
+        yield self.applyJournal(include_own = True)
+        # Both trees are loaded at this point, so this is the high-water
+        # mark of the reload.
+        max_rss = _max_rss()
+        self.load_stats = {'source': 'storage', 'time': elapsed,
+                'seq': self.journal_seq, 'replayed_oids': replayed,
+                'max_rss_mb': max_rss}
+        log.msg('ObjectStore: full reload done in %.2fs, memory high-water mark %.1f MB (%.1f MB before)' % (
+            time.time() - start, max_rss, start_rss))
+        self._retireTree(old_tree)
+
+    def _retireTree(self, old_tree):
+        """Free a tree replaced by a background reload after a grace period.
+
+        Requests that fetched nodes before the swap can still be using
+        (and committing) them. Their commits are journaled as changes of
+        this object store, so while there are old trees own journal
+        entries are applied as well (see applyJournal) and commits of old
+        nodes apply the journal once done (see commit). After
+        RELOAD_GRACE_PERIOD seconds the journal is applied a last time
+        and the old tree is freed in steps, changes made to it after that
+        are lost.
+
+        Returns a deferred that fires once the tree is freed.
+        """
+        @defer.inlineCallbacks
+        def free():
+            try:
+                if self.commits_in_flight:
+                    yield defer.DeferredList(list(self.commits_in_flight),
+                            consumeErrors = True)
+                yield self.applyJournal(include_own = True)
+            except Exception, e:
+                log.msg('ObjectStore: applying the journal before freeing the old tree failed: %s' % (e))
+            del self.old_trees[old_tree]
+            start = time.time()
+            yield task.cooperate(old_tree.iterFree(RELOAD_STEP_SIZE)).whenDone()
+            log.msg('ObjectStore: old tree freed in %.2fs' % (time.time() - start))
+        d = task.deferLater(reactor, RELOAD_GRACE_PERIOD, free)
+        d.addErrback(lambda failure: log.msg('ObjectStore: freeing the old tree failed: %s' % (
+            failure.getErrorMessage())))
+        self.old_trees[old_tree] = d
+        return d
+
+    def _iterBuild(self, build, idmap, associations):
+        """Populate the tree of a load state in steps.
+
+        Generator for task.cooperate, see _backgroundReload.
+        """
+        intern_id = interning.intern_id
+        mapping = build.oid_class_mapping
+        for n, row in enumerate(idmap):
+            mapping[intern_id(row[1])] = intern_id(row[2])
+            if n % RELOAD_STEP_SIZE == RELOAD_STEP_SIZE - 1:
+                yield None
+        for _ in build.object_tree.iterLoadBranches(idmap, RELOAD_STEP_SIZE):
+            yield None
+        build.object_tree.loadAssociations(associations)
+        self._swapState(build)
+        try:
+            self.view_tree = self.getOID('0')
+        finally:
+            self._swapState(build)
+
+    @defer.inlineCallbacks
+    def _backgroundPreLoad(self, build):
+        """Preload the nodes of a load state, see _backgroundReload.
+
+        Node data is streamed from storage, each streamed batch is
+        loaded in a single step.
+        """
+        def run(method, *args):
+            self._swapState(build)
+            self.call_loaded = False
+            try:
+                return method(*args)
+            finally:
+                self.call_loaded = True
+                self._swapState(build)
+        preloader = run(_StreamingPreLoader, self)
+        yield self.storage.streamOIDData(lambda batch: run(preloader.load, batch))
+        run(preloader.finish)
+
+    def _newObjectTree(self):
+        self.object_tree = objecttree.Tree(tree_callbacks, self)
+        if self.node_cache:
+            self.node_cache.clear()
+            self.object_tree.access_callback = self.node_cache.accessed
+
+    def applyJournal(self, include_own = False):
+        """Apply changes made by other object stores to the object tree.
+
+        Reads the storage change journal entries written since the last
+        applied sequence number. Entries written by this object store
+        are skipped unless include_own is set or there are old trees left
+        by a background reload (see _retireTree), otherwise those changes
+        are already in the tree. Nodes that had writes rejected in
+        readonly mode are resynced as well. The other changed oids have
+        their current idmap, association and node data rows fetched and
+        are reconciled with the tree, see _applyChanges. Raises
+        JournalTrimmed if the entries needed have been trimmed, a full
+        reload is needed then. Only one call runs at a time, rows read
+        by one call would otherwise be applied over newer ones.
+
+        Returns the number of oids that were updated.
+        """
+        return self.journal_lock.run(self._applyJournal,
+                include_own or bool(self.old_trees))
+
+    @defer.inlineCallbacks
+    def _applyJournal(self, include_own):
+        start = time.time()
+        seq = self.journal_seq
+        resync = self.resync_oids
+        self.resync_oids = set()
+        last_seq, changed, rows = yield self._readJournalChanges(seq,
+                include_own, resync)
+        if last_seq == seq and not changed:
+            defer.returnValue(0)
+        if changed:
+            if self.node_cache:
+                self.node_cache.discard(changed)
+            applied = self._applyChanges(changed, *rows)
+            if self.view_tree.oid in applied:
+                yield self.view_tree._initUserManager()
+            self.event_triggers = list(self.view_tree.listChildren(include = ['event trigger']))
+            treenodes.perm_cache.clear()
+        self.journal_seq = last_seq
+        log.msg('ObjectStore: applied journal up to %s, %d changed oids in %.2fs' % (
+            last_seq, len(changed), time.time() - start))
+        defer.returnValue(len(changed))
+
+    @defer.inlineCallbacks
+    def _readJournalChanges(self, seq, include_own = False, changed = ()):
+        """Read the changes listed in the change journal after seq.
+
+        Returns (last_seq, changed, rows), changed is the list of
+        changed oids (starting with those passed in) and rows the
+        (idmap, associations, data_mapping) arguments for _applyChanges,
+        None if nothing changed. Raises JournalTrimmed if entries after
+        seq have been trimmed, only a full reload can catch up then.
+        """
+        journal = yield self.storage.listJournal(seq)
+        # Checked after listing, the journal might be trimmed meanwhile.
+        trim_seq = yield self.storage.getJournalTrimSeq()
+        if seq < trim_seq:
+            raise errors.JournalTrimmed('journal trimmed up to %s, past %s' % (
+                trim_seq, seq))
+        last_seq = seq
+        if journal:
+            last_seq = journal[-1][0]
+        changed = list(changed)
+        seen = set(changed)
+        for entry_seq, oid, origin in journal:
+            if (include_own or origin != self.origin) and oid not in seen:
+                seen.add(oid)
+                changed.append(oid)
+        journal = seen = None
+        rows = None
+        if changed:
+            idmap = yield self.storage.getOIDMapRows(changed)
+            associations = yield self.storage.getAssociationRows(changed)
+            data_mapping = yield self.storage.getOIDData(changed)
+            rows = (idmap, associations, data_mapping)
+        defer.returnValue((last_seq, changed, rows))
+
+    def _applyChanges(self, oids, idmap, associations, data_mapping):
+        """Reconcile the object tree with the storage rows of oids.
+
+        idmap, associations and data_mapping hold the current storage
+        rows for the oids. Branches are created, moved and detached
+        without any callbacks (nothing is written back to storage),
+        associations are brought in line with storage and the nodes are
+        passed their current data through _loaded.
+        Nodes with uncommitted storage actions are left alone, their
+        pending changes will overwrite whatever is in storage anyway.
+
+        Returns the set of oids that were applied.
+        """
+        tree = self.object_tree
+        apply = []
+        for oid in oids:
+            branch = tree.getBranch(oid)
+            if branch and branch.hasExtData() and branch.ext_data._storage_actions:
+                log.msg('ObjectStore: skipping journal changes for %s, it has pending changes' % (oid))
+                continue
+            apply.append(oid)
+        applied = set(apply)
+        rows = {}
+        for row in idmap:
+            if row[1] in applied:
+                rows[row[1]] = row
+        # Create new branches first so relocations to new parents work.
+        new_rows = [rows[oid] for oid in apply \
+                if oid in rows and not tree.branchExists(oid)]
+        tree.loadBranches(new_rows)
+        for parent_oid, oid, class_id in rows.itervalues():
+            self.oid_class_mapping[interning.intern_id(oid)] = \
+                    interning.intern_id(class_id)
+        for oid in apply:
+            branch = tree.getBranch(oid)
+            if not branch or oid not in rows:
+                continue
+            parent_oid = rows[oid][0]
+            if parent_oid == 'ROOT':
+                parent = tree
+            else:
+                parent = tree.getBranch(parent_oid)
+            if parent and parent is not branch.parent:
+                branch.move(parent)
+        removed = []
+        for oid in apply:
+            branch = tree.getBranch(oid)
+            if not branch or oid in rows:
+                continue
+            self.oid_class_mapping.pop(oid, None)
+            # Nodes that were never loaded aren't referenced or indexed
+            # anywhere.
+            if not branch.hasExtData():
+                branch.detach()
+                continue
+            node = branch.ext_data
+            node.searcherAction('remove_node')
+            if node.class_name in search_attr_classes:
+                node.searcherAction('remove_attr', {'parent': node.parent})
+            branch.detach()
+            node.branch = None
+            node.removed = True
+            removed.append(node)
+        wanted = {}
+        for self_oid, other_oid in associations:
+            if self_oid in applied:
+                wanted.setdefault(self_oid, set()).add(other_oid)
+        for oid in apply:
+            branch = tree.getBranch(oid)
+            if not branch:
+                continue
+            targets = wanted.get(oid, set())
+            for other in list(branch.associations):
+                if other.oid in targets:
+                    targets.discard(other.oid)
+                else:
+                    branch.disassociate(other)
+            for other_oid in targets:
+                other = tree.getBranch(other_oid)
+                if other:
+                    branch.associate(other)
+        updated = []
+        self.call_loaded = False
+        try:
+            for oid in apply:
+                branch = tree.getBranch(oid)
+                if not branch:
+                    continue
+                if tree.snapshots:
+                    tree.preserve(branch)
+                self._preLoadBranch(branch, data_mapping.get(oid, {}))
+                node = branch.ext_data
+                node.setModified()
+                node.searcherAction('create_node')
+                if node.class_name in search_attr_classes:
+                    node.searcherAction('set_attr', {'parent': node.parent})
+                updated.append(node)
+        finally:
+            self.call_loaded = True
+        if self.searcher:
+            self.searcher.commit(updated + removed)
+        return applied
 
     @defer.inlineCallbacks
     def _checkStorage(self):
@@ -92,7 +976,7 @@ class ObjectStore(object):
         defer.returnValue(True)
 
     @defer.inlineCallbacks
-    def preLoad(self):
+    def preLoad(self, data_mapping = None):
         """Preload node data.
 
         The following happens:
@@ -109,79 +993,354 @@ class ObjectStore(object):
         The layout of the data passed to the node is a dict of one or
         more of:
         data['storage_data_name] = (data_type, data)
+
+        If stream_preload is set node data is instead streamed from
+        storage in oid order and handed to the nodes as it arrives, see
+        _streamPreLoad.
+
+        data_mapping can be passed in if node data has already been
+        fetched using storage.makeOIDData.
         """
-        print 'Loading OID data'
-        data_mapping = yield self.storage.makeOIDData()
-        print 'OID data loaded'
+        if data_mapping is None and self.stream_preload:
+            yield self._streamPreLoad()
+            defer.returnValue(True)
+        if data_mapping is None:
+            print 'Loading OID data'
+            data_mapping = yield self.storage.makeOIDData()
+            print 'OID data loaded'
         self.call_loaded = False
         try:
             for branch in self.object_tree.traverse():
 #                if branch.hasExtData():
 #                    continue
-                node = branch.ext_data
-                if not node:
-                    log.msg('ObjectStore.preLoad branch %s returned no ext_data node, skipping' % (branch))
-                    continue
                 data = {}
                 if branch.oid in data_mapping:
                     data = data_mapping[branch.oid]
-                # Calling _loaded must be done with call_loaded enabled.
-                # This is due to the possibility that a nodes _loaded
-                # will use getOID to fetch another node which might not
-                # have been loaded yet. If that happens with call_loaded =
-                # False the node will be loaded without ever having
-                # _loaded called, which might be very bad.
-                self.call_loaded = True
-                node._loaded(data)
-                self.call_loaded = False
+                self._preLoadBranch(branch, data)
         finally:
             self.call_loaded = True
         defer.returnValue(True)
 
+    def _preLoadBranch(self, branch, data):
+        """Load a branches node and pass it its preloaded data.
+
+        Must be called with call_loaded disabled.
+        """
+        node = branch.ext_data
+        if not node:
+            log.msg('ObjectStore.preLoad branch %s returned no ext_data node, skipping' % (branch))
+            return
+        # Calling _loaded must be done with call_loaded enabled.
+        # This is due to the possibility that a nodes _loaded
+        # will use getOID to fetch another node which might not
+        # have been loaded yet. If that happens with call_loaded =
+        # False the node will be loaded without ever having
+        # _loaded called, which might be very bad.
+        self.call_loaded = True
+        node._loaded(data)
+        self.call_loaded = False
+
     @defer.inlineCallbacks
-    def _loadOIDClassMapping(self):
-        """Return a mapping (dict) of oid -> class_id.
+    def _streamPreLoad(self):
+        """Preload node data streamed from storage.
 
-        The ObjectStore keeps a dict of oid to class_id mappings.
-        This is done to avoid hitting storage every time a node needs
-        to be loaded. When loading a node only the oid is known (from the
-        branch), so the class_id needs to be looked up.
+        Instead of building a mapping of all node data up front, storage
+        hands us the data for a batch of oids at a time (in oid order),
+        and each node is loaded as its data arrives. This keeps memory
+        use during startup close to the size of the loaded tree.
+
+        Nodes are matched against the streamed data by walking a sorted
+        list of the oids in the tree, nodes without any data get an
+        empty dict, just like preLoad.
         """
-        mapping = {}
-        res = yield self.storage.listOIDClasses()
-        for oid, class_id in res:
-            mapping[oid] = class_id
-        defer.returnValue(mapping)
-    
+        print 'Streaming OID data'
+        preloader = _StreamingPreLoader(self)
+        self.call_loaded = False
+        try:
+            count = yield self.storage.streamOIDData(preloader.load)
+            preloader.finish()
+        finally:
+            self.call_loaded = True
+        print 'OID data streamed for %d oids' % (count)
+        defer.returnValue(True)
+
+    @defer.inlineCallbacks
+    def _loadStorage(self):
+        """Load the object tree (and node data) from storage.
+
+        If a snapshot path is set and a usable snapshot exists it is
+        loaded instead, see _loadSnapshot.
+
+        Otherwise the idmap, associations and node data are fetched.
+        They are independent of each other, so all three queries are
+        started at once and run concurrently on separate pool
+        connections. The tree is built from the idmap as soon as it
+        arrives, while the other queries are still running.
+
+        Streamed node data (see _streamPreLoad) needs the finished tree,
+        so it is only fetched after the tree has been built.
+        """
+        start = time.time()
+        if self.snapshot_path:
+            loaded = yield self._loadSnapshot()
+            if loaded:
+                defer.returnValue(True)
+        # Read before anything else, changes made while loading are
+        # then picked up from the journal later on.
+        self.journal_seq = yield self.storage.getJournalSeq()
+        idmap, associations, data_mapping = yield self._fetchRows(start,
+                with_data = self.preload and not self.stream_preload)
+        yield self._buildStore(idmap, associations, data_mapping)
+        elapsed = time.time() - start
+        self.load_stats = {'source': 'storage', 'time': elapsed,
+                'seq': self.journal_seq, 'replayed_oids': 0}
+        log.msg('ObjectStore: storage loaded in %.2fs' % (elapsed))
+        defer.returnValue(True)
+
+    @defer.inlineCallbacks
+    def _fetchRows(self, start, with_data):
+        """Fetch the idmap, associations and (optionally) node data.
+
+        The queries are started at once and run concurrently on
+        separate pool connections. Returns (idmap, associations,
+        data_mapping), data_mapping is None unless with_data is set.
+        """
+        idmap_d = self._timedLoad('idmap', start, self.storage.listOIDMap())
+        assoc_d = self._timedLoad('associations', start,
+                self.storage.listAssociations())
+        data_d = None
+        if with_data:
+            data_d = self._timedLoad('node data', start,
+                    self.storage.makeOIDData())
+        # Wait for all queries before failing on any of them, otherwise
+        # the remaining ones will end up as unhandled errors.
+        results = yield defer.DeferredList(
+                [d for d in [idmap_d, assoc_d, data_d] if d],
+                consumeErrors = True)
+        for success, result in results:
+            if not success:
+                result.raiseException()
+        idmap = results[0][1]
+        associations = results[1][1]
+        data_mapping = None
+        if data_d:
+            data_mapping = results[2][1]
+        # The deferreds hold on to their results, drop them so the
+        # loaded rows can be freed as soon as they have been used.
+        results = idmap_d = assoc_d = data_d = None
+        defer.returnValue((idmap, associations, data_mapping))
+
+    @defer.inlineCallbacks
+    def _buildStore(self, idmap, associations, data_mapping):
+        """Build the object tree and preload nodes from loaded rows."""
+        self._populateObjectTree(idmap, associations)
+        idmap = associations = None
+        self.view_tree = self.getOID('0')
+        if self.preload:
+            phase_start = time.time()
+            yield self.preLoad(data_mapping)
+            data_mapping = None
+            log.msg('ObjectStore: preload took %.2fs' % (time.time() - phase_start))
+        defer.returnValue(True)
+
+    @defer.inlineCallbacks
+    def _loadSnapshot(self):
+        """Load the object store from a snapshot file.
+
+        The snapshot is only used if it was written for the current
+        storage version and its journal sequence number isn't ahead
+        of storage. Oids with change journal entries newer than the
+        snapshot have their idmap, association and node data rows
+        fetched from storage, replacing the snapshot rows.
+
+        Returns True if the snapshot was loaded, False if it wasn't
+        usable.
+        """
+        start = time.time()
+        try:
+            snap = snapshot.Snapshot(self.snapshot_path)
+        except errors.SnapshotError, e:
+            log.msg('ObjectStore: not loading from snapshot: %s' % (e))
+            defer.returnValue(False)
+        try:
+            current_seq = yield self.storage.getJournalSeq()
+            if snap.store_version != STORE_VERSION or snap.seq > current_seq:
+                log.msg('ObjectStore: snapshot %s does not match storage, not using it' % (
+                    self.snapshot_path))
+                defer.returnValue(False)
+            journal = yield self.storage.listJournal(snap.seq)
+            trim_seq = yield self.storage.getJournalTrimSeq()
+            if snap.seq < trim_seq:
+                log.msg('ObjectStore: snapshot %s is older than the journal, not using it' % (
+                    self.snapshot_path))
+                defer.returnValue(False)
+            changed = set([oid for seq, oid, origin in journal])
+            if journal:
+                current_seq = max(current_seq, journal[-1][0])
+            journal = None
+            idmap = [row for row in snap.idmap() if row[1] not in changed]
+            associations = [row for row in snap.associations() \
+                    if row[0] not in changed and row[1] not in changed]
+            data_mapping = None
+            if self.preload:
+                data_mapping = dict(snap.iterData())
+        except errors.SnapshotError, e:
+            log.msg('ObjectStore: not loading from snapshot: %s' % (e))
+            defer.returnValue(False)
+        finally:
+            snap.close()
+        log.msg('ObjectStore: reading snapshot took %.2fs' % (time.time() - start))
+        if changed:
+            changed = list(changed)
+            rows = yield self.storage.getOIDMapRows(changed)
+            idmap.extend(rows)
+            rows = yield self.storage.getAssociationRows(changed)
+            associations.extend(set([tuple(row) for row in rows]))
+            if data_mapping is not None:
+                for oid in changed:
+                    data_mapping.pop(oid, None)
+                data = yield self.storage.getOIDData(changed)
+                data_mapping.update(data)
+            log.msg('ObjectStore: replayed %d changed oids since snapshot' % (len(changed)))
+        self.journal_seq = current_seq
+        yield self._buildStore(idmap, associations, data_mapping)
+        elapsed = time.time() - start
+        self.load_stats = {'source': 'snapshot', 'time': elapsed,
+                'seq': current_seq, 'replayed_oids': len(changed)}
+        log.msg('ObjectStore: snapshot loaded in %.2fs' % (elapsed))
+        defer.returnValue(True)
+
     @defer.inlineCallbacks
-    def _getNextOID(self):
-        """Return the next available object id.
+    def writeSnapshot(self, path = None):
+        """Write a snapshot of storage to path (default: snapshot_path).
 
-        Checks the object id's allocated in storage and returns the
-        next available one.
+        The snapshot is built from storage, not from the in memory
+        tree, so uncommitted changes are never included. Node data is
+        read a page at a time and the file is written in a thread.
+        Changes committed while the snapshot is written are covered by
+        the journal sequence number, which is read first.
+
+        Once written, the journal is trimmed, see trimJournal.
+
+        Returns the journal sequence number of the snapshot or None if
+        a snapshot is already being written.
         """
-        last_oid = 0
-        res = yield self.storage.listOIDs()
-        for parent_oid, oid in res:
-            oid = int(oid)
-            if oid > last_oid:
-                last_oid = oid
-        last_oid += 1
-        defer.returnValue(last_oid)
+        path = path or self.snapshot_path
+        if not path:
+            raise errors.SnapshotError('no snapshot path set')
+        if self.snapshot_writing:
+            log.msg('ObjectStore: snapshot already being written, skipping')
+            defer.returnValue(None)
+        self.snapshot_writing = True
+        start = time.time()
+        try:
+            seq = yield self.storage.getJournalSeq()
+            idmap = yield self.storage.listOIDMap()
+            associations = yield self.storage.listAssociations()
+            writer = yield threads.deferToThread(snapshot.SnapshotWriter,
+                    path, STORE_VERSION, seq)
+            try:
+                yield threads.deferToThread(self._writeSnapshotRows,
+                        writer, idmap, associations)
+                idmap = associations = None
+                last_oid = ''
+                while True:
+                    rows = yield self.storage.getOIDDataPage(last_oid,
+                            SNAPSHOT_PAGE_SIZE)
+                    if not rows:
+                        break
+                    last_oid = rows[-1][0]
+                    yield threads.deferToThread(self._writeSnapshotData,
+                            writer, rows)
+                yield threads.deferToThread(writer.close)
+            except:
+                writer.abort()
+                raise
+        finally:
+            self.snapshot_writing = False
+        log.msg('ObjectStore: snapshot written to %s in %.2fs (seq %s)' % (
+            path, time.time() - start, seq))
+        yield self.trimJournal()
+        defer.returnValue(seq)
 
     @defer.inlineCallbacks
-    def _populateObjectTree(self):
+    def trimJournal(self):
+        """Trim the change journal down to journal_retention entries.
+
+        Called every JOURNAL_TRIM_COMMITS commits and after a snapshot
+        is written, so the journal is bounded whether or not snapshots
+        are used. Object stores that haven't caught up to the trimmed
+        entries yet do a full reload, and snapshots older than the trim
+        point aren't used, see _readJournalChanges.
+
+        Does nothing in readonly mode or if journal_retention is None.
+        Returns the sequence number trimmed up to or None.
+        """
+        if self.readonly or self.journal_retention is None or \
+                self.journal_trimming:
+            defer.returnValue(None)
+        self.journal_trimming = True
+        self.commits_since_trim = 0
+        try:
+            seq = yield self.storage.getJournalSeq()
+            trim_seq = seq - self.journal_retention
+            trimmed_seq = yield self.storage.getJournalTrimSeq()
+            if trim_seq <= trimmed_seq:
+                defer.returnValue(None)
+            yield self.storage.trimJournal(trim_seq)
+        finally:
+            self.journal_trimming = False
+        log.msg('ObjectStore: journal trimmed up to seq %s' % (trim_seq))
+        defer.returnValue(trim_seq)
+
+    def _ebTrimJournal(self, failure):
+        log.msg('ObjectStore: trimming journal failed: %s' % (failure.getErrorMessage()))
+
+    def _writeSnapshotRows(self, writer, idmap, associations):
+        writer.addIdmap(idmap)
+        writer.addAssociations(associations)
+
+    def _writeSnapshotData(self, writer, rows):
+        for oid, data in streaming.group_rows(rows):
+            writer.addData(oid, data)
+
+    def _timedLoad(self, name, start, d):
+        """Log the time it took for storage query deferred d to finish."""
+        def cb(res):
+            log.msg('ObjectStore: loading %s took %.2fs' % (name, time.time() - start))
+            return res
+        d.addCallback(cb)
+        return d
+
+    def _populateObjectTree(self, idmap, associations):
         """Populate the object tree with oids.
 
-        Grabs all existing oids from storage and loads them into the
-        object tree (a branch is created per oid.
+        idmap is a list of (parent_oid, oid, class_id) rows, a branch
+        is created per oid and the oid -> class_id mapping is built from
+        the same rows.
+        The ObjectStore keeps a dict of oid to class_id mappings.
+        This is done to avoid hitting storage every time a node needs
+        to be loaded. When loading a node only the oid is known (from the
+        branch), so the class_id needs to be looked up.
         Also loads all associations.
         """
-        oids = yield self.storage.listOIDs()
-        self.object_tree.loadBranches(oids)
-        associations = yield self.storage.listAssociations()
+        start = time.time()
+        mapping = {}
+        intern_id = interning.intern_id
+        for parent_oid, oid, class_id in idmap:
+            mapping[intern_id(oid)] = intern_id(class_id)
+        self.oid_class_mapping = mapping
+        self.object_tree.loadBranches(idmap)
         self.object_tree.loadAssociations(associations)
-        defer.returnValue(True)
+        log.msg('ObjectStore: populating object tree took %.2fs' % (time.time() - start))
+
+    def snapshot(self, capture = None):
+        """Return a read snapshot of the object tree.
+
+        See objecttree.TreeSnapshot, the snapshot must be closed when
+        it is no longer needed.
+        """
+        return self.object_tree.snapshot(capture)
 
     def getOID(self, oid, valid_types = None, user = None):
         """Return the object with the given object id.
@@ -233,10 +1392,10 @@ class ObjectStore(object):
                     continue
                 # Get the attributes nearest _non-attribute_ parent.
                 node = node.getParentNode()
-            if not node.hasReadPermission(user):
-                continue
             if node.oid in returned:
                 continue
+            if not node.checkReadPermission(user):
+                continue
             if len(include) > 0 and node.class_name not in include:
                 continue
             if node.class_name in exclude:
@@ -276,10 +1435,10 @@ class ObjectStore(object):
             if node.class_name in local_types:
                 # Get the attributes nearest _non-attribute_ parent.
                 node = node.getParentNode()
-            if not node.hasReadPermission(user):
-                continue
             if node.oid in returned:
                 continue
+            if not node.checkReadPermission(user):
+                continue
             if node.class_name not in ['device']:
                 continue
             returned[node.oid] = True
@@ -304,6 +1463,89 @@ class ObjectStore(object):
             log.msg('Trigger %s raised unhandled exception: %s' % (event_trigger, str(e)))
         self.event_triggers_enabled = True
 
+    def checkWritable(self):
+        """Raise errors.ReadOnly if the object store is read-only.
+
+        Called before modifying the tree, so rejected writes leave the
+        tree untouched.
+        """
+        if self.readonly:
+            raise errors.ReadOnly('object store is read-only')
+
+    def rejectWrite(self, node):
+        """Reject a storage action for node in readonly mode.
+
+        Setters call checkWritable before changing anything, this is the
+        fallback for nodes that were changed in memory before their
+        storage action was added. The node data is reloaded from storage
+        right away to undo the change, and the node is resynced (parent
+        and associations included) the next time the journal is applied.
+        """
+        self.resync_oids.add(node.oid)
+        try:
+            data = self.storage.readOIDDataBlocking([node.oid])[node.oid]
+            node._loaded(data = data)
+        except Exception, e:
+            log.msg('ObjectStore: reloading %s after a rejected write failed: %s' % (
+                node.oid, e))
+        raise errors.ReadOnly('object store is read-only')
+
+    def getStats(self):
+        """Return a dict of object store statistics."""
+        stats = {'commit': self.commit_stats.asDict(),
+                'load': self.load_stats}
+        if self.node_cache:
+            stats['node_cache'] = self.node_cache.asDict()
+        stats['perm_cache'] = treenodes.perm_cache.asDict()
+        return stats
+
+    def census(self, step = census.STEP_SIZE):
+        """Count nodes and estimate memory use per node class and cache.
+
+        Runs in steps of step items on the reactor (see task.cooperate),
+        the tree is traversed through a snapshot so it can change
+        meanwhile. Returns a deferred that fires with a dict:
+            nodes: count, bytes and per class (name) count, loaded and
+                bytes, see census.NodeCensus
+            oid_class_mapping, perm_cache: entries and bytes
+            snapshots: open tree snapshots and branches copied by them
+            node_cache: the node cache stats, if there is a node cache
+            search: searcher specific, see BaseSearch.census
+        Sizes are approximate, see census.py.
+        """
+        result = {}
+        d = task.cooperate(self._iterCensus(result, step)).whenDone()
+        d.addCallback(lambda _: result)
+        return d
+
+    def _iterCensus(self, result, step):
+        tree = self.object_tree
+        nodes = census.NodeCensus()
+        tree_snapshot = tree.snapshot()
+        try:
+            for n, branch in enumerate(tree_snapshot.traverse(tree, False, -1)):
+                nodes.add(branch)
+                if n % step == step - 1:
+                    yield None
+                    if tree_snapshot.tree is None:
+                        raise errors.SiptrackError(
+                                'object store reloaded during census')
+        finally:
+            tree_snapshot.close()
+        result['nodes'] = nodes.asDict()
+        for name, mapping in [('oid_class_mapping', self.oid_class_mapping),
+                ('perm_cache', treenodes.perm_cache.entries)]:
+            mapping_census = census.MappingCensus()
+            for _ in mapping_census.iterCount(mapping, step):
+                yield None
+            result[name] = mapping_census.asDict()
+        result['snapshots'] = {'open': len(tree.snapshots),
+                'copied': sum(len(s.saved) for s in tree.snapshots)}
+        if self.node_cache:
+            result['node_cache'] = self.node_cache.asDict()
+        if self.searcher:
+            result['search'] = self.searcher.census()
+
     @defer.inlineCallbacks
     def commit(self, orig_nodes):
         if type(orig_nodes) not in [list, tuple]:
@@ -311,40 +1553,50 @@ class ObjectStore(object):
         else:
             nodes = list(orig_nodes)
         # This happens in a seperate thread.
-        def db_commit(txn, commit_data):
+        def db_commit(txn, commit_data, elided):
             start = time.time()
             print 'STARTING STORAGE COMMIT', start, len(commit_data)
+            batch = StorageBatch(self.origin)
             for node, actions in commit_data:
                 for action in actions:
-                    args = action.get('args')
-                    if action['action'] == 'create_node':
-                        parent_oid = 'ROOT'
-                        parent = node.parent
-                        if parent:
-                            parent_oid = parent.oid
-                        self.storage.addOID(parent_oid, node.oid, node.class_id, txn)
-                    elif action['action'] == 'remove_node':
-                        self.storage.removeOID(node.oid, txn)
-                    elif action['action'] == 'relocate':
-                        self.storage.relocate(node.oid, node.branch.parent.oid, txn)
-                    elif action['action'] == 'associate':
-                        self.storage.associate(node.oid, args['other'], txn)
-                    elif action['action'] == 'disassociate':
-                        self.storage.disassociate(node.oid, args['other'], txn)
-                    elif action['action'] == 'write_data':
-                        self.storage.writeData(node.oid, args['name'], args['value'], txn)
-                    elif action['action'] == 'affecting_node':
-                        nodes.append(args['node'])
-            print 'STORAGE COMMIT DONE', start, time.time()-start
+                    if action['action'] == 'affecting_node':
+                        nodes.append(action['args']['node'])
+                    else:
+                        batch.add(node, action['action'], action.get('args'))
+            batch.write(self.storage, txn)
+            elapsed = time.time() - start
+            self.commit_stats.update(batch.actions, elapsed, elided)
+            print 'STORAGE COMMIT DONE', start, elapsed, batch.actions, elided
         def get_commit_data(nodes):
             data = []
+            elided = 0
             for node in nodes:
                 if node._storage_actions:
-                    actions = node._storage_actions
-                    node._storage_actions = []
-                    data.append((node, actions))
-            return data
-        st_d = self.storage.interact(db_commit, get_commit_data(nodes))
-        yield st_d
-        se_d = self.searcher.commit(orig_nodes)
+                    actions, node_elided = compact_actions(node._storage_actions)
+                    node._storage_actions = ()
+                    elided += node_elided
+                    if actions:
+                        data.append((node, actions))
+            return data, elided
+        commit_data, elided = get_commit_data(nodes)
+        st_d = self.storage.interact(db_commit, commit_data, elided)
+        self.commits_in_flight.add(st_d)
+        try:
+            yield st_d
+        finally:
+            self.commits_in_flight.discard(st_d)
+        # Nodes fetched before a background reload swapped trees, get
+        # their changes into the live tree, see _retireTree.
+        if self.old_trees and \
+                [node for node in nodes if node.branch is not None and \
+                    node.branch.tree is not self.object_tree]:
+            try:
+                yield self.applyJournal(include_own = True)
+            except Exception, e:
+                log.msg('ObjectStore: applying the journal after commit failed: %s' % (e))
+        self.commits_since_trim += 1
+        if self.commits_since_trim >= JOURNAL_TRIM_COMMITS:
+            self.trimJournal().addErrback(self._ebTrimJournal)
+        if self.searcher:
+            se_d = self.searcher.commit(orig_nodes)
         defer.returnValue(True)
@@ -1,6 +1,9 @@
 import time
 import os
 import os.path
+import re
+import sys
+import fnmatch
 try:
     from whoosh.index import create_in
     from whoosh import fields
@@ -9,6 +12,7 @@ try:
     from whoosh.qparser import QueryParser, MultifieldParser
     from whoosh.qparser import plugins
     from whoosh import analysis
+    from whoosh.query import Wildcard
     from whoosh.compat import u
     import threading
     _have_whoosh = True
@@ -16,6 +20,7 @@ except:
     _have_whoosh = False
 
 from twisted.internet import threads
+from twisted.internet import task
 
 from siptrackdlib import errors
 from siptrackdlib import log
@@ -88,12 +93,439 @@ class BaseSearch(object):
         """
         return iter([])
 
+    def reloaded(self, object_store):
+        """Called when a full reload has swapped in a new object tree."""
+        pass
+
+    def census(self):
+        """Return a dict describing the size of the search index.
+
+        Byte counts are floats, see census.py.
+        """
+        return {}
+
+# Splits values into terms, like the whoosh StandardAnalyzer (without
+# the stop words).
+_token_re = re.compile(r'\w+(?:\.?\w+)*', re.UNICODE)
+# Splits a query into words, keeping quoted phrases together.
+_query_re = re.compile(r'(?:(\w+):)?(?:"([^"]*)"|(\S+))', re.UNICODE)
+
+# Number of nodes indexed per step when MemorySearch rebuilds its index
+# after a reload.
+BUILD_STEP_SIZE = 1000
+
+# Fields matched as a whole instead of by their terms (ID fields in the
+# whoosh schema).
+_id_fields = ['oid', 'name']
+
+def _trigrams(text):
+    return set(text[n:n + 3] for n in xrange(len(text) - 2))
+
+class TermIndex(object):
+    """Trigram index of the terms of a search index.
+
+    Maps every trigram of every term added to the (field, term) pairs
+    containing it. Used to find the terms matching a wildcard pattern
+    without looking at every term of a field, see match.
+    """
+    def __init__(self):
+        # trigram -> set of (field, term)
+        self.trigrams = {}
+        self.terms = 0
+
+    def add(self, field, term):
+        """Add a term, terms that are already indexed are ignored."""
+        key = (field, term)
+        added = False
+        for trigram in _trigrams(term):
+            keys = self.trigrams.get(trigram)
+            if keys is None:
+                keys = self.trigrams[trigram] = set()
+            if key not in keys:
+                keys.add(key)
+                added = True
+        if added:
+            self.terms += 1
+
+    def remove(self, field, term):
+        key = (field, term)
+        removed = False
+        for trigram in _trigrams(term):
+            keys = self.trigrams.get(trigram)
+            if keys is not None and key in keys:
+                keys.remove(key)
+                removed = True
+                if not keys:
+                    del self.trigrams[trigram]
+        if removed:
+            self.terms -= 1
+
+    def match(self, pattern, fields = None):
+        """Return the (field, term) pairs matching a glob pattern.
+
+        Only terms of the given fields (all fields if None) are
+        returned. Returns None if the literal parts of pattern don't
+        have a single trigram, those patterns need a scan of the terms.
+        """
+        trigrams = set()
+        # Character classes ([...]) aren't literals.
+        literals = re.sub(r'\[[^\]]*\]', '?', pattern)
+        for literal in re.split(r'[*?]', literals):
+            trigrams.update(_trigrams(literal))
+        if not trigrams:
+            return None
+        # Intersect the smallest sets first.
+        keys = None
+        for trigram in sorted(trigrams,
+                key = lambda t: len(self.trigrams.get(t, ()))):
+            found = self.trigrams.get(trigram)
+            if not found:
+                return []
+            if keys is None:
+                keys = set(found)
+            else:
+                keys &= found
+            if not keys:
+                return []
+        match = re.compile(fnmatch.translate(pattern), re.UNICODE).match
+        if fields is not None:
+            fields = set(fields)
+        return [(field, term) for field, term in keys
+                if (fields is None or field in fields) and match(term)]
+
+    def census(self):
+        size = sys.getsizeof(self.trigrams)
+        for keys in self.trigrams.itervalues():
+            size += sys.getsizeof(keys)
+        return {'terms': self.terms, 'trigrams': len(self.trigrams),
+                'bytes': float(size)}
+
+class MemorySearch(BaseSearch):
+    """An in memory search index.
+
+    Every non-attribute node is a document of {field: value}, with the
+    values from node.buildSearchValues (lower case). For each field the
+    index keeps postings, {term: set of oids}, for the terms of the
+    values, except for name which is indexed as a whole, like in the
+    whoosh schema. Terms are also indexed by a TermIndex, so wildcard
+    queries only have to look at terms that contain the literal parts
+    of the pattern.
+
+    Queries use a subset of the whoosh query syntax: words are ANDed,
+    OR and NOT are supported, field:word searches a single field,
+    "quoted phrases" must appear in a value as is and * and ? are
+    wildcards. Words without a field are looked for in default_fields,
+    or in every field if there are none.
+
+    The index is updated as soon as nodes are committed and isn't
+    stored anywhere, it is built on startup. After full reloads a new
+    index is built in steps and swapped in, see reloaded.
+    """
+    def __init__(self):
+        self._clear()
+        # The index being built by reloaded and the (node, action)
+        # pairs committed since it was started.
+        self._rebuild = None
+        self._rebuild_actions = None
+
+    def _clear(self):
+        # oid -> {field: value}
+        self.documents = {}
+        # field -> {term: set of oids}
+        self.postings = {}
+        self.terms = TermIndex()
+
+    def _buildIndex(self, object_store = None, force = False):
+        log.msg('MemorySearch building index.')
+        start = time.time()
+        self._clear()
+        for _ in self._iterBuildIndex(object_store):
+            pass
+        log.msg('MemorySearch indexed %d nodes in %.2fs.' % (
+            len(self.documents), time.time() - start))
+
+    def _iterBuildIndex(self, object_store, step = BUILD_STEP_SIZE,
+            snapshot = None):
+        """Index the nodes of object_store, yields after every step nodes.
+
+        The tree can change in between steps, snapshot (an
+        objecttree.TreeSnapshot) is traversed instead of the live tree
+        then, so no node is skipped. It is closed when done.
+        """
+        attr_types = ['attribute', 'versioned attribute']
+        try:
+            for n, node in enumerate(object_store.view_tree.traverse(
+                    exclude = attr_types, snapshot = snapshot)):
+                # Removed since the snapshot was taken, the removal is
+                # applied to the index later anyway.
+                if not node.removed:
+                    self._setNode(node)
+                if n % step == step - 1:
+                    yield None
+                    if snapshot is not None and snapshot.tree is None:
+                        raise errors.SiptrackError(
+                                'object store reloaded during index build')
+        finally:
+            if snapshot is not None:
+                snapshot.close()
+
+    def reloaded(self, object_store):
+        """Build a new index for the reloaded tree in the background.
+
+        The current index keeps answering searches (and being updated)
+        until the new one is done. The tree is indexed as it is now,
+        through a snapshot, and commits made in the meantime are applied
+        to the new index before it is swapped in.
+        """
+        start = time.time()
+        index = self._rebuild = MemorySearch()
+        self._rebuild_actions = []
+        snapshot = object_store.object_tree.snapshot()
+        d = task.cooperate(index._iterBuildIndex(object_store,
+            snapshot = snapshot)).whenDone()
+        d.addCallback(self._cbReloaded, index, start)
+        d.addErrback(self._ebReloaded, index)
+        return d
+
+    def _cbReloaded(self, _, index, start):
+        if index is not self._rebuild:
+            # Replaced by a later rebuild.
+            return
+        for node, action in self._rebuild_actions:
+            index._applyAction(node, action)
+        self.documents = index.documents
+        self.postings = index.postings
+        self.terms = index.terms
+        self._rebuild = self._rebuild_actions = None
+        log.msg('MemorySearch rebuilt index of %d nodes in %.2fs.' % (
+            len(self.documents), time.time() - start))
+
+    def _ebReloaded(self, failure, index):
+        if index is self._rebuild:
+            self._rebuild = self._rebuild_actions = None
+        log.msg('MemorySearch rebuilding the index failed: %s' % (
+            failure.getErrorMessage()))
+
+    def census(self):
+        size = sys.getsizeof(self.documents)
+        for values in self.documents.itervalues():
+            size += sys.getsizeof(values)
+        terms = 0
+        for field_postings in self.postings.itervalues():
+            terms += len(field_postings)
+            size += sys.getsizeof(field_postings)
+            for oids in field_postings.itervalues():
+                size += sys.getsizeof(oids)
+        term_index = self.terms.census()
+        return {
+            'documents': len(self.documents),
+            'terms': terms,
+            'trigrams': term_index['trigrams'],
+            'bytes': size + term_index['bytes'],
+        }
+
+    def commit(self, nodes):
+        if type(nodes) not in [list, tuple]:
+            nodes = [nodes]
+        for node in nodes:
+            if not node._searcher_actions:
+                continue
+            actions = node._searcher_actions
+            node._searcher_actions = ()
+            for action in actions:
+                self._applyAction(node, action)
+                if self._rebuild_actions is not None:
+                    self._rebuild_actions.append((node, action))
+
+    def _applyAction(self, node, action):
+        args = action.get('args')
+        if action['action'] == 'create_node':
+            self._setNode(node)
+        elif action['action'] == 'remove_node':
+            self._removeDocument(node.oid)
+        elif action['action'] in ['set_attr', 'remove_attr']:
+            self._setNode(args['parent'])
+
+    def _terms(self, field, value):
+        if field in _id_fields:
+            return [value]
+        return set(_token_re.findall(value))
+
+    def _setNode(self, node):
+        # Attribute values are indexed as part of their parent.
+        if node.class_name in ['attribute', 'versioned attribute']:
+            return
+        self._removeDocument(node.oid)
+        values = {}
+        for field, value in node.buildSearchValues().iteritems():
+            value = self._stringifyValue(value)
+            if type(value) != unicode:
+                value = value.decode('utf-8', 'replace')
+            values[field] = value
+        if not values:
+            return
+        oid = node.oid
+        self.documents[oid] = values
+        for field, value in values.iteritems():
+            field_postings = self.postings.setdefault(field, {})
+            for term in self._terms(field, value):
+                oids = field_postings.get(term)
+                if oids is None:
+                    oids = field_postings[term] = set()
+                    self.terms.add(field, term)
+                oids.add(oid)
+
+    def _removeDocument(self, oid):
+        values = self.documents.pop(oid, None)
+        if not values:
+            return
+        for field, value in values.iteritems():
+            field_postings = self.postings[field]
+            for term in self._terms(field, value):
+                oids = field_postings[term]
+                oids.discard(oid)
+                if oids:
+                    continue
+                del field_postings[term]
+                self.terms.remove(field, term)
+            if not field_postings:
+                del self.postings[field]
+
+    def _matchWord(self, word, fields):
+        """Return the oids with a term matching word in one of fields."""
+        if fields is None:
+            fields = self.postings.keys()
+        result = set()
+        if '*' not in word and '?' not in word:
+            for field in fields:
+                result.update(self.postings.get(field, {}).get(word, ()))
+            return result
+        keys = self.terms.match(word, fields)
+        if keys is not None:
+            for field, term in keys:
+                result.update(self.postings[field][term])
+        else:
+            match = re.compile(fnmatch.translate(word), re.UNICODE).match
+            for field in fields:
+                for term, oids in self.postings.get(field, {}).iteritems():
+                    if match(term):
+                        result.update(oids)
+        return result
+
+    def _matchPhrase(self, phrase, fields):
+        """Return the oids with phrase in the value of one of fields."""
+        candidates = None
+        for word in _token_re.findall(phrase):
+            oids = self._matchWord(u'*%s*' % (word), fields)
+            if candidates is None:
+                candidates = oids
+            else:
+                candidates &= oids
+        result = set()
+        for oid in candidates or ():
+            values = self.documents[oid]
+            for field in fields or values.keys():
+                if phrase in values.get(field, u''):
+                    result.add(oid)
+                    break
+        return result
+
+    def _search(self, query, default_fields):
+        """Return the set of oids matching a single query."""
+        groups = []
+        clauses = []
+        negate = False
+        for match in _query_re.finditer(query.lower()):
+            field, phrase, word = match.groups()
+            if not field and word in ['and', 'or', 'not'] and \
+                    match.group(0) == word:
+                if word == 'or':
+                    groups.append(clauses)
+                    clauses = []
+                elif word == 'not':
+                    negate = True
+                continue
+            if field:
+                fields = [field]
+            else:
+                fields = default_fields or None
+            if phrase is not None:
+                oids = self._matchPhrase(phrase, fields)
+            else:
+                oids = self._matchWord(word, fields)
+            clauses.append((negate, oids))
+            negate = False
+        groups.append(clauses)
+        result = set()
+        for clauses in groups:
+            matched = None
+            for negate, oids in clauses:
+                if not negate:
+                    matched = oids if matched is None else matched & oids
+            if matched is None:
+                if not clauses:
+                    continue
+                matched = set(self.documents)
+            for negate, oids in clauses:
+                if negate:
+                    matched = matched - oids
+            result |= matched
+        return result
+
+    def _yieldResults(self, oids, max_results):
+        count = 0
+        for oid in sorted(oids, key = lambda oid: (len(oid), oid)):
+            yield oid
+            count += 1
+            if max_results and count >= max_results:
+                break
+
+    def search(self, queries, fuzzy = True, default_fields = [], max_results = None):
+        if type(queries) != list:
+            queries = [queries]
+        if type(default_fields) != list:
+            default_fields = [default_fields]
+        if fuzzy and len(queries) == 1 and len(queries[0].split()) == 1 and ':' not in queries[0] and '*' not in queries[0]:
+            queries = ['*%s*' % (queries[0])]
+        for query in queries:
+            if type(query) != unicode:
+                query = query.decode('utf-8')
+            log.msg('search query: %s' % (query))
+            for oid in self._yieldResults(self._search(query, default_fields),
+                    max_results):
+                yield oid
+
+    def searchHostnames(self, queries, max_results = None):
+        if type(queries) != list:
+            queries = [queries]
+        for query in queries:
+            if type(query) == unicode:
+                pass
+            elif type(query) == str:
+                query = query.decode('utf-8')
+            else:
+                query = str(query).decode('ascii')
+            for oid in self._yieldResults(self._search(query, ['name']),
+                    max_results):
+                yield oid
+
 class WhooshSearch(BaseSearch):
+    """Search using a whoosh index, on disk or in memory.
+
+    Wildcard queries starting with a wildcard (like the *text* of
+    fuzzy searches) would have whoosh go through every term of the
+    fields searched. Instead the terms matching them are looked up in
+    a TermIndex of the terms in the whoosh index, see
+    TermIndexWildcard. The TermIndex is built when the searcher starts
+    and only grows after that: terms of deleted documents are kept,
+    they just don't match anything anymore.
+    """
     def __init__(self, storage_directory = None):
         self._using_existing_index = False
         self.schema, self.ix = self._setup(storage_directory)
         self._indexed = False
         self._write_lock = threading.Lock()
+        self.terms = TermIndex()
 
     def _setup(self, storage_directory):
         schema = fields.Schema(
@@ -115,16 +547,48 @@ class WhooshSearch(BaseSearch):
         return (schema, ix)
 
     def _buildIndex(self, object_store):
-        if self._using_existing_index:
-            return
-        log.msg('WhooshSearch building index, hang on.')
-        self._indexed = True
-        attr_types = ['attribute', 'versioned attribute']
-        writer = self.ix.writer()
-        for node in object_store.view_tree.traverse(exclude = attr_types):
-            self._setNode(node, writer)
-        writer.commit()
-        log.msg('WhooshSearch index building complete.')
+        if not self._using_existing_index:
+            log.msg('WhooshSearch building index, hang on.')
+            self._indexed = True
+            attr_types = ['attribute', 'versioned attribute']
+            writer = self.ix.writer()
+            for node in object_store.view_tree.traverse(exclude = attr_types):
+                self._setNode(node, writer)
+            writer.commit()
+            log.msg('WhooshSearch index building complete.')
+        self._buildTermIndex()
+
+    def _buildTermIndex(self):
+        start = time.time()
+        self.terms = TermIndex()
+        reader = self.ix.reader()
+        try:
+            for fieldname, btext in reader.all_terms():
+                if fieldname != 'oid':
+                    self.terms.add(fieldname,
+                            self.ix.schema[fieldname].from_bytes(btext))
+        finally:
+            reader.close()
+        log.msg('WhooshSearch indexed %d terms in %.2fs.' % (
+            self.terms.terms, time.time() - start))
+
+    def _addTerms(self, documents):
+        """Add the terms of newly written documents to the TermIndex."""
+        for values in documents:
+            for fieldname, value in values.iteritems():
+                if fieldname == 'oid':
+                    continue
+                field = self.ix.schema[fieldname]
+                for term in field.process_text(value, mode = 'index'):
+                    self.terms.add(fieldname, term)
+
+    def census(self):
+        storage = self.ix.storage
+        return {
+            'documents': self.ix.doc_count(),
+            'bytes': float(sum(storage.file_length(name) for name in storage.list())),
+            'term_index': self.terms.census(),
+        }
 
     def commit(self, nodes):
         def run(nodes):
@@ -135,33 +599,46 @@ class WhooshSearch(BaseSearch):
             self._write_lock.acquire()
             try:
                 writer = self.ix.writer()
-                self._commit(nodes, writer)
+                documents = self._commit(nodes, writer)
                 writer.commit()
             finally:
                 self._write_lock.release()
-        return threads.deferToThread(run, nodes)
+            return documents
+        d = threads.deferToThread(run, nodes)
+        # The TermIndex is only used from the reactor thread.
+        d.addCallback(self._addTerms)
+        return d
 
     def _commit(self, nodes, writer):
+        """Write the searcher actions of nodes.
+
+        Returns the documents written.
+        """
         start = time.time()
+        documents = []
         print 'STARTING SEARCHER COMMIT', start, len(nodes)
         while nodes:
             node = nodes.pop(0)
 #            print 'SEARCHER COMMIT NODE', node
             if node._searcher_actions:
                 actions = node._searcher_actions
-                node._searcher_actions = []
+                node._searcher_actions = ()
                 for action in actions:
 #                    print 'SEARCHER COMMIT ACTION', node, action
                     args = action.get('args')
+                    values = None
                     if action['action'] == 'create_node':
-                        self._setNode(node, writer)
+                        values = self._setNode(node, writer)
                     elif action['action'] == 'remove_node':
                         writer.delete_by_term('oid', unicode(node.oid))
                     elif action['action'] == 'set_attr':
-                        self._setNode(args['parent'], writer)
+                        values = self._setNode(args['parent'], writer)
                     elif action['action'] == 'remove_attr':
-                        self._setNode(args['parent'], writer)
+                        values = self._setNode(args['parent'], writer)
+                    if values:
+                        documents.append(values)
         print 'SEARCHER COMMIT DONE', start, time.time()-start
+        return documents
 
     def _setNode(self, node, writer):
         # Special case handling of attribute, there is no point in
@@ -174,6 +651,14 @@ class WhooshSearch(BaseSearch):
             values['oid'] = unicode(node.oid)
             writer.delete_by_term('oid', unicode(node.oid))
             writer.add_document(**values)
+        return values
+
+    def _useTermIndex(self, query):
+        """Query.accept function replacing leading wildcard queries."""
+        if type(query) is Wildcard and query.text[:1] in ['*', '?']:
+            return TermIndexWildcard(query.fieldname, query.text,
+                    self.terms, boost = query.boost)
+        return query
 
     def search(self, queries, fuzzy = True, default_fields = [], max_results = None):
         if type(queries) != list:
@@ -190,7 +675,7 @@ class WhooshSearch(BaseSearch):
                 parser = MultifieldParser(default_fields, self.ix.schema)
                 parser.remove_plugin_class(plugins.WildcardPlugin)
                 parser.add_plugin(WildcardPlugin)
-                query = parser.parse(query)
+                query = parser.parse(query).accept(self._useTermIndex)
                 log.msg('search query parsed: %s' % (query))
                 results = searcher.search(query, limit = None)
                 count = 0
@@ -213,7 +698,7 @@ class WhooshSearch(BaseSearch):
                 else:
                     query = str(query).decode('ascii')
 #                log.msg('search query: %s' % (query))
-                query = parser.parse(query)
+                query = parser.parse(query).accept(self._useTermIndex)
 #                log.msg('search query parsed: %s' % (query))
                 count = 0
                 for result in searcher.search(query, limit = None):
@@ -233,6 +718,30 @@ if _have_whoosh:
         qms = u("\u055E\u061F\u1367")
         expr = u("(?P<text>[\\S]*[*?%s]([\\S]|[*?%s])*)") % (qms, qms)
 
+    class TermIndexWildcard(Wildcard):
+        """A Wildcard query that finds its terms in a TermIndex.
+
+        Falls back to going through the terms of the field when the
+        pattern is too short for the TermIndex.
+        """
+        def __init__(self, fieldname, text, term_index, boost = 1.0,
+                constantscore = True):
+            super(TermIndexWildcard, self).__init__(fieldname, text, boost,
+                    constantscore)
+            self.term_index = term_index
+
+        def _btexts(self, ixreader):
+            keys = self.term_index.match(self.text, [self.fieldname])
+            if keys is None:
+                for btext in super(TermIndexWildcard, self)._btexts(ixreader):
+                    yield btext
+                return
+            # Terms missing from the reader (the TermIndex keeps terms
+            # of deleted documents) are skipped by the Term matchers.
+            field = ixreader.schema[self.fieldname]
+            for btext in sorted(field.to_bytes(term) for _, term in keys):
+                yield btext
+
 def get_searcher(name = None, *args, **kwargs):
     if name == 'memory':
         searcher = MemorySearch(*args, **kwargs)
@@ -0,0 +1,175 @@
+"""On-disk snapshots of object store storage.
+
+A snapshot holds the idmap, associations and decoded node data of a
+storage, stamped with the storage version and the change journal
+sequence number it was taken at. Loading a snapshot and replaying the
+journal entries written after it gives the same tree as loading
+everything from storage, but is a lot faster for large stores.
+
+File layout:
+  * MAGIC
+  * sections, one after the other
+  * the header, a marshalled dict describing the snapshot and the
+    (offset, length, crc32) of each section
+  * a trailer with the header offset followed by MAGIC
+
+The idmap and associations are stored as marshalled lists, node data
+is pickled in chunks of (oid, data) pairs so it can be decoded a chunk
+at a time. Snapshots are read using mmap.
+"""
+
+import os
+import marshal
+import mmap
+import struct
+import time
+import zlib
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+from siptrackdlib import errors
+
+MAGIC = 'STSNAP01'
+FORMAT_VERSION = 1
+# Number of oids per pickled node data chunk.
+DATA_CHUNK_SIZE = 5000
+
+_trailer = struct.Struct('!Q8s')
+
+def _crc(data):
+    return zlib.crc32(data) & 0xffffffff
+
+class SnapshotWriter(object):
+    """Write a snapshot file.
+
+    The snapshot is written to a temporary file that replaces path
+    when close is called, so an existing snapshot is never left half
+    written.
+    """
+    def __init__(self, path, store_version, seq):
+        self.path = path
+        self.tmp_path = '%s.tmp' % (path)
+        self.header = {
+            'format': FORMAT_VERSION,
+            'store_version': store_version,
+            'seq': seq,
+            'created': time.time(),
+            'sections': {},
+            'data_chunks': [],
+        }
+        self.data_chunk = []
+        self.file = open(self.tmp_path, 'wb')
+        self.file.write(MAGIC)
+        self.offset = len(MAGIC)
+
+    def _writeSection(self, data):
+        section = (self.offset, len(data), _crc(data))
+        self.file.write(data)
+        self.offset += len(data)
+        return section
+
+    def addIdmap(self, rows):
+        """Add the (parent_oid, oid, class_id) idmap rows."""
+        data = marshal.dumps([tuple(row) for row in rows])
+        self.header['sections']['idmap'] = self._writeSection(data)
+
+    def addAssociations(self, rows):
+        """Add the (self_oid, other_oid) association rows."""
+        data = marshal.dumps([tuple(row) for row in rows])
+        self.header['sections']['associations'] = self._writeSection(data)
+
+    def addData(self, oid, data):
+        """Add the decoded node data dict for an oid."""
+        self.data_chunk.append((oid, data))
+        if len(self.data_chunk) >= DATA_CHUNK_SIZE:
+            self._flushData()
+
+    def _flushData(self):
+        if self.data_chunk:
+            data = pickle.dumps(self.data_chunk, pickle.HIGHEST_PROTOCOL)
+            self.header['data_chunks'].append(self._writeSection(data))
+            self.data_chunk = []
+
+    def close(self):
+        """Finish the snapshot and move it into place."""
+        self._flushData()
+        header = marshal.dumps(self.header)
+        self.file.write(header)
+        self.file.write(_trailer.pack(self.offset, MAGIC))
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+        os.rename(self.tmp_path, self.path)
+
+    def abort(self):
+        """Throw away a partially written snapshot."""
+        self.file.close()
+        if os.path.exists(self.tmp_path):
+            os.unlink(self.tmp_path)
+
+class Snapshot(object):
+    """A snapshot file opened for reading.
+
+    Raises errors.SnapshotError if the file is missing or invalid.
+    """
+    def __init__(self, path):
+        self.path = path
+        try:
+            self.file = open(path, 'rb')
+        except IOError, e:
+            raise errors.SnapshotError('unable to open snapshot %s: %s' % (path, e))
+        try:
+            self.map = mmap.mmap(self.file.fileno(), 0, access = mmap.ACCESS_READ)
+        except (mmap.error, ValueError), e:
+            self.file.close()
+            raise errors.SnapshotError('unable to map snapshot %s: %s' % (path, e))
+        try:
+            self.header = self._readHeader()
+        except:
+            self.close()
+            raise
+        self.seq = self.header['seq']
+        self.store_version = self.header['store_version']
+        self.created = self.header['created']
+
+    def _readHeader(self):
+        size = len(self.map)
+        if size < len(MAGIC) + _trailer.size or self.map[:len(MAGIC)] != MAGIC:
+            raise errors.SnapshotError('invalid snapshot file %s' % (self.path))
+        header_offset, magic = _trailer.unpack(self.map[size - _trailer.size:])
+        if magic != MAGIC or header_offset > size - _trailer.size:
+            raise errors.SnapshotError('truncated snapshot file %s' % (self.path))
+        try:
+            header = marshal.loads(self.map[header_offset:size - _trailer.size])
+        except (ValueError, EOFError, TypeError):
+            raise errors.SnapshotError('invalid snapshot header in %s' % (self.path))
+        if type(header) is not dict or header.get('format') != FORMAT_VERSION:
+            raise errors.SnapshotError('unsupported snapshot format in %s' % (self.path))
+        return header
+
+    def _readSection(self, section):
+        offset, length, crc = section
+        data = self.map[offset:offset + length]
+        if _crc(data) != crc:
+            raise errors.SnapshotError('corrupt snapshot section in %s' % (self.path))
+        return data
+
+    def idmap(self):
+        """Return the list of (parent_oid, oid, class_id) idmap rows."""
+        return marshal.loads(self._readSection(self.header['sections']['idmap']))
+
+    def associations(self):
+        """Return the list of (self_oid, other_oid) association rows."""
+        return marshal.loads(self._readSection(self.header['sections']['associations']))
+
+    def iterData(self):
+        """Yield (oid, data) pairs for all oids with node data."""
+        for section in self.header['data_chunks']:
+            for item in pickle.loads(self._readSection(section)):
+                yield item
+
+    def close(self):
+        self.map.close()
+        self.file.close()
@@ -0,0 +1,95 @@
+"""Node data value encodings.
+
+Node data is stored as (datatype, data) pairs, the datatype describes
+how data was encoded. Common simple values (ints, bools, strings, lists
+of oids) get their own compact datatypes that are cheap to decode,
+anything else is pickled.
+
+Rows written by older versions all use the 'pickle' datatype, those are
+still read as before and can be rewritten to the compact datatypes with
+convert().
+"""
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+from siptrackdlib import errors
+
+def _is_oid_list(value):
+    for oid in value:
+        if type(oid) not in [str, unicode] or not oid.isdigit():
+            return False
+    return True
+
+def encode(value):
+    """Encode a value for storage.
+
+    Returns a (datatype, data) tuple where data is a (byte) string.
+    """
+    vtype = type(value)
+    if vtype is bool:
+        if value:
+            return 'bool', '1'
+        return 'bool', '0'
+    elif vtype is int or vtype is long:
+        return 'int', str(value)
+    elif vtype is unicode:
+        return 'text', value.encode('utf-8')
+    elif vtype is str:
+        return 'binary', value
+    elif value is None:
+        return 'none', ''
+    elif vtype is float:
+        return 'float', repr(value)
+    elif vtype is list and _is_oid_list(value):
+        return 'oidlist', str(','.join(value))
+    return 'pickle', pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+def _decode_bool(data):
+    return data == '1'
+
+def _decode_text(data):
+    return data.decode('utf-8')
+
+def _decode_binary(data):
+    return data
+
+def _decode_none(data):
+    return None
+
+def _decode_oidlist(data):
+    if not data:
+        return []
+    return data.split(',')
+
+_decoders = {
+    'pickle': pickle.loads,
+    'int': int,
+    'bool': _decode_bool,
+    'text': _decode_text,
+    'binary': _decode_binary,
+    'none': _decode_none,
+    'float': float,
+    'oidlist': _decode_oidlist,
+}
+
+def decode(dtype, data):
+    """Decode a (datatype, data) pair read from storage."""
+    try:
+        decoder = _decoders[dtype]
+    except KeyError:
+        raise errors.StorageError('unknown data type "%s" while reading node data' % (dtype))
+    return decoder(str(data))
+
+def convert(dtype, data):
+    """Re-encode a stored value using the current encodings.
+
+    Returns a new (datatype, data) pair, or None if the value is already
+    stored using the current encoding.
+    """
+    new_dtype, new_data = encode(decode(dtype, data))
+    if new_dtype == dtype and new_data == str(data):
+        return None
+    return new_dtype, new_data
@@ -2,6 +2,7 @@ import os
 import codecs
 #import MySQLdb
 import pymysql
+import pymysql.cursors
 import struct
 import threading
 import time
@@ -11,12 +12,10 @@ from twisted.enterprise import adbapi
 from twisted.internet import defer
 from twisted.internet import reactor
 
-try:
-    import cPickle as pickle
-except ImportError:
-    import pickle
-
 from siptrackdlib import errors
+from siptrackdlib import interning
+from siptrackdlib.storage import datatypes
+from siptrackdlib.storage import streaming
 
 sqltables = [
         """
@@ -60,6 +59,24 @@ sqltables = [
             primary key (oid, timestamp)
         )
         """,
+        """
+        create table changelog
+        (
+            seq bigint not null primary key,
+            oid varchar(16),
+            origin varchar(32)
+        )
+        """,
+        """
+        create table oidseq
+        (
+            name varchar(32) primary key,
+            value bigint
+        )
+        """,
+        """insert into oidseq (name, value) values ('oid', 0)""",
+        """insert into oidseq (name, value) values ('journal', 0)""",
+        """insert into oidseq (name, value) values ('journal_trim', 0)""",
         """create index nodedata_oid_idx on nodedata (oid)""",
         """create index idmap_oid_idx on idmap (oid)""",
         """create index associations_self_oid_idx on associations (self_oid)""",
@@ -79,6 +96,40 @@ sqltables_1_to_2 = [
         """create index device_config_data_oid_idx on device_config_data (oid)""",
 ]
 
+sqltables_2_to_3 = [
+        """
+        create table changelog
+        (
+            seq bigint not null auto_increment primary key,
+            oid varchar(16),
+            origin varchar(32)
+        )
+        """,
+]
+
+sqltables_3_to_4 = [
+        """
+        create table oidseq
+        (
+            name varchar(32) primary key,
+            value bigint
+        )
+        """,
+        """insert into oidseq (name, value)
+        select 'oid', coalesce(max(cast(oid as unsigned)) + 1, 0) from idmap""",
+        """insert into oidseq (name, value)
+        select 'journal', coalesce(max(seq), 0) from changelog""",
+        """insert into oidseq (name, value) values ('journal_trim', 0)""",
+]
+
+# Max number of oids in a single 'where oid in (...)' batch statement.
+MAX_IN_ARGS = 1000
+
+def _chunks(seq, size):
+    """Split a list into lists of at most size items."""
+    for pos in range(0, len(seq), size):
+        yield seq[pos:pos + size]
+
 class Storage(object):
     def __init__(self, config = None, readonly = False):
         """Load (or create if it doesn't exist) necessary infrastructure."""
@@ -207,8 +258,7 @@ class Storage(object):
     def writeData(self, oid, name, data, txn = None):
         if self.readonly:
             raise errors.StorageError('storage in readonly mode')
-        dtype = 'pickle'
-        data = pickle.dumps(data)
+        dtype, data = datatypes.encode(data)
         qargs = (oid, name, dtype, data)
         q = """replace into nodedata (oid, name, datatype, data) values (%s, %s, %s, %s)"""
         if txn:
@@ -216,6 +266,128 @@ class Storage(object):
         else:
             return self.runOperation(q, qargs)
 
+    def addOIDs(self, rows, txn):
+        """Batched addOID, rows is a list of (parent_oid, oid, class_id)."""
+        if self.readonly:
+            raise errors.StorageError('storage in readonly mode')
+        q = """insert into idmap (parent_oid, oid, class_id) values (%s, %s, %s)"""
+        return self.txndbrunmany(txn, q, rows)
+
+    def removeOIDs(self, oids, txn):
+        """Batched removeOID."""
+        if self.readonly:
+            raise errors.StorageError('storage in readonly mode')
+        for chunk in _chunks(oids, MAX_IN_ARGS):
+            marks = ', '.join(['%s'] * len(chunk))
+            self.txndbrun(txn, """delete from idmap where oid in (%s)""" % (marks), chunk)
+            self.txndbrun(txn, """delete from nodedata where oid in (%s)""" % (marks), chunk)
+            self.txndbrun(txn, """delete from associations where self_oid in (%s)""" % (marks), chunk)
+        return True
+
+    def relocateOIDs(self, rows, txn):
+        """Batched relocate, rows is a list of (oid, new_parent_oid)."""
+        if self.readonly:
+            raise errors.StorageError('storage in readonly mode')
+        q = """update idmap set parent_oid = %s where oid = %s"""
+        return self.txndbrunmany(txn, q, [(parent_oid, oid) for oid, parent_oid in rows])
+
+    def associateMany(self, rows, txn):
+        """Batched associate, rows is a list of (self_oid, other_oid)."""
+        if self.readonly:
+            raise errors.StorageError('storage in readonly mode')
+        q = """insert into associations (self_oid, other_oid) values (%s, %s)"""
+        return self.txndbrunmany(txn, q, rows)
+
+    def disassociateMany(self, rows, txn):
+        """Batched disassociate, rows is a list of (self_oid, other_oid)."""
+        if self.readonly:
+            raise errors.StorageError('storage in readonly mode')
+        q = """delete from associations where self_oid = %s and other_oid = %s"""
+        return self.txndbrunmany(txn, q, rows)
+
+    def writeDataMany(self, rows, txn):
+        """Batched writeData, rows is a list of (oid, name, data).
+
+        pymysql rewrites executemany of a replace into multi-row
+        statements, so this is a handful of round trips at most.
+        """
+        if self.readonly:
+            raise errors.StorageError('storage in readonly mode')
+        qargs = []
+        for oid, name, data in rows:
+            dtype, data = datatypes.encode(data)
+            qargs.append((oid, name, dtype, data))
+        q = """replace into nodedata (oid, name, datatype, data) values (%s, %s, %s, %s)"""
+        return self.txndbrunmany(txn, q, qargs)
+
+    def journalOIDs(self, oids, origin, txn):
+        """Add change journal entries for a list of changed oids.
+
+        origin identifies the object store that made the changes.
+        """
+        if self.readonly:
+            raise errors.StorageError('storage in readonly mode')
+        # Entries are numbered from the journal sequence row. Updating it
+        # locks the row until the transaction is done, so sequence
+        # numbers are handed out in commit order and a reader that has
+        # seen an entry has also seen every entry before it (an
+        # auto_increment seq can become visible out of order).
+        self.txndbrun(txn, """update oidseq set value = value + %s where name = 'journal'""",
+                (len(oids),))
+        txn.execute("""select value from oidseq where name = 'journal'""")
+        first = int(txn.fetchone()[0]) - len(oids) + 1
+        q = """insert into changelog (seq, oid, origin) values (%s, %s, %s)"""
+        return self.txndbrunmany(txn, q, [(first + pos, oid, origin) \
+                for pos, oid in enumerate(oids)])
+
+    def reserveOIDs(self, count):
+        """Reserve a block of count oids.
+
+        Moves the stored oid sequence past the block and returns the
+        first oid in the block.
+        """
+        if self.readonly:
+            raise errors.StorageError('storage in readonly mode')
+        def run(txn):
+            q = """update oidseq set value = value + %s where name = 'oid'"""
+            self.txndbrun(txn, q, (count,))
+            txn.execute("""select value from oidseq where name = 'oid'""")
+            return int(txn.fetchone()[0]) - count
+        return self.runInteraction(run)
+
+    def _runBlocking(self, function):
+        """Run function(cursor) in a transaction on the calling thread.
+
+        The connection is owned by the calling thread. If it has been
+        lost the transaction is retried once on a new connection, like
+        the pool does with cp_reconnect.
+        """
+        retries = 1
+        while True:
+            conn = self.db.connect()
+            try:
+                cursor = conn.cursor()
+                try:
+                    ret = function(cursor)
+                finally:
+                    cursor.close()
+                conn.commit()
+                return ret
+            except (adbapi.ConnectionLost, pymysql.OperationalError) as e:
+                print('Storage DB access failed, reconnecting: %s' % e)
+                self.db.disconnect(conn)
+                if retries < 1:
+                    raise
+                retries -= 1
+            except:
+                exc_info = sys.exc_info()
+                try:
+                    conn.rollback()
+                except Exception:
+                    self.db.disconnect(conn)
+                # Re-raise the original error, not one from the rollback.
+                raise exc_info[0], exc_info[1], exc_info[2]
+
     def removeData(self, oid, name):
         if self.readonly:
             raise errors.StorageError('storage in readonly mode')
@@ -241,6 +413,11 @@ class Storage(object):
         q = """select parent_oid, oid from idmap order by parent_oid"""
         return self.runQuery(q)
 
+    def listOIDMap(self):
+        """Return (parent_oid, oid, class_id) rows for all oids."""
+        q = """select parent_oid, oid, class_id from idmap order by parent_oid"""
+        return self.runQuery(q)
+
     def listOIDClasses(self):
         q = """select oid, class_id from idmap"""
         return self.runQuery(q)
@@ -249,6 +426,128 @@ class Storage(object):
         q = """select self_oid, other_oid from associations"""
         return self.runQuery(q)
 
+    @defer.inlineCallbacks
+    def getJournalSeq(self):
+        """Return the sequence number of the latest change journal entry."""
+        res = yield self._fetchSingle("""select value from oidseq where name = 'journal'""")
+        if res is None:
+            res = 0
+        defer.returnValue(int(res))
+
+    @defer.inlineCallbacks
+    def getJournalTrimSeq(self):
+        """Return the sequence number the change journal is trimmed up to.
+
+        Entries up to and including it have been removed, see trimJournal.
+        """
+        res = yield self._fetchSingle("""select value from oidseq where name = 'journal_trim'""")
+        if res is None:
+            res = 0
+        defer.returnValue(int(res))
+
+    def trimJournal(self, seq):
+        """Remove the change journal entries up to and including seq."""
+        if self.readonly:
+            raise errors.StorageError('storage in readonly mode')
+        def run(txn):
+            self.txndbrun(txn, """delete from changelog where seq <= %s""", (seq,))
+            self.txndbrun(txn, """update oidseq set value = %s where name = 'journal_trim' and value < %s""",
+                    (seq, seq))
+        return self.runInteraction(run)
+
+    def listJournal(self, seq):
+        """Return (seq, oid, origin) journal rows newer than seq, in order."""
+        q = """select seq, oid, origin from changelog where seq > %s order by seq"""
+        return self.runQuery(q, (seq,))
+
+    def _selectForOIDs(self, q, oids, repeat = 1):
+        """Run the select q for a list of oids and return all rows.
+
+        q is run once per chunk of oids, each of its repeat '%s'
+        placeholders is replaced with the parameter marks for the chunk.
+        """
+        def run(txn):
+            rows = []
+            for chunk in _chunks(list(oids), MAX_IN_ARGS):
+                marks = ', '.join(['%s'] * len(chunk))
+                txn.execute(q % ((marks,) * repeat), chunk * repeat)
+                rows.extend(txn.fetchall())
+            return rows
+        return self.runInteraction(run)
+
+    def getOIDMapRows(self, oids):
+        """Return (parent_oid, oid, class_id) rows for a list of oids."""
+        q = """select parent_oid, oid, class_id from idmap where oid in (%s)"""
+        return self._selectForOIDs(q, oids)
+
+    def getAssociationRows(self, oids):
+        """Return (self_oid, other_oid) rows involving any of oids."""
+        q = """select self_oid, other_oid from associations
+            where self_oid in (%s) or other_oid in (%s)"""
+        return self._selectForOIDs(q, oids, 2)
+
+    @defer.inlineCallbacks
+    def getOIDData(self, oids):
+        """Return node data for a list of oids, in the makeOIDData format."""
+        q = """select oid, name, datatype, data from nodedata where oid in (%s)"""
+        res = yield self._selectForOIDs(q, oids)
+        data_mapping = {}
+        for oid, name, dtype, data in res:
+            oid = interning.intern_id(oid)
+            if oid not in data_mapping:
+                data_mapping[oid] = {}
+            data_mapping[oid][interning.intern_id(name)] = self._parseReadData(dtype, data)
+        defer.returnValue(data_mapping)
+
+    def readOIDDataBlocking(self, oids):
+        """Return node data for a list of oids, read synchronously.
+
+        Returns a dict mapping each oid to its node data dict (empty
+        for oids without data). The query runs on a connection owned by
+        the calling thread (not one of the pool threads) and blocks it
+        until done. Used to load nodes on access (see root.NodeCache)
+        where there is no deferred to wait for, callers pass several
+        oids at once to save round trips.
+        """
+        q = """select oid, name, datatype, data from nodedata where oid in (%s)"""
+        def run(cursor):
+            rows = []
+            for chunk in _chunks(list(oids), MAX_IN_ARGS):
+                cursor.execute(q % (', '.join(['%s'] * len(chunk))), chunk)
+                rows.extend(cursor.fetchall())
+            return rows
+        # Ending the transaction doesn't leave a read snapshot open.
+        rows = self._runBlocking(run)
+        data_mapping = {}
+        for oid in oids:
+            data_mapping[oid] = {}
+        for oid, name, dtype, value in rows:
+            data_mapping[oid][interning.intern_id(name)] = self._parseReadData(dtype, value)
+        return data_mapping
+
+    def getOIDDataPage(self, after_oid, limit):
+        """Return a page of (oid, name, datatype, data) node data rows.
+
+        Rows are ordered by oid and start after after_oid. A page holds
+        around limit rows, all rows for an oid are always returned in
+        the same page. An empty page means there is no more data.
+        Reading node data a page at a time keeps each transaction short.
+        """
+        def run(txn):
+            q = """select oid, name, datatype, data from nodedata
+                where oid > %s order by oid limit %s"""
+            txn.execute(q, (after_oid, limit))
+            rows = list(txn.fetchall())
+            if len(rows) == limit:
+                last_oid = rows[-1][0]
+                while rows and rows[-1][0] == last_oid:
+                    rows.pop()
+                q = """select oid, name, datatype, data from nodedata where oid = %s"""
+                txn.execute(q, (last_oid,))
+                rows.extend(txn.fetchall())
+            return rows
+        return self.runInteraction(run)
+
     def dataExists(self, oid, name):
         q = """select oid from nodedata where oid=%s and name=%s limit 1"""
         res = yield self.runQuery(q, (oid, name))
@@ -257,11 +556,7 @@ class Storage(object):
         defer.returnValue(False)
 
     def _parseReadData(self, dtype, data):
-        if dtype == 'pickle':
-            data = pickle.loads(str(data))
-        else:
-            raise errors.StorageError('unknown data type "%s" while reading node data' % (dtype))
-        return data
+        return datatypes.decode(dtype, data)
 
     @defer.inlineCallbacks
     def readData(self, oid, name):
@@ -281,13 +576,33 @@ class Storage(object):
             txn.execute(q)
             for oid, name, dtype, data in txn:
                 data = self._parseReadData(dtype, data)
+                oid = interning.intern_id(oid)
                 if oid not in data_mapping:
                     data_mapping[oid] = {}
-                data_mapping[oid][name] = data
+                data_mapping[oid][interning.intern_id(name)] = data
             return data_mapping
         ret = yield self.runInteraction(run)
         defer.returnValue(ret)
 
+    def streamOIDData(self, callback, batch_size = 1000):
+        """Stream all node data to callback, grouped by oid.
+
+        A low memory alternative to makeOIDData, see
+        streaming.stream_grouped_rows for how callback is called.
+        Uses a server side cursor so the result set is never held in
+        memory on our side.
+        """
+        def run(txn):
+            q = """select oid, name, datatype, data from nodedata order by oid"""
+            cursor = txn._connection.cursor(pymysql.cursors.SSCursor)
+            try:
+                cursor.execute(q)
+                return streaming.stream_grouped_rows(cursor, callback,
+                        batch_size)
+            finally:
+                cursor.close()
+        return self.runInteraction(run)
+
     def addDeviceConfigData(self, oid, data, timestamp):
         if self.readonly:
             raise errors.StorageError('storage in readonly mode')
@@ -346,6 +661,42 @@ class Storage(object):
         q = """select count(*) from device_config_data where oid = %s"""
         return self._fetchSingle(q, (oid,))
 
+    @defer.inlineCallbacks
+    def convertDataTypes(self, batch_size = 5000):
+        """Rewrite legacy pickled node data using the compact datatypes.
+
+        Rows are converted in batches of batch_size, one transaction per
+        batch. Values that have no compact datatype are left pickled.
+        """
+        if self.readonly:
+            raise errors.StorageError('storage in readonly mode')
+        def run(txn, last_key):
+            q = """select oid, name, datatype, data from nodedata
+                where datatype = 'pickle' and (oid > %s or (oid = %s and name > %s))
+                order by oid, name limit %s"""
+            txn.execute(q, (last_key[0], last_key[0], last_key[1], batch_size))
+            rows = txn.fetchall()
+            updates = []
+            for oid, name, dtype, data in rows:
+                converted = datatypes.convert(dtype, data)
+                if converted:
+                    new_dtype, new_data = converted
+                    updates.append((new_dtype, new_data, oid, name))
+            q = """update nodedata set datatype = %s, data = %s where oid = %s and name = %s"""
+            if updates:
+                txn.executemany(q, updates)
+            last_key = None
+            if len(rows) == batch_size:
+                last_key = (rows[-1][0], rows[-1][1])
+            return last_key, len(updates)
+        last_key = ('', '')
+        converted = 0
+        while last_key:
+            last_key, count = yield self.runInteraction(run, last_key)
+            converted += count
+        print 'Converted %d node data values' % (converted)
+        defer.returnValue(converted)
+
     @defer.inlineCallbacks
     def _upgrade1to2(self):
         print 'DB upgrade version 1 -> 2'
@@ -353,6 +704,20 @@ class Storage(object):
             yield self.runOperation(table)
         yield self.setVersion('2')
 
+    @defer.inlineCallbacks
+    def _upgrade2to3(self):
+        print 'DB upgrade version 2 -> 3'
+        for table in sqltables_2_to_3:
+            yield self.runOperation(table)
+        yield self.setVersion('3')
+
+    @defer.inlineCallbacks
+    def _upgrade3to4(self):
+        print 'DB upgrade version 3 -> 4'
+        for table in sqltables_3_to_4:
+            yield self.runOperation(table)
+        yield self.setVersion('4')
+
     @defer.inlineCallbacks
     def upgrade(self):
         self.db = adbapi.ConnectionPool(
@@ -366,10 +731,18 @@ class Storage(object):
         version = str(version)
         if version == '1':
             yield self._upgrade1to2()
+            yield self._upgrade2to3()
+            yield self._upgrade3to4()
         elif version == '2':
+            yield self._upgrade2to3()
+            yield self._upgrade3to4()
+        elif version == '3':
+            yield self._upgrade3to4()
+        elif version == '4':
             pass
         else:
             raise errors.StorageError('unknown storage version %s' % (version))
+        yield self.convertDataTypes()
         defer.returnValue(True)
 
     @defer.inlineCallbacks
@@ -450,12 +823,18 @@ class Storage(object):
         defer.returnValue(ret)
 
     def txndbrun(self, txn, *args, **kwargs):
+        return self._txnretry(txn.execute, *args, **kwargs)
+
+    def txndbrunmany(self, txn, *args, **kwargs):
+        return self._txnretry(txn.executemany, *args, **kwargs)
+
+    def _txnretry(self, function, *args, **kwargs):
         ret = None
         retries = 3
         while True:
             try:
 #                print('TXNDBRUN', args, kwargs)
-                ret = txn.execute(*args, **kwargs)
+                ret = function(*args, **kwargs)
             except (adbapi.ConnectionLost, pymysql.OperationalError) as e:
                 print('Storage DB access failed, retrying: %s' % e)
                 if retries < 1:
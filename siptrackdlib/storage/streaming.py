@@ -0,0 +1,54 @@
+"""Helpers for streaming node data out of storage.
+
+Used by the storage backends streamOIDData methods, which run in a
+database thread and hand node data back to the reactor thread in
+batches.
+"""
+
+from twisted.internet import reactor
+from twisted.internet import threads
+
+from siptrackdlib.storage import datatypes
+from siptrackdlib import interning
+
+def group_rows(rows):
+    """Group (oid, name, datatype, data) rows by oid.
+
+    rows must be ordered by oid. Yields (oid, data) pairs, where data is
+    a dict of name -> decoded value. Oids and names are interned.
+    """
+    decode = datatypes.decode
+    cur_oid = None
+    cur_data = None
+    for oid, name, dtype, data in rows:
+        if oid != cur_oid:
+            if cur_data is not None:
+                yield cur_oid, cur_data
+            cur_oid = interning.intern_id(oid)
+            cur_data = {}
+        cur_data[interning.intern_id(name)] = decode(dtype, data)
+    if cur_data is not None:
+        yield cur_oid, cur_data
+
+def stream_grouped_rows(rows, callback, batch_size):
+    """Group (oid, name, datatype, data) rows by oid and pass them on.
+
+    rows must be ordered by oid. callback is called in the reactor
+    thread with a list of at most batch_size (oid, data) pairs, where
+    data is a dict of name -> decoded value. The calling (database)
+    thread blocks until callback has returned, so only a single batch
+    of decoded data exists at any time.
+
+    Returns the number of oids streamed.
+    """
+    batch = []
+    count = 0
+    for item in group_rows(rows):
+        batch.append(item)
+        count += 1
+        if len(batch) >= batch_size:
+            threads.blockingCallFromThread(reactor, callback, batch)
+            batch = []
+    if batch:
+        threads.blockingCallFromThread(reactor, callback, batch)
+    return count
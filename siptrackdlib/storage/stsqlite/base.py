@@ -7,12 +7,10 @@ import threading
 from twisted.enterprise import adbapi
 from twisted.internet import defer
 
-try:
-    import cPickle as pickle
-except ImportError:
-    import pickle
-
 from siptrackdlib import errors
+from siptrackdlib import interning
+from siptrackdlib.storage import datatypes
+from siptrackdlib.storage import streaming
 
 sqltables = [
         """
@@ -55,6 +53,24 @@ sqltables = [
             UNIQUE (oid, timestamp)
         )
         """,
+        """
+        create table changelog
+        (
+            seq integer primary key,
+            oid varchar(16),
+            origin varchar(32)
+        )
+        """,
+        """
+        create table oidseq
+        (
+            name varchar(32) primary key,
+            value bigint
+        )
+        """,
+        """insert into oidseq (name, value) values ('oid', 0)""",
+        """insert into oidseq (name, value) values ('journal', 0)""",
+        """insert into oidseq (name, value) values ('journal_trim', 0)""",
         """create index nodedata_oid_idx on nodedata (oid)""",
         """create index idmap_oid_idx on idmap (oid)""",
         """create index associations_self_oid_idx on associations (self_oid)""",
@@ -74,18 +90,139 @@ sqltables_1_to_2 = [
         """create index device_config_data_oid_idx on device_config_data (oid)""",
 ]
 
+sqltables_2_to_3 = [
+        """
+        create table changelog
+        (
+            seq integer primary key autoincrement,
+            oid varchar(16),
+            origin varchar(32)
+        )
+        """,
+]
+
+sqltables_3_to_4 = [
+        """
+        create table oidseq
+        (
+            name varchar(32) primary key,
+            value bigint
+        )
+        """,
+        """insert into oidseq (name, value)
+        select 'oid', coalesce(max(cast(oid as integer)) + 1, 0) from idmap""",
+        """insert into oidseq (name, value)
+        select 'journal', coalesce(max(seq), 0) from changelog""",
+        """insert into oidseq (name, value) values ('journal_trim', 0)""",
+]
+
+# Max number of oids in a single 'where oid in (...)' batch statement,
+# sqlite has a default limit of 999 variables per statement.
+MAX_IN_ARGS = 500
+
+def _chunks(seq, size):
+    """Split a list into lists of at most size items."""
+    for pos in range(0, len(seq), size):
+        yield seq[pos:pos + size]
+
+# Allowed values for the synchronous and temp_store pragmas.
+SYNCHRONOUS_MODES = ['off', 'normal', 'full', 'extra', '0', '1', '2', '3']
+TEMP_STORE_MODES = ['default', 'file', 'memory', '0', '1', '2']
+# Default number of connections in the reader pool in wal mode.
+DEFAULT_READERS = 4
+
+def _get_option(config, name, default = None):
+    if config.has_option('sqlite', name):
+        return config.get('sqlite', name)
+    return default
+
+def _get_int_option(config, name, default = None):
+    value = _get_option(config, name, default)
+    if value is None:
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        raise errors.StorageError('invalid sqlite %s value: %s' % (name, value))
+
 class Storage(object):
+    """sqlite storage.
+
+    The following options are read from the [sqlite] config section:
+      filename: the database file.
+      wal: use write-ahead logging. Writes go through a single
+          connection writer pool and reads through a separate reader
+          pool, so reads no longer wait for commits and the other way
+          around.
+      readers: number of reader connections in wal mode.
+      synchronous, cache_size, mmap_size, temp_store: set the sqlite
+          pragmas of the same names for every connection. synchronous
+          defaults to normal in wal mode.
+    """
     def __init__(self, config = None, readonly = False):
         """Load (or create if it doesn't exist) necessary infrastructure."""
         self.dbfile = config.get('sqlite', 'filename')
         self.readonly = readonly
+        self.wal = False
+        if config.has_option('sqlite', 'wal'):
+            self.wal = config.getboolean('sqlite', 'wal')
+        self.readers = _get_int_option(config, 'readers', DEFAULT_READERS)
+        self.pragmas = self._makePragmas(config)
+
+    def _makePragmas(self, config):
+        pragmas = []
+        default = None
+        if self.wal:
+            default = 'normal'
+        synchronous = _get_option(config, 'synchronous', default)
+        if synchronous is not None:
+            if synchronous.lower() not in SYNCHRONOUS_MODES:
+                raise errors.StorageError('invalid sqlite synchronous value: %s' % (synchronous))
+            pragmas.append('pragma synchronous = %s' % (synchronous.lower()))
+        for name in ['cache_size', 'mmap_size']:
+            value = _get_int_option(config, name)
+            if value is not None:
+                pragmas.append('pragma %s = %d' % (name, value))
+        temp_store = _get_option(config, 'temp_store')
+        if temp_store is not None:
+            if temp_store.lower() not in TEMP_STORE_MODES:
+                raise errors.StorageError('invalid sqlite temp_store value: %s' % (temp_store))
+            pragmas.append('pragma temp_store = %s' % (temp_store.lower()))
+        return pragmas
+
+    def _setupConnection(self, conn):
+        for pragma in self.pragmas:
+            conn.execute(pragma)
+
+    def _openPools(self):
+        """Open the connection pools.
+
+        self.db is used for writes and self.read_db for reads, without
+        wal they are the same pool. A single writer connection avoids
+        busy errors between concurrent write transactions.
+        """
+        if self.wal:
+            self.db = adbapi.ConnectionPool('sqlite3', self.dbfile,
+                    check_same_thread = False, cp_openfun = self._setupConnection,
+                    cp_min = 1, cp_max = 1)
+            self.read_db = adbapi.ConnectionPool('sqlite3', self.dbfile,
+                    check_same_thread = False, cp_openfun = self._setupConnection,
+                    cp_min = 1, cp_max = self.readers)
+        else:
+            self.db = adbapi.ConnectionPool('sqlite3', self.dbfile,
+                    check_same_thread = False, cp_openfun = self._setupConnection)
+            self.read_db = self.db
 
     @defer.inlineCallbacks
     def initialize(self, version):
         needs_init = False
         if not os.path.exists(self.dbfile):
             needs_init = True
-        self.db = adbapi.ConnectionPool('sqlite3', self.dbfile, check_same_thread = False)
+        self._openPools()
+        if self.wal and not self.readonly:
+            # The journal mode is stored in the database file, readers
+            # (including readonly followers) pick it up from there.
+            yield self.db.runOperation("""pragma journal_mode = wal""")
         if needs_init:
             if self.readonly:
                 raise errors.StorageError('storage in readonly mode')
@@ -98,7 +235,7 @@ class Storage(object):
 
     @defer.inlineCallbacks
     def _fetchSingle(self, *args, **kwargs):
-        res = yield self.db.runQuery(*args, **kwargs)
+        res = yield self.read_db.runQuery(*args, **kwargs)
         ret = None
         if len(res) == 1:
             ret = res[0][0]
@@ -180,13 +317,93 @@ class Storage(object):
             op = txn.execute
         else:
             op = self.db.runOperation
-        dtype = 'pickle'
-        data = pickle.dumps(data)
+        dtype, data = datatypes.encode(data)
         data = sqlite.Binary(data)
         qargs = (oid, name, dtype, data)
         q = """replace into nodedata (oid, name, datatype, data) values (?, ?, ?, ?)"""
         return op(q, qargs)
 
+    def addOIDs(self, rows, txn):
+        """Batched addOID, rows is a list of (parent_oid, oid, class_id)."""
+        if self.readonly:
+            raise errors.StorageError('storage in readonly mode')
+        q = """insert into idmap (parent_oid, oid, class_id) values (?, ?, ?)"""
+        txn.executemany(q, rows)
+
+    def removeOIDs(self, oids, txn):
+        """Batched removeOID."""
+        if self.readonly:
+            raise errors.StorageError('storage in readonly mode')
+        for chunk in _chunks(oids, MAX_IN_ARGS):
+            marks = ', '.join(['?'] * len(chunk))
+            txn.execute("""delete from idmap where oid in (%s)""" % (marks), chunk)
+            txn.execute("""delete from nodedata where oid in (%s)""" % (marks), chunk)
+            txn.execute("""delete from associations where self_oid in (%s)""" % (marks), chunk)
+
+    def relocateOIDs(self, rows, txn):
+        """Batched relocate, rows is a list of (oid, new_parent_oid)."""
+        if self.readonly:
+            raise errors.StorageError('storage in readonly mode')
+        q = """update idmap set parent_oid = ? where oid = ?"""
+        txn.executemany(q, [(parent_oid, oid) for oid, parent_oid in rows])
+
+    def associateMany(self, rows, txn):
+        """Batched associate, rows is a list of (self_oid, other_oid)."""
+        if self.readonly:
+            raise errors.StorageError('storage in readonly mode')
+        q = """insert into associations (self_oid, other_oid) values (?, ?)"""
+        txn.executemany(q, rows)
+
+    def disassociateMany(self, rows, txn):
+        """Batched disassociate, rows is a list of (self_oid, other_oid)."""
+        if self.readonly:
+            raise errors.StorageError('storage in readonly mode')
+        q = """delete from associations where self_oid = ? and other_oid = ?"""
+        txn.executemany(q, rows)
+
+    def writeDataMany(self, rows, txn):
+        """Batched writeData, rows is a list of (oid, name, data)."""
+        if self.readonly:
+            raise errors.StorageError('storage in readonly mode')
+        qargs = []
+        for oid, name, data in rows:
+            dtype, data = datatypes.encode(data)
+            qargs.append((oid, name, dtype, sqlite.Binary(data)))
+        q = """replace into nodedata (oid, name, datatype, data) values (?, ?, ?, ?)"""
+        txn.executemany(q, qargs)
+
+    def journalOIDs(self, oids, origin, txn):
+        """Add change journal entries for a list of changed oids.
+
+        origin identifies the object store that made the changes.
+        """
+        if self.readonly:
+            raise errors.StorageError('storage in readonly mode')
+        # Number entries from the journal sequence row, the same way as
+        # the mysql storage, so seqs are always handed out in commit order.
+        txn.execute("""update oidseq set value = value + ? where name = 'journal'""",
+                (len(oids),))
+        txn.execute("""select value from oidseq where name = 'journal'""")
+        first = int(txn.fetchone()[0]) - len(oids) + 1
+        q = """insert into changelog (seq, oid, origin) values (?, ?, ?)"""
+        txn.executemany(q, [(first + pos, oid, origin) \
+                for pos, oid in enumerate(oids)])
+
+    def reserveOIDs(self, count):
+        """Reserve a block of count oids.
+
+        Moves the stored oid sequence past the block and returns the
+        first oid in the block.
+        """
+        if self.readonly:
+            raise errors.StorageError('storage in readonly mode')
+        def run(txn):
+            q = """update oidseq set value = value + ? where name = 'oid'"""
+            txn.execute(q, (count,))
+            txn.execute("""select value from oidseq where name = 'oid'""")
+            return int(txn.fetchone()[0]) - count
+        return self.db.runInteraction(run)
+
     def removeData(self, oid, name):
         if self.readonly:
             raise errors.StorageError('storage in readonly mode')
@@ -211,34 +428,161 @@ class Storage(object):
 
     def listOIDs(self):
         q = """select parent_oid, oid from idmap order by parent_oid"""
-        return self.db.runQuery(q)
+        return self.read_db.runQuery(q)
+
+    def listOIDMap(self):
+        """Return (parent_oid, oid, class_id) rows for all oids."""
+        q = """select parent_oid, oid, class_id from idmap order by parent_oid"""
+        return self.read_db.runQuery(q)
 
     def listOIDClasses(self):
         q = """select oid, class_id from idmap"""
-        return self.db.runQuery(q)
+        return self.read_db.runQuery(q)
 
     def listAssociations(self):
         q = """select self_oid, other_oid from associations"""
-        return self.db.runQuery(q)
+        return self.read_db.runQuery(q)
+
+    @defer.inlineCallbacks
+    def getJournalSeq(self):
+        """Return the sequence number of the latest change journal entry."""
+        res = yield self._fetchSingle("""select value from oidseq where name = 'journal'""")
+        if res is None:
+            res = 0
+        defer.returnValue(int(res))
+
+    @defer.inlineCallbacks
+    def getJournalTrimSeq(self):
+        """Return the sequence number the change journal is trimmed up to.
+
+        Entries up to and including it have been removed, see trimJournal.
+        """
+        res = yield self._fetchSingle("""select value from oidseq where name = 'journal_trim'""")
+        if res is None:
+            res = 0
+        defer.returnValue(int(res))
+
+    def trimJournal(self, seq):
+        """Remove the change journal entries up to and including seq."""
+        if self.readonly:
+            raise errors.StorageError('storage in readonly mode')
+        def run(txn):
+            txn.execute("""delete from changelog where seq <= ?""", (seq,))
+            txn.execute("""update oidseq set value = ? where name = 'journal_trim' and value < ?""",
+                    (seq, seq))
+        return self.db.runInteraction(run)
+
+    def listJournal(self, seq):
+        """Return (seq, oid, origin) journal rows newer than seq, in order."""
+        q = """select seq, oid, origin from changelog where seq > ? order by seq"""
+        return self.read_db.runQuery(q, (seq,))
+
+    def _selectForOIDs(self, q, oids, repeat = 1):
+        """Run the select q for a list of oids and return all rows.
+
+        q is run once per chunk of oids, each of its repeat '%s'
+        placeholders is replaced with the parameter marks for the chunk.
+        """
+        def run(txn):
+            rows = []
+            for chunk in _chunks(list(oids), MAX_IN_ARGS):
+                marks = ', '.join(['?'] * len(chunk))
+                txn.execute(q % ((marks,) * repeat), chunk * repeat)
+                rows.extend(txn.fetchall())
+            return rows
+        return self.read_db.runInteraction(run)
+
+    def getOIDMapRows(self, oids):
+        """Return (parent_oid, oid, class_id) rows for a list of oids."""
+        q = """select parent_oid, oid, class_id from idmap where oid in (%s)"""
+        return self._selectForOIDs(q, oids)
+
+    def getAssociationRows(self, oids):
+        """Return (self_oid, other_oid) rows involving any of oids."""
+        q = """select self_oid, other_oid from associations
+            where self_oid in (%s) or other_oid in (%s)"""
+        return self._selectForOIDs(q, oids, 2)
+
+    @defer.inlineCallbacks
+    def getOIDData(self, oids):
+        """Return node data for a list of oids, in the makeOIDData format."""
+        q = """select oid, name, datatype, data from nodedata where oid in (%s)"""
+        res = yield self._selectForOIDs(q, oids)
+        data_mapping = {}
+        for oid, name, dtype, data in res:
+            oid = interning.intern_id(oid)
+            if oid not in data_mapping:
+                data_mapping[oid] = {}
+            data_mapping[oid][interning.intern_id(name)] = self._parseReadData(dtype, data)
+        defer.returnValue(data_mapping)
+
+    def readOIDDataBlocking(self, oids):
+        """Return node data for a list of oids, read synchronously.
+
+        Returns a dict mapping each oid to its node data dict (empty
+        for oids without data). The query runs on a connection owned by
+        the calling thread (not one of the pool threads) and blocks it
+        until done. Used to load nodes on access (see root.NodeCache)
+        where there is no deferred to wait for, callers pass several
+        oids at once to save round trips.
+        """
+        q = """select oid, name, datatype, data from nodedata where oid in (%s)"""
+        conn = self.read_db.connect()
+        cursor = conn.cursor()
+        rows = []
+        try:
+            for chunk in _chunks(list(oids), MAX_IN_ARGS):
+                cursor.execute(q % (', '.join(['?'] * len(chunk))), chunk)
+                rows.extend(cursor.fetchall())
+        finally:
+            cursor.close()
+        # Don't leave a read transaction (snapshot) open. Not done in the
+        # finally clause, an error from it would hide the original one.
+        conn.rollback()
+        data_mapping = {}
+        for oid in oids:
+            data_mapping[oid] = {}
+        for oid, name, dtype, value in rows:
+            data_mapping[oid][interning.intern_id(name)] = self._parseReadData(dtype, value)
+        return data_mapping
+
+    def getOIDDataPage(self, after_oid, limit):
+        """Return a page of (oid, name, datatype, data) node data rows.
+
+        Rows are ordered by oid and start after after_oid. A page holds
+        around limit rows, all rows for an oid are always returned in
+        the same page. An empty page means there is no more data.
+        Reading node data a page at a time keeps each transaction short.
+        """
+        def run(txn):
+            q = """select oid, name, datatype, data from nodedata
+                where oid > ? order by oid limit ?"""
+            txn.execute(q, (after_oid, limit))
+            rows = list(txn.fetchall())
+            if len(rows) == limit:
+                last_oid = rows[-1][0]
+                while rows and rows[-1][0] == last_oid:
+                    rows.pop()
+                q = """select oid, name, datatype, data from nodedata where oid = ?"""
+                txn.execute(q, (last_oid,))
+                rows.extend(txn.fetchall())
+            return rows
+        return self.read_db.runInteraction(run)
 
     def dataExists(self, oid, name):
         q = """select oid from nodedata where oid=? and name=? limit 1"""
-        res = yield self.db.runQuery(q, (oid, name))
+        res = yield self.read_db.runQuery(q, (oid, name))
         if res:
             defer.returnValue(True)
         defer.returnValue(False)
 
     def _parseReadData(self, dtype, data):
-        if dtype == 'pickle':
-            data = pickle.loads(str(data))
-        else:
-            raise errors.StorageError('unknown data type "%s" while reading node data' % (dtype))
-        return data
+        return datatypes.decode(dtype, data)
 
     @defer.inlineCallbacks
     def readData(self, oid, name):
         q = """select datatype, data from nodedata where oid = ? and name = ? limit 1"""
-        res = yield self.db.runQuery(q, (oid, name))
+        res = yield self.read_db.runQuery(q, (oid, name))
         if not res:
             defer.returnValue(None)
         dtype, data = res[0]
@@ -253,13 +597,26 @@ class Storage(object):
             res = txn.execute(q)
             for oid, name, dtype, data in res:
                 data = self._parseReadData(dtype, data)
+                oid = interning.intern_id(oid)
                 if oid not in data_mapping:
                     data_mapping[oid] = {}
-                data_mapping[oid][name] = data
+                data_mapping[oid][interning.intern_id(name)] = data
             return data_mapping
-        ret = yield self.db.runInteraction(run)
+        ret = yield self.read_db.runInteraction(run)
         defer.returnValue(ret)
 
+    def streamOIDData(self, callback, batch_size = 1000):
+        """Stream all node data to callback, grouped by oid.
+
+        A low memory alternative to makeOIDData, see
+        streaming.stream_grouped_rows for how callback is called.
+        """
+        def run(txn):
+            q = """select oid, name, datatype, data from nodedata order by oid"""
+            return streaming.stream_grouped_rows(txn.execute(q), callback,
+                    batch_size)
+        return self.read_db.runInteraction(run)
+
     def addDeviceConfigData(self, oid, data, timestamp):
         if self.readonly:
             raise errors.StorageError('storage in readonly mode')
@@ -272,12 +629,12 @@ class Storage(object):
             q = """select timestamp from device_config_data where oid = ? order by timestamp"""
         else:
             q = """select data, timestamp from device_config_data where oid = ? order by timestamp"""
-        return self.db.runQuery(q, (oid,))
+        return self.read_db.runQuery(q, (oid,))
 
     @defer.inlineCallbacks
     def getLatestDeviceConfigData(self, oid):
         q = """select data, timestamp from device_config_data where oid = ? order by timestamp desc limit 1"""
-        res = yield self.db.runQuery(q, (oid,))
+        res = yield self.read_db.runQuery(q, (oid,))
         if not res:
             defer.returnValue(None)
         data, timestamp = res[0]
@@ -303,7 +660,7 @@ class Storage(object):
     @defer.inlineCallbacks
     def getTimestampDeviceConfigData(self, oid, timestamp):
         q = """select data from device_config_data where oid = ? and timestamp = ? limit 1"""
-        res = yield self.db.runQuery(q, (oid, timestamp))
+        res = yield self.read_db.runQuery(q, (oid, timestamp))
         if not res:
             defer.returnValue(None)
         data = str(res[0][0])
@@ -313,6 +670,42 @@ class Storage(object):
         q = """select count(*) from device_config_data where oid = ?"""
         return self._fetchSingle(q, (oid,))
 
+    @defer.inlineCallbacks
+    def convertDataTypes(self, batch_size = 5000):
+        """Rewrite legacy pickled node data using the compact datatypes.
+
+        Rows are converted in batches of batch_size, one transaction per
+        batch. Values that have no compact datatype are left pickled.
+        """
+        if self.readonly:
+            raise errors.StorageError('storage in readonly mode')
+        def run(txn, last_key):
+            q = """select oid, name, datatype, data from nodedata
+                where datatype = 'pickle' and (oid > ? or (oid = ? and name > ?))
+                order by oid, name limit ?"""
+            txn.execute(q, (last_key[0], last_key[0], last_key[1], batch_size))
+            rows = txn.fetchall()
+            updates = []
+            for oid, name, dtype, data in rows:
+                converted = datatypes.convert(dtype, data)
+                if converted:
+                    new_dtype, new_data = converted
+                    updates.append((new_dtype, sqlite.Binary(new_data), oid, name))
+            q = """update nodedata set datatype = ?, data = ? where oid = ? and name = ?"""
+            if updates:
+                txn.executemany(q, updates)
+            last_key = None
+            if len(rows) == batch_size:
+                last_key = (rows[-1][0], rows[-1][1])
+            return last_key, len(updates)
+        last_key = ('', '')
+        converted = 0
+        while last_key:
+            last_key, count = yield self.db.runInteraction(run, last_key)
+            converted += count
+        print 'Converted %d node data values' % (converted)
+        defer.returnValue(converted)
+
     @defer.inlineCallbacks
     def _upgrade1to2(self):
         print 'DB upgrade version 1 -> 2'
@@ -320,17 +713,39 @@ class Storage(object):
             yield self.db.runOperation(table)
         yield self.setVersion('2')
 
+    @defer.inlineCallbacks
+    def _upgrade2to3(self):
+        print 'DB upgrade version 2 -> 3'
+        for table in sqltables_2_to_3:
+            yield self.db.runOperation(table)
+        yield self.setVersion('3')
+
+    @defer.inlineCallbacks
+    def _upgrade3to4(self):
+        print 'DB upgrade version 3 -> 4'
+        for table in sqltables_3_to_4:
+            yield self.db.runOperation(table)
+        yield self.setVersion('4')
+
     @defer.inlineCallbacks
     def upgrade(self):
         if not os.path.exists(self.dbfile):
             raise errors.StorageError('Unable to perform db upgrade, can\'t find a dbfile')
-        self.db = adbapi.ConnectionPool('sqlite3', self.dbfile, check_same_thread = False)
+        self._openPools()
         version = yield self.getVersion()
         version = str(version)
         if version == '1':
             yield self._upgrade1to2()
+            yield self._upgrade2to3()
+            yield self._upgrade3to4()
         elif version == '2':
+            yield self._upgrade2to3()
+            yield self._upgrade3to4()
+        elif version == '3':
+            yield self._upgrade3to4()
+        elif version == '4':
             pass
         else:
             raise errors.StorageError('unknown storage version %s' % (version))
+        yield self.convertDataTypes()
         defer.returnValue(True)
@@ -4,6 +4,8 @@ from siptrackdlib import errors
 
 class StorageValue(object):
     """Simple wrapper for storage access for a single variable."""
+    __slots__ = ('node', 'oid', 'object_store', 'name', 'value', '_has_value',
+            '_validator_cb', 'cache_value')
     _write_none = False
 
     def __init__(self, node, name, value = None, validator = None, cache_value = True):
@@ -46,6 +48,7 @@ class StorageValue(object):
 
         Both locally and in storage.
         """
+        self.node.object_store.checkWritable()
         self._validator(value)
         # Don't write anything if the Value is None.
         if value is None and not self._write_none:
@@ -106,6 +109,7 @@ class StorageValue(object):
                 self.value = self._getValue(self.value)
 
 class StorageNode(StorageValue):
+    __slots__ = ()
     _write_none = True
 
     def get(self):
@@ -149,18 +153,24 @@ class StorageNode(StorageValue):
         super(StorageNode, self)._validator(value)
 
 class StorageText(StorageValue):
+    __slots__ = ()
+
     def _validator(self, value):
         if type(value) not in [str, unicode]:
             raise errors.SiptrackError('invalid value for type StorageText')
         super(StorageText, self)._validator(value)
 
 class StorageNum(StorageValue):
+    __slots__ = ()
+
     def _validator(self, value):
         if type(value) not in [int, long]:
             raise errors.SiptrackError('invalid value for type StorageNum')
         super(StorageNum, self)._validator(value)
 
 class StorageNumPositive(StorageValue):
+    __slots__ = ()
+
     def _validator(self, value):
         if type(value) not in [int, long]:
             raise errors.SiptrackError('invalid value for type StorageNumPositive')
@@ -169,12 +179,16 @@ class StorageNumPositive(StorageValue):
         super(StorageNumPositive, self)._validator(value)
 
 class StorageBool(StorageValue):
+    __slots__ = ()
+
     def _validator(self, value):
         if type(value) not in [bool]:
             raise errors.SiptrackError('invalid value for type StorageBool')
         super(StorageBool, self)._validator(value)
 
 class StorageNodeList(StorageValue):
+    __slots__ = ()
+
     def get(self):
         """Special get for storage node lists.
 
@@ -224,3 +238,312 @@ class StorageNodeList(StorageValue):
                 raise errors.SiptrackError('invalid value for type StorageNodeList')
         super(StorageNodeList, self)._validator(value)
 
+
+# Marks a field that has no locally held value in a nodes value list.
+UNSET = object()
+
+def field_layout(cls):
+    """Return the {field: index} layout of the storage fields of cls.
+
+    Every Field declared on cls or one of its bases is given an index in
+    the nodes value list. The layout is built once per class.
+    """
+    layout = cls.__dict__.get('_field_layout')
+    if layout is None:
+        layout = {}
+        for klass in reversed(cls.__mro__):
+            for value in klass.__dict__.itervalues():
+                if isinstance(value, Field) and value not in layout:
+                    layout[value] = len(layout)
+        cls._field_layout = layout
+    return layout
+
+class Field(object):
+    """Descriptor version of StorageValue.
+
+    A StorageValue is created for every field of every node and holds
+    its own references to the node, oid and object store. A Field is
+    declared once on the node class instead:
+
+        class Permission(treenodes.BaseNode):
+            read_access = storagevalue.BoolField('read_access')
+
+    The values of all fields of a node are kept in a single list,
+    node._field_values, laid out per class by field_layout. Accessing
+    the field on a node returns a BoundField that supports the same
+    get/set/commit/preload calls as a StorageValue, initial values are
+    passed in with init.
+
+    validator is the name of a node method that is called with values
+    about to be written, changed the name of a node method that is
+    called with values once they have been set. cache_value is the same
+    as for StorageValue.
+    """
+    _write_none = False
+
+    def __init__(self, name, validator = None, cache_value = True,
+            changed = None):
+        self.name = name
+        self.validator = validator
+        self.cache_value = cache_value
+        self.changed = changed
+
+    def __get__(self, node, owner):
+        if node is None:
+            return self
+        return BoundField(self, node)
+
+    def __set__(self, node, value):
+        raise AttributeError('use .set() or .init() to change storage field %s' % (self.name))
+
+    def _values(self, node):
+        """Return the value list and our index in it for node."""
+        layout = field_layout(type(node))
+        values = node._field_values
+        if values is None:
+            values = node._field_values = [UNSET] * len(layout)
+        return values, layout[self]
+
+    def _setValue(self, node, value):
+        """Prepare value for writing to storage.
+
+        This does nothing here, subclasses may override where necessary.
+        """
+        return value
+
+    def _getValue(self, node, value):
+        """Parse value after having read from storage.
+
+        This does nothing here, subclasses may override where necessary.
+        """
+        return value
+
+    def _validator(self, node, value):
+        """Validate a value that is about to be written to storage (set).
+
+        Calls the nodes validator method if one was given.
+        """
+        if self.validator:
+            getattr(node, self.validator)(value)
+
+    def init(self, node, value):
+        """Set the local value without writing it to storage.
+
+        A value of None is ignored, like for a new StorageValue.
+        """
+        if value is not None:
+            values, index = self._values(node)
+            values[index] = value
+
+    def peek(self, node):
+        """Return the local value, None if there is none."""
+        values, index = self._values(node)
+        value = values[index]
+        if value is UNSET:
+            return None
+        return value
+
+    def set(self, node, value):
+        node.object_store.checkWritable()
+        self._validator(node, value)
+        # Don't write anything if the Value is None.
+        if value is None and not self._write_none:
+            return
+        node.storageAction('write_data', {'name': self.name,
+            'value': self._setValue(node, value)})
+        node.setModified()
+        values, index = self._values(node)
+        if self.cache_value:
+            values[index] = value
+        else:
+            values[index] = UNSET
+        if self.changed:
+            getattr(node, self.changed)(value)
+
+    def get(self, node):
+        values, index = self._values(node)
+        value = values[index]
+        if value is not UNSET:
+            return value
+        if self.cache_value:
+            # Stays None until a storage read has returned.
+            values[index] = None
+        value = node.object_store.storage.readData(node.oid, self.name)
+        if isinstance(value, defer.Deferred):
+            value.addCallback(self._cbGet, node)
+            return value
+        return self._cbGet(value, node)
+
+    def _cbGet(self, value, node):
+        value = self._getValue(node, value)
+        if self.cache_value:
+            values, index = self._values(node)
+            values[index] = value
+        return value
+
+    def commit(self, node):
+        self.set(node, self.peek(node))
+
+    def preload(self, node, data):
+        if data is not None and self.cache_value:
+            values, index = self._values(node)
+            if self.name in data:
+                values[index] = self._getValue(node, data[self.name])
+            elif values[index] is UNSET:
+                values[index] = None
+
+class BoundField(object):
+    """A Field bound to a node, returned when accessing the field."""
+    __slots__ = ('field', 'node')
+
+    def __init__(self, field, node):
+        self.field = field
+        self.node = node
+
+    def get(self):
+        """Return the value.
+
+        Load from storage if necessary.
+        """
+        return self.field.get(self.node)
+
+    def set(self, value):
+        """Set the value.
+
+        Both locally and in storage.
+        """
+        self.field.set(self.node, value)
+
+    def init(self, value):
+        """Set the initial value without writing it to storage."""
+        self.field.init(self.node, value)
+
+    def commit(self):
+        """Save the locally stored value to storage."""
+        self.field.commit(self.node)
+
+    def preload(self, data):
+        """Load existing storage data that is passed in."""
+        self.field.preload(self.node, data)
+
+    @property
+    def value(self):
+        """The locally held value, None if there is none."""
+        return self.field.peek(self.node)
+
+class NodeField(Field):
+    _write_none = True
+
+    def get(self, node):
+        """Special get for storage nodes.
+
+        Check if the value (node) is cached but has been deleted.
+        If it has, return None instead of an invalid node.
+        """
+        value = super(NodeField, self).get(node)
+        if isinstance(value, defer.Deferred):
+            value.addCallback(self._cbGetNode, node)
+            return value
+        if value and value.oid is None:
+            value = None
+        return value
+
+    def _cbGetNode(self, value, node):
+        if value and value.oid is None:
+            if self.cache_value:
+                values, index = self._values(node)
+                values[index] = None
+            value = None
+        return value
+
+    def _getValue(self, node, value):
+        """Tries to load a node from an oid."""
+        try:
+            value = node.object_store.getOID(value)
+        except errors.NonExistent:
+            value = None
+        return value
+
+    def _setValue(self, node, value):
+        if value is None:
+            return None
+        return value.oid
+
+    def _validator(self, node, value):
+        # Allow None for storing no storage node.
+        if value is None:
+            return
+        if not hasattr(value, 'oid'):
+            raise errors.SiptrackError('invalid value for type NodeField')
+        super(NodeField, self)._validator(node, value)
+
+class TextField(Field):
+    def _validator(self, node, value):
+        if type(value) not in [str, unicode]:
+            raise errors.SiptrackError('invalid value for type TextField')
+        super(TextField, self)._validator(node, value)
+
+class NumField(Field):
+    def _validator(self, node, value):
+        if type(value) not in [int, long]:
+            raise errors.SiptrackError('invalid value for type NumField')
+        super(NumField, self)._validator(node, value)
+
+class NumPositiveField(Field):
+    def _validator(self, node, value):
+        if type(value) not in [int, long] or value < 0:
+            raise errors.SiptrackError('invalid value for type NumPositiveField')
+        super(NumPositiveField, self)._validator(node, value)
+
+class BoolField(Field):
+    def _validator(self, node, value):
+        if type(value) not in [bool]:
+            raise errors.SiptrackError('invalid value for type BoolField')
+        super(BoolField, self)._validator(node, value)
+
+class NodeListField(Field):
+    def get(self, node):
+        """Special get for storage node lists.
+
+        Check if any of the cached nodes are missing (have been deleted
+        while in our cache). Remove them from the list if they have.
+        """
+        value = super(NodeListField, self).get(node)
+        if isinstance(value, defer.Deferred):
+            value.addCallback(self._parseValue, node)
+            return value
+        return self._parseValue(value, node)
+
+    def _parseValue(self, value, node):
+        missing = []
+        if value:
+            for item in value:
+                if item.oid is None or item.removed:
+                    missing.append(item)
+        if len(missing) > 0:
+            for item in missing:
+                value.remove(item)
+            self.set(node, value)
+            node.setModified()
+        return value
+
+    def _getValue(self, node, value):
+        """Tries to load a node from an oid."""
+        ret = []
+        for oid in value:
+            try:
+                ret.append(node.object_store.getOID(oid))
+            except errors.NonExistent:
+                pass
+        return ret
+
+    def _setValue(self, node, value):
+        return [item.oid for item in value]
+
+    def _validator(self, node, value):
+        if type(value) != list:
+            raise errors.SiptrackError('invalid value for type NodeListField')
+        for item in value:
+            if not hasattr(item, 'oid'):
+                raise errors.SiptrackError('invalid value for type NodeListField')
+        super(NodeListField, self)._validator(node, value)
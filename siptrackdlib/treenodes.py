@@ -6,28 +6,306 @@ from siptrackdlib import storagevalue
 from siptrackdlib import log
 from siptrackdlib.objectregistry import object_registry
 
-class PermissionCache(object):
-    def __init__(self):
-        self.cache = {}
+# Number of invalidations kept in PermissionCache.history.
+PERM_CACHE_HISTORY = 10
 
-    def clear(self):
-        self.cache = {}
+# Where PermissionCache looks for user groups.
+USER_MANAGER_CLASSES = ['user manager local', 'user manager ldap',
+        'user manager active directory']
+GROUP_CLASSES = ['user group', 'user group ldap',
+        'user group active directory']
 
-    def init(self, node):
-        if node.oid not in self.cache:
-            self.cache[node.oid] = []
+_missing = object()
 
-    def add(self, node, perm):
-        self.init(node)
-        self.cache[node.oid].append(perm)
+class PermissionSet(object):
+    """The permissions of a node that has permission children.
 
-    def cached(self, node):
-        return node.oid in self.cache
+    own is the permission children of the node, inherited the recursive
+    ones among them (which apply to the nodes below as well) and parent
+    the PermissionSet of the nearest parent node that has permission
+    children, or None.
 
-    def get(self, node):
-        if node.oid in self.cache:
-            return self.cache[node.oid]
-        return []
+    readable caches read access per user, {(user oid, own): bool}, own
+    being True for the node itself and False for the nodes below it
+    that share the set. It is only valid for the PermissionCache
+    generation it was filled in.
+    """
+    __slots__ = ('oid', 'own', 'inherited', 'parent', 'readable',
+            'generation')
+
+    def __init__(self, oid, own, parent):
+        self.oid = oid
+        self.own = own
+        self.inherited = tuple(perm for perm in own if perm.recursive.get())
+        self.parent = parent
+        self.readable = {}
+        self.generation = None
+
+    def permissions(self, own):
+        """Iterate over the permissions that apply, in order.
+
+        own is True for the node the set belongs to, False for the
+        nodes below it.
+        """
+        entry = self
+        if own:
+            for perm in entry.own:
+                yield perm
+            entry = entry.parent
+        while entry is not None:
+            for perm in entry.inherited:
+                yield perm
+            entry = entry.parent
+
+class PermissionCache(object):
+    """Index of the permissions that apply to nodes.
+
+    The permissions that apply to a node are its own permission
+    children followed by the recursive permission children of each of
+    its parents, nearest first. Nodes with permission children get a
+    PermissionSet, every other node just points to the PermissionSet
+    of its nearest parent with permission children (self.entries maps
+    oids to PermissionSets or None), so nothing is copied per node.
+
+    Entries are built on demand, a node is only added once all its
+    parents have been. So when a node isn't in the cache neither is
+    anything below it, invalidate uses that to only visit the cached
+    part of a subtree.
+
+    self.history keeps the last PERM_CACHE_HISTORY invalidations with
+    the number of entries dropped and the number of entries (and time
+    spent) rebuilding them since, see asDict.
+
+    The cache also answers whether a permission matches a user, see
+    matchesUser. Group memberships are indexed by user (built on first
+    use) and kept up to date by the user groups through groupChanged,
+    match results are cached per user and permission.
+
+    Read access is cached per user in the PermissionSets (see
+    readable), so all nodes sharing a set, usually whole subtrees, are
+    checked once per user. Changes to group memberships or users bump
+    self.generation, which makes all those results stale at once.
+    """
+    def __init__(self):
+        self.entries = {}
+        # Permission oid -> oid of the node it was cached for.
+        self.owners = {}
+        # User oid -> frozenset of the oids of the groups it is in.
+        self.member_groups = None
+        # Group oid -> frozenset of the oids of its users.
+        self.group_members = None
+        # User oid -> {permission oid: True/False}.
+        self.matches = {}
+        self.generation = 0
+        self.invalidations = 0
+        self.dropped = 0
+        self.built = 0
+        self.build_time = 0.0
+        self.history = []
+
+    def _invalidated(self, oid, dropped, elapsed):
+        self.invalidations += 1
+        self.dropped += dropped
+        self.history.append({'oid': oid or '', 'dropped': dropped,
+            'time': elapsed, 'rebuilt': 0, 'rebuild_time': 0.0})
+        del self.history[:-PERM_CACHE_HISTORY]
+
+    def clear(self):
+        """Drop all entries, group memberships and matches."""
+        dropped = len(self.entries)
+        self.entries = {}
+        self.owners = {}
+        self.member_groups = None
+        self.group_members = None
+        self.matches = {}
+        self.generation += 1
+        self._invalidated(None, dropped, 0.0)
+
+    def invalidate(self, branch):
+        """Drop the entries for branch and everything below it."""
+        start = time.time()
+        dropped = 0
+        entries = self.entries
+        stack = [branch]
+        while stack:
+            cur = stack.pop()
+            entry = entries.pop(cur.oid, _missing)
+            if entry is _missing:
+                continue
+            dropped += 1
+            if entry is not None and entry.oid == cur.oid:
+                for perm in entry.own:
+                    self.owners.pop(perm.oid, None)
+            if cur.branches:
+                stack.extend(cur.branches)
+        self._invalidated(branch.oid, dropped, time.time() - start)
+
+    def invalidateOwner(self, perm, tree):
+        """Drop the entries of the node perm was cached for, if any."""
+        oid = self.owners.get(perm.oid)
+        if oid is not None:
+            branch = tree.getBranch(oid)
+            if branch is not None:
+                self.invalidate(branch)
+
+    def lookup(self, node):
+        """Return the entry for node, building it if necessary."""
+        entry = self.entries.get(node.oid, _missing)
+        if entry is not _missing:
+            return entry
+        start = time.time()
+        path = []
+        entry = None
+        while node is not None:
+            entry = self.entries.get(node.oid, _missing)
+            if entry is not _missing:
+                break
+            path.append(node)
+            node = node.parent
+        if entry is _missing:
+            entry = None
+        for node in reversed(path):
+            own = tuple(node.listChildren(include = ['permission']))
+            if own:
+                entry = PermissionSet(node.oid, own, entry)
+                for perm in own:
+                    self.owners[perm.oid] = node.oid
+            self.entries[node.oid] = entry
+        elapsed = time.time() - start
+        self.built += len(path)
+        self.build_time += elapsed
+        if self.history:
+            self.history[-1]['rebuilt'] += len(path)
+            self.history[-1]['rebuild_time'] += elapsed
+        return entry
+
+    def permissions(self, node):
+        """Iterate over the permissions that apply to node, in order."""
+        entry = self.lookup(node)
+        if entry is not None:
+            for perm in entry.permissions(entry.oid == node.oid):
+                yield perm
+
+    def readable(self, node, user):
+        """Return True if the permissions of node give user read access.
+
+        Only the permissions are checked, see BaseNode.hasReadPermission.
+        """
+        entry = self.lookup(node)
+        if entry is None:
+            return False
+        if entry.generation != self.generation:
+            entry.readable = {}
+            entry.generation = self.generation
+        key = (user.oid, entry.oid == node.oid)
+        result = entry.readable.get(key)
+        if result is None:
+            result = False
+            for perm in entry.permissions(key[1]):
+                if perm.matchesUser(user):
+                    result = perm.read_access.get()
+                    break
+            entry.readable[key] = result
+        return result
+
+    def _indexGroups(self, object_store):
+        """Build the group membership index from the user managers."""
+        self.member_groups = {}
+        self.group_members = {}
+        for user_manager in object_store.view_tree.listChildren(
+                include = USER_MANAGER_CLASSES):
+            for group in user_manager.listChildren(include = GROUP_CLASSES):
+                self._setMembers(group.oid,
+                        frozenset(user.oid for user in group.users.get()))
+
+    def _setMembers(self, group_oid, members):
+        """Update the index for the new members of a group.
+
+        Returns the oids of the users that joined or left the group.
+        """
+        old_members = self.group_members.pop(group_oid, frozenset())
+        if members:
+            self.group_members[group_oid] = members
+        changed = old_members ^ members
+        for user_oid in changed:
+            groups = self.member_groups.get(user_oid, frozenset())
+            if user_oid in members:
+                groups = groups | frozenset([group_oid])
+            else:
+                groups = groups - frozenset([group_oid])
+            if groups:
+                self.member_groups[user_oid] = groups
+            else:
+                self.member_groups.pop(user_oid, None)
+        return changed
+
+    def groupChanged(self, group, users):
+        """Called when the users of a group have been set (or removed)."""
+        self.generation += 1
+        if self.group_members is None:
+            # Nothing indexed, but matches may still have been cached
+            # for permissions without groups.
+            self.matches = {}
+            return
+        members = frozenset(user.oid for user in users)
+        for user_oid in self._setMembers(group.oid, members):
+            self.matches.pop(user_oid, None)
+
+    def groupsOf(self, user, object_store):
+        """Return the oids of the groups user is a member of."""
+        if self.member_groups is None:
+            self._indexGroups(object_store)
+        return self.member_groups.get(user.oid, frozenset())
+
+    def forgetPermission(self, perm):
+        """Drop the cached matches of a (removed) permission."""
+        for user_matches in self.matches.itervalues():
+            user_matches.pop(perm.oid, None)
+
+    def forgetUser(self, user):
+        """Drop the cached matches of a (removed) user."""
+        self.generation += 1
+        self.matches.pop(user.oid, None)
+
+    def matchesUser(self, perm, user):
+        """Return True if perm matches user through its users or groups.
+
+        all_users is left to the permission.
+        """
+        user_matches = self.matches.get(user.oid)
+        if user_matches is None:
+            user_matches = self.matches[user.oid] = {}
+        match = user_matches.get(perm.oid)
+        if match is None:
+            match = self._matchesUser(perm, user)
+            user_matches[perm.oid] = match
+        return match
+
+    def _matchesUser(self, perm, user):
+        for perm_user in perm.users.get():
+            if perm_user.oid == user.oid:
+                return True
+        groups = perm.groups.get()
+        if groups:
+            member_groups = self.groupsOf(user, perm.object_store)
+            for group in groups:
+                if group.oid in member_groups:
+                    return True
+        return False
+
+    def asDict(self):
+        return {
+            'entries': len(self.entries),
+            'permissions': len(self.owners),
+            'groups': len(self.group_members or ()),
+            'matches': sum(len(user_matches)
+                for user_matches in self.matches.itervalues()),
+            'invalidations': self.invalidations,
+            'dropped': self.dropped,
+            'built': self.built,
+            'build_time': self.build_time,
+            'history': list(self.history),
+        }
 
 perm_cache = PermissionCache()
 
@@ -46,11 +324,15 @@ def load_data_callback(branch):
     been loaded.
     """
     ret = None
-    if branch.oid in branch.tree.ext_data.oid_class_mapping:
-        class_id = branch.tree.ext_data.oid_class_mapping[branch.oid]
+    object_store = branch.tree.ext_data
+    if branch.oid in object_store.oid_class_mapping:
+        class_id = object_store.oid_class_mapping[branch.oid]
         obj = object_registry._createObject(class_id, branch)
-        if branch.tree.ext_data.call_loaded:
-            obj._loaded(data = None)
+        if object_store.call_loaded:
+            if object_store.node_cache is not None:
+                obj._loaded(data = object_store.node_cache.loaded(branch))
+            else:
+                obj._loaded(data = None)
         ret = obj
     return ret
 
@@ -59,6 +341,22 @@ def relocate_callback(branch):
     if branch.ext_data:
         branch.ext_data._relocate()
 
+def has_read_permission(node, user, administrator = None):
+    """node.hasReadPermission that also works for removed nodes.
+
+    Nodes seen through a tree snapshot can have been removed after the
+    snapshot was taken. They no longer have any permissions to check,
+    so only administrators can read them.
+    Failures aren't logged, see BaseNode.checkReadPermission.
+    """
+    if not user:
+        return True
+    if administrator is None:
+        administrator = user.administrator
+    if node.removed:
+        return administrator
+    return node.checkReadPermission(user, administrator)
+
 class NodeFilter(object):
     """A filter for object tree branch traversal.
 
@@ -69,14 +367,18 @@ class NodeFilter(object):
         list.
     no_match_break : will prevent further recursing down unmatches nodes.
     user : user to use for permission matching.
+    snapshot : an objecttree.TreeSnapshot the branches come from.
     """
     result_match = 1
     result_no_match = 0
     result_break = -1
     def __init__(self, include = [], exclude = [], no_match_break = False,
-            user = None):
+            user = None, snapshot = None):
         self.include_all = False
         self.user = user
+        self.snapshot = snapshot
+        # Looked up once, it's checked for every branch.
+        self.administrator = bool(user and user.administrator)
         if len(include) == 0:
             self.include_all = True
         self.ret_match = 1
@@ -103,21 +405,27 @@ class NodeFilter(object):
         Returns -1 for no match + halt of further traversal down that
         branch. 0 for regular no match. 1 for match.
         """
-        # Avoid removed nodes.
-        if branch.ext_data.removed:
+        if self.snapshot is None:
+            node = branch.ext_data
+        else:
+            node = self.snapshot.extData(branch)
+        # Avoid removed nodes, unless they were removed after the
+        # snapshot was taken.
+        if node.removed and self.snapshot is None:
             self.result = self.result_break
         # If we have a user and it doesn't have proper permissions,
         # always leave the branch.
-        elif self.user and not branch.ext_data.hasReadPermission(self.user):
+        elif self.user and not has_read_permission(node, self.user,
+                self.administrator):
             self.result = self.result_break
         # Matched exclude, don't yield.
-        elif branch.ext_data.class_name in self.exclude:
+        elif node.class_name in self.exclude:
             self.result = self.ret_no_match
         # Include list empty, include anything not excluded.
         elif self.include_all:
             self.result = self.ret_match
         # Matched include, yield.
-        elif branch.ext_data.class_name in self.include:
+        elif node.class_name in self.include:
             self.result = self.ret_match
         # We didn't match excludes, but not includes either, counts as no
         # match.
@@ -130,25 +438,36 @@ class BaseNode(object):
 
     This class is inherited by all regular tree objects, views,
     containers etc.
+
+    BaseNode uses __slots__, subclasses that are created in large
+    numbers (attributes) should define __slots__ as well.
     """
+    __slots__ = ('oid', 'branch', '_storage_actions', '_searcher_actions',
+            'object_store', 'searcher', 'removed', 'modtime', 'perm_cache',
+            '_attr_index', '_field_values')
     require_admin = False
+    # Creation time.
+    ctime = storagevalue.Field('ctime')
 
     def __init__(self, oid, branch):
         self.oid = oid
         self.branch = branch
-        # Contains a list of all StorageValue instances used by the node.
-        # Updated by StorageValue.__init__.
-        self._storage_actions = []
-        self._searcher_actions = []
+        # Pending storage/searcher actions, an empty tuple until the
+        # first action is added to avoid a list per node.
+        self._storage_actions = ()
+        self._searcher_actions = ()
         self.object_store = self.branch.tree.ext_data
         self.searcher = self.object_store.searcher
         self.removed = False
-        # Creation time.
-        self.ctime = storagevalue.StorageValue(self, 'ctime', 0)
+        # Values of the storagevalue.Fields of the node, see field_layout.
+        self._field_values = None
+        self.ctime.init(0)
         # Modification time, for internal use.
         self.modtime = time.time()
         global perm_cache
         self.perm_cache = perm_cache
+        # Attribute name -> attribute branch, see getAttribute.
+        self._attr_index = None
 
     def __str__(self):
         return '<%s:%s>' % (self.class_name, self.oid)
@@ -170,11 +489,24 @@ class BaseNode(object):
         self.searcher = None
         self.perm_cache = None
         self._storage_actions = None
+        self._attr_index = None
 
     def storageAction(self, action, args = None):
+        if self.object_store.readonly:
+            self.object_store.rejectWrite(self)
+        # Every change to a node's data is written to storage, let any
+        # open tree snapshots keep a copy of the node first.
+        branch = self.branch
+        if branch is not None and branch.tree is not None and \
+                branch.tree.snapshots:
+            branch.tree.preserve(branch)
+        if not self._storage_actions:
+            self._storage_actions = []
         self._storage_actions.append({'action': action, 'args': args})
 
     def searcherAction(self, action, args = None):
+        if not self._searcher_actions:
+            self._searcher_actions = []
         self._searcher_actions.append({'action': action, 'args': args})
 
     def removeStorageAction(self, rm_action):
@@ -195,6 +527,7 @@ class BaseNode(object):
         the current object. Also creates a new branch in the object tree
         to hold the object.
         """
+        self.object_store.checkWritable()
         if not object_registry.isValidChild(self.class_id, class_id):
             raise errors.SiptrackError(
                     'trying to create child of invalid type \'%s\'' % (class_id))
@@ -256,11 +589,13 @@ class BaseNode(object):
         Callbacks from the objecttree branches being removed will call
         _remove for each object being removed.
         """
+        self.object_store.checkWritable()
         return self.branch.remove(recursive, user)
     delete = remove
 
     def _remove(self, user):
         """Remove a single object. Called from branch callbacks."""
+        self.object_store.checkWritable()
         if not self.hasWritePermission(user):
             raise errors.PermissionDenied()
         self.object_store.triggerEvent('node remove', self)
@@ -275,7 +610,6 @@ class BaseNode(object):
         self.setModified()
         self.storageAction('remove_node')
         self.searcherAction('remove_node')
-        self.removeStorageAction('create_node')
 
     def _relocate(self):
         """Relocate (new parent) an object. Called from branch callbacks.
@@ -285,6 +619,8 @@ class BaseNode(object):
         """
         self.storageAction('relocate')
         self.setModified()
+        # Inherited permissions have changed for the whole subtree.
+        self.perm_cache.invalidate(self.branch)
 
     def relocate(self, new_parent, user = None):
         """Relocate (new parent) an object. Called manually.
@@ -292,6 +628,7 @@ class BaseNode(object):
         For manual use. Will relocate the objects branch and let the
         callback (_relocate) do the work.
         """
+        self.object_store.checkWritable()
         if not self.hasWritePermission(user) or not new_parent.hasWritePermission(user):
             raise errors.PermissionDenied()
         # Don't set a node as its own parent..
@@ -329,6 +666,7 @@ class BaseNode(object):
         Associations/references are stored in the object tree as
         associations between branches.
         """
+        self.object_store.checkWritable()
         if self.isAssociated(other):
             raise errors.SiptrackError('objects already associated')
         if self is other:
@@ -341,6 +679,7 @@ class BaseNode(object):
 
     def disassociate(self, other):
         """Remove an association to another object."""
+        self.object_store.checkWritable()
         if not self.isAssociated(other):
             raise errors.SiptrackError('objects not associated')
         self.storageAction('disassociate', {'other': other.oid})
@@ -351,10 +690,9 @@ class BaseNode(object):
 
     def isAssociated(self, other):
         # Just check the tree to avoid loading nodes unnecessarily.
-        for branch in self.branch.associations:
-            if other.oid == branch.oid:
-                return True
-        return False
+        if other.branch is None:
+            return False
+        return other.branch in self.branch.associations
 
     def listAssocRef(self, include = [], exclude = []):
         """List associations and references.
@@ -400,15 +738,44 @@ class BaseNode(object):
 
     def traverse(self, include_self = True, max_depth = -1,
             include = [], exclude = [], no_match_break = False,
-            include_depth = False, user = None):
+            include_depth = False, user = None, snapshot = None):
         """Tree traversal.
 
         Just like branch.traverse but returns nodes, not branches.
         include/exclude are used to filter results with the NodeFilter
         class.
+        If snapshot (an objecttree.TreeSnapshot) is given the tree is
+        traversed as it was when the snapshot was taken.
         """
-        node_filter = NodeFilter(include, exclude, no_match_break, user)
-        for data in self.branch.traverse(include_self, max_depth, node_filter,
+        node_filter = NodeFilter(include, exclude, no_match_break, user,
+                snapshot)
+        branch = self.branch
+        if snapshot is not None:
+            branch = snapshot.branch(self)
+        if include and max_depth == 0 and not include_self and \
+                (snapshot is None or snapshot.saved.get(branch) is None):
+            # Listing children of some classes, use the branches class
+            # index if possible (for snapshots only if the children
+            # haven't changed). The filter still has the final say.
+            class_ids = [object_registry.getIDByName(name) for name in include]
+            children = branch.listChildrenByClass(class_ids)
+            if children is not None:
+                for branch in list(children):
+                    if node_filter.filter(branch) == 1:
+                        if include_depth:
+                            yield 0, branch.ext_data
+                        else:
+                            yield branch.ext_data
+                return
+        if snapshot is not None:
+            for data in snapshot.traverse(branch, include_self, max_depth,
+                    node_filter, include_depth):
+                if include_depth:
+                    yield data[0], snapshot.extData(data[1])
+                else:
+                    yield snapshot.extData(data)
+            return
+        for data in branch.traverse(include_self, max_depth, node_filter,
                 include_depth):
             if include_depth:
                 # depth, branch
@@ -426,7 +793,7 @@ class BaseNode(object):
                 include = include, exclude = exclude)
 
     def search(self, re_pattern, attr_limit = [], include = [], exclude = [],
-            no_match_break = False, user = None):
+            no_match_break = False, user = None, snapshot = None):
         re_compiled = re.compile(re_pattern, re.IGNORECASE)
         """Searches for nodes.
         
@@ -440,6 +807,8 @@ class BaseNode(object):
         include    : include only node types listed
         exclude    : exclude node types listed
         no_match_break : see argument with same name to traverse
+        snapshot   : an objecttree.TreeSnapshot to search instead of the
+            current tree
         """
         match_any_attrs = True
         if len(attr_limit) > 0:
@@ -453,15 +822,17 @@ class BaseNode(object):
         ]
 
         prev_added = None
-        node_filter = NodeFilter(include, exclude, no_match_break)
+        node_filter = NodeFilter(include, exclude, no_match_break,
+                snapshot = snapshot)
 #        for node in self.traverse(include = local_include, exclude = exclude,
 #                no_match_break = no_match_break, user = user):
         # Don't include the user in the traverse. If we did we wouldn't be
         # able to match nodes further into the tree that we do have
         # access to. We do permission checking ourselves below.
         for node in self.traverse(include = local_include, exclude = exclude,
-                no_match_break = no_match_break, user = None):
-            if not node.hasReadPermission(user):
+                no_match_break = no_match_break, user = None,
+                snapshot = snapshot):
+            if not has_read_permission(node, user):
                 continue
 
             local_types = [
@@ -470,25 +841,38 @@ class BaseNode(object):
             ]
             # Match attributes.
             if node.class_name in local_types:
-                value = node.value
-                if node.atype in ['int', 'bool']:
+                state = None
+                if snapshot is not None:
+                    state = snapshot.state(node)
+                if state is None:
+                    state = (node.name, node.atype, node.value)
+                name, atype, value = state
+                if atype in ['int', 'bool']:
                     value = str(value)
-                if (match_any_attrs or node.name in attr_limit) and \
-                        node.atype in ['text', 'int', 'bool'] and \
+                if (match_any_attrs or name in attr_limit) and \
+                        atype in ['text', 'int', 'bool'] and \
                         re_compiled.search(value):
                     # Get the attributes nearest _non-attribute_ parent.
-                    parent = node.getParentNode()
+                    parent = node.getParentNode(snapshot)
+                    if snapshot is None:
+                        parent_branch = parent.branch
+                    else:
+                        parent_branch = snapshot.branch(parent)
                     if parent is not prev_added and \
-                            node_filter.filter(parent.branch) == \
+                            node_filter.filter(parent_branch) == \
                             node_filter.result_match and \
-                            parent.hasReadPermission(user):
+                            has_read_permission(parent, user):
                         yield parent
                         prev_added = parent
             # Match networks.
             elif node.class_name in ['ipv4 network', 'ipv6 network']:
+                if snapshot is None:
+                    branch = node.branch
+                else:
+                    branch = snapshot.branch(node)
                 if re_compiled.search(str(node.address)) and \
                         node is not prev_added and \
-                        node_filter.filter(node.branch) == \
+                        node_filter.filter(branch) == \
                         node_filter.result_match:
                     yield node
                     prev_added = node
@@ -527,14 +911,37 @@ class BaseNode(object):
 
     def getAttribute(self, name):
         """Returns the first matched directly attached attribute with name.
-        
-        This is a bit of an ugly hack. Should be cleaned up.
+
+        Lookups use a name -> attribute branch index that is built on
+        first use. Attributes drop their parents index when they are
+        added, renamed, loaded, relocated or removed (see
+        attribute.AttributeBase). An index entry that no longer points to
+        a child branch (changed by a journal replay for example) also
+        causes a rebuild. The index holds branches, not nodes, so it
+        doesn't keep attributes from being evicted by the node cache.
         """
+        index = self._attr_index
+        if index is None:
+            index = self._buildAttributeIndex()
+        branch = index.get(name)
+        if branch is not None and branch.parent is not self.branch:
+            branch = self._buildAttributeIndex().get(name)
+        if branch is None:
+            return None
+        return branch.ext_data
+
+    def _buildAttributeIndex(self):
+        index = {}
         for obj in self.listChildren(
                 include = ['attribute', 'versioned attribute']):
-            if obj.name == name:
-                return obj
-        return None
+            try:
+                name = obj.name
+            except errors.MissingData:
+                continue
+            if name not in index:
+                index[name] = obj.branch
+        self._attr_index = index
+        return index
 
     def getAttributeValue(self, name, default = None):
         attr = self.getAttribute(name)
@@ -543,44 +950,37 @@ class BaseNode(object):
         return attr.value
 
     def getPermission(self, user, recurse = True):
-        self._cachePermissions()
-        for perm in self.perm_cache.get(self):
+        for perm in self.perm_cache.permissions(self):
             if perm.matchesUser(user):
                 return perm
 
-    def _cachePermissions(self):
-        if self.perm_cache.cached(self):
-            return
-        self.perm_cache.init(self)
-        # First add our own permission children.
-        for perm in self.listChildren(include = ['permission']):
-            self.perm_cache.add(self, perm)
-        parent = self.parent
-        if parent:
-            # If we have a parent, tell it to cache it's permissions.
-            parent._cachePermissions()
-            # Next, add the parents recursive permissions to our own
-            # perm cache.
-            for perm in self.perm_cache.get(parent):
-                if perm.recursive.get():
-                    self.perm_cache.add(self, perm)
-
     def logPermissionCache(self, user = None):
-        for perm in self.perm_cache.get(self):
+        for perm in self.perm_cache.permissions(self):
             log.msg(str(perm))
             if user and perm.matchesUser(user):
                 log.msg('matches user %s: true' % (user))
 
-    def hasReadPermission(self, user, recurse = True):
-        if not user or user.administrator:
+    def checkReadPermission(self, user, administrator = None):
+        """hasReadPermission without logging failures.
+
+        Used where nodes are checked in bulk (traversals, searches),
+        administrator can be passed in if it's already known.
+        """
+        if not user:
             return True
-        if self.require_admin and not user.administrator:
+        if administrator is None:
+            administrator = user.administrator
+        if administrator:
+            return True
+        if self.require_admin:
             return False
         # Users have access to their own users.
         if self == user.user:
             return True
-        perm = self.getPermission(user, recurse)
-        if perm and perm.read_access.get():
+        return self.perm_cache.readable(self, user)
+
+    def hasReadPermission(self, user, recurse = True):
+        if self.checkReadPermission(user):
             return True
 
         log.msg('FAIL: read permission failed for node:%s user:%s' % (self, user))
@@ -814,18 +814,24 @@ class UserLocal(treenodes.BaseNode, UserCommon):
     """A user account."""
     class_id = 'U'
     class_name = 'user local'
+    _username = storagevalue.Field('username')
+    _password = storagevalue.Field('password')
+    _administrator = storagevalue.BoolField('administrator')
 
     def __init__(self, oid, branch, username = None, password = None,
             administrator = None):
         super(UserLocal, self).__init__(oid, branch)
-        self._username = storagevalue.StorageValue(self, 'username', username)
-        self._password = storagevalue.StorageValue(self, 'password', password)
-        self._administrator = storagevalue.StorageBool(self, 'administrator',
-                administrator)
+        self._username.init(username)
+        self._password.init(password)
+        self._administrator.init(administrator)
 
     def _encryptPassword(self, password):
         return hashlib.sha1(password).hexdigest()
 
+    def _remove(self, *args, **kwargs):
+        super(UserLocal, self)._remove(*args, **kwargs)
+        self.perm_cache.forgetUser(self)
+
     def _created(self, user):
         super(UserLocal, self)._created(user)
         if type(self._username.get()) not in [unicode, str]:
@@ -908,13 +914,14 @@ class UserLDAP(treenodes.BaseNode, UserCommon):
     """An LDAP user account."""
     class_id = 'UL'
     class_name = 'user ldap'
+    _username = storagevalue.Field('username')
+    _administrator = storagevalue.BoolField('administrator')
+    _password_hash = storagevalue.Field('password-hash')
 
     def __init__(self, oid, branch, username = None, administrator = None):
         super(UserLDAP, self).__init__(oid, branch)
-        self._username = storagevalue.StorageValue(self, 'username', username)
-        self._administrator = storagevalue.StorageBool(self, 'administrator',
-                administrator)
-        self._password_hash = storagevalue.StorageValue(self, 'password-hash', None)
+        self._username.init(username)
+        self._administrator.init(administrator)
 
     def _created(self, user):
         super(UserLDAP, self)._created(user)
@@ -923,6 +930,10 @@ class UserLDAP(treenodes.BaseNode, UserCommon):
         self._username.commit()
         self._administrator.commit()
 
+    def _remove(self, *args, **kwargs):
+        super(UserLDAP, self)._remove(*args, **kwargs)
+        self.perm_cache.forgetUser(self)
+
     def _loaded(self, data = None):
         """Load the user information from disk."""
         super(UserLDAP, self)._loaded(data)
@@ -1010,11 +1021,12 @@ class UserActiveDirectory(UserLDAP):
 class UserGroupBase(treenodes.BaseNode):
     """Groups for users."""
     valid_user_types = []
+    users = storagevalue.NodeListField('users', '_validateUsers',
+            changed = '_usersChanged')
 
     def __init__(self, oid, branch, users = None):
         super(UserGroupBase, self).__init__(oid, branch)
-        self.users = storagevalue.StorageNodeList(self,
-                'users', users, self._validateUsers)
+        self.users.init(users)
 
     def _created(self, user):
         super(UserGroupBase, self)._created(user)
@@ -1031,6 +1043,13 @@ class UserGroupBase(treenodes.BaseNode):
             if type(node) not in self.valid_user_types:
                 raise errors.SiptrackError('invalid user in group')
 
+    def _usersChanged(self, value):
+        self.perm_cache.groupChanged(self, value)
+
+    def _remove(self, *args, **kwargs):
+        super(UserGroupBase, self)._remove(*args, **kwargs)
+        self.perm_cache.groupChanged(self, [])
+
 class UserGroup(UserGroupBase):
     """Groups for users."""
     class_id = 'UG'
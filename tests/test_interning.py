@@ -0,0 +1,63 @@
+from twisted.internet import defer
+from siptrackdlib import interning
+import siptrackdlib
+from utils import BasicTestCase, make_storage
+
+
+class TestInterning(BasicTestCase):
+    def testInternText(self):
+        name = u''.join([u'desc', u'ription'])
+        shared = interning.intern_text(u'description')
+        self.assert_(interning.intern_text(name) is shared)
+        self.assertEqual(type(shared), unicode)
+        name = ''.join(['desc', 'ription'])
+        self.assert_(interning.intern_text(name) is interning.intern_text('description'))
+        self.assertEqual(type(interning.intern_text(name)), str)
+        self.assertEqual(interning.intern_text(5), 5)
+        self.assertEqual(interning.intern_id(None), None)
+        self.assertEqual(type(interning.intern_id(u'17')), str)
+
+    def testInternTextBounded(self):
+        self.patch(interning, '_text_table', {})
+        self.patch(interning, 'MAX_TEXT_TABLE', 2)
+        first = interning.intern_text(u''.join([u'fi', u'rst']))
+        interning.intern_text(u'second')
+        self.assertEqual(interning.text_table_size(), 2)
+        third = u''.join([u'thi', u'rd'])
+        self.assert_(interning.intern_text(third) is third)
+        self.assertEqual(interning.text_table_size(), 2)
+        self.assert_(interning.intern_text(u'first') is first)
+
+    @defer.inlineCallbacks
+    def testLoadedShared(self):
+        view = self.object_store.view_tree.add(None, 'view')
+        device_tree = view.add(None, 'device tree')
+        attrs = []
+        for n in range(2):
+            device = device_tree.add(None, 'device')
+            attrs.append(device.add(None, 'attribute', u'description',
+                'text', u'device %d' % (n)))
+            attrs.append(device.add(None, 'attribute', 'serial', 'text',
+                u'%d' % (n)))
+        yield self.object_store.commit([self.object_store.view_tree, view,
+            device_tree] +
+                [attr.parent for attr in attrs] + attrs)
+        object_store = siptrackdlib.ObjectStore(make_storage(self.config))
+        yield object_store.init()
+        loaded = [object_store.getOID(attr.oid) for attr in attrs]
+        # Oids and class ids are shared and are str, like the oids handed
+        # out for new nodes.
+        for attr, loaded_attr in zip(attrs, loaded):
+            self.assertEqual(loaded_attr.oid, attr.oid)
+            self.assert_(loaded_attr.oid is intern(attr.oid))
+            self.assertEqual(type(loaded_attr.oid), str)
+        mapping = object_store.oid_class_mapping
+        self.assert_(mapping[loaded[0].oid] is mapping[loaded[2].oid])
+        self.assert_(mapping[loaded[0].parent.oid] is
+                mapping[loaded[2].parent.oid])
+        # Attribute names are shared and keep their type.
+        self.assert_(loaded[0].name is loaded[2].name)
+        self.assertEqual(type(loaded[0].name), unicode)
+        self.assert_(loaded[1].name is loaded[3].name)
+        self.assertEqual(type(loaded[1].name), type(attrs[1].name))
+        self.assert_(loaded[0].atype is loaded[1].atype)
@@ -1,4 +1,10 @@
-from utils import BasicTestCase
+import os
+import xmlrpclib
+
+from twisted.internet import defer
+from twisted.internet import reactor
+from utils import BasicTestCase, make_storage
+import siptrackdlib
 import siptrackdlib.errors
 
 
@@ -13,6 +19,764 @@ class TestObjectStore(BasicTestCase):
     def testGetExistingOID(self):
         obj = self.object_store.getOID('0')
 
+    @defer.inlineCallbacks
+    def testBatchedCommit(self):
+        view_1 = self.object_store.view_tree.add(None, 'view')
+        view_2 = self.object_store.view_tree.add(None, 'view')
+        attr = view_1.add(None, 'attribute', 'name', 'text', u'first')
+        attr.value = u'second'
+        removed = view_2.add(None, 'attribute', 'name', 'text', u'gone')
+        view_1.associate(view_2)
+        nodes = [self.object_store.view_tree, view_1, view_2, attr, removed]
+        yield self.object_store.commit(nodes)
+        stats = self.object_store.getStats()['commit']
+        self.assert_(stats['last_actions'] > 0)
+        removed_oid = removed.oid
+        removed.remove(recursive = True)
+        yield self.object_store.commit([removed, view_2])
+
+        object_store = siptrackdlib.ObjectStore(make_storage(self.config))
+        yield object_store.init()
+        self.assertEqual(object_store.getOID(attr.oid).value, u'second')
+        self.assert_(object_store.getOID(view_1.oid).isAssociated(
+            object_store.getOID(view_2.oid)))
+        self.assertRaises(
+            siptrackdlib.errors.NonExistent,
+            object_store.getOID,
+            removed_oid
+        )
+
+    @defer.inlineCallbacks
+    def testCompactActions(self):
+        view_1 = self.object_store.view_tree.add(None, 'view')
+        view_2 = self.object_store.view_tree.add(None, 'view')
+        counter = view_1.add(None, 'attribute', 'counter', 'int', 0)
+        for n in range(10):
+            counter.value = n
+        removed = view_1.add(None, 'attribute', 'gone', 'int', 1)
+        removed_oid = removed.oid
+        removed.remove(recursive = True)
+        view_1.associate(view_2)
+        view_1.disassociate(view_2)
+        yield self.object_store.commit([self.object_store.view_tree,
+            view_1, view_2, counter, removed])
+        stats = self.object_store.getStats()['commit']
+        self.assert_(stats['last_elided'] >= 13)
+
+        object_store = siptrackdlib.ObjectStore(make_storage(self.config))
+        yield object_store.init()
+        self.assertEqual(object_store.getOID(counter.oid).value, 9)
+        self.assertFalse(object_store.getOID(view_1.oid).isAssociated(
+            object_store.getOID(view_2.oid)))
+        self.assertRaises(
+            siptrackdlib.errors.NonExistent,
+            object_store.getOID,
+            removed_oid
+        )
+
+    def testLargeChildList(self):
+        view = self.object_store.view_tree.add(None, 'view')
+        other = self.object_store.view_tree.add(None, 'view')
+        attrs = [view.add(None, 'attribute', 'attr-%d' % n, 'int', n)
+                 for n in range(100)]
+        for attr in attrs:
+            attr.associate(other)
+        for attr in attrs[::2]:
+            attr.remove(recursive = True)
+        kept = attrs[1::2]
+        self.assertEqual(list(view.listChildren()), kept)
+        self.assertEqual(list(view.listChildren(include = ['attribute'])), kept)
+        self.assertEqual(list(view.listChildren(include = ['view'])), [])
+        self.assertEqual(view.getAttribute('attr-51'), attrs[51])
+        added = view.add(None, 'attribute', 'added', 'int', 1)
+        self.assertEqual(list(view.listChildren(include = ['attribute'])),
+                kept + [added])
+        added.remove(recursive = True)
+        self.assertEqual(list(other.references), kept)
+        self.assert_(kept[-1].isAssociated(other))
+        for attr in kept[:-1]:
+            attr.relocate(kept[-1])
+        self.assertEqual(list(view.listChildren()), kept[-1:])
+        self.assertEqual(list(kept[-1].listChildren()), kept[:-1])
+
+    def testAttributeIndex(self):
+        view = self.object_store.view_tree.add(None, 'view')
+        first = view.add(None, 'attribute', 'name', 'text', u'first')
+        second = view.add(None, 'attribute', 'name', 'text', u'second')
+        self.assertEqual(view.getAttributeValue('name'), u'first')
+        self.assertEqual(view.getAttribute('missing'), None)
+        first.name = 'renamed'
+        self.assertEqual(view.getAttribute('renamed'), first)
+        self.assertEqual(view.getAttributeValue('name'), u'second')
+        second.remove(recursive = True)
+        self.assertEqual(view.getAttribute('name'), None)
+        moved = first.add(None, 'attribute', 'name', 'text', u'moved')
+        self.assertEqual(first.getAttribute('name'), moved)
+        holder = view.add(None, 'attribute', 'holder', 'int', 1)
+        self.assertEqual(holder.getAttribute('name'), None)
+        moved.relocate(holder)
+        self.assertEqual(holder.getAttribute('name'), moved)
+        self.assertEqual(first.getAttribute('name'), None)
+
+    @defer.inlineCallbacks
+    def testStorageFields(self):
+        view_tree = self.object_store.view_tree
+        um = view_tree.add(None, 'user manager local')
+        user = um.add(None, 'user local', u'fielduser', u'secret', False)
+        group = um.add(None, 'user group', [user])
+        view = view_tree.add(None, 'view')
+        perm = view.add(None, 'permission', True, False, [user], [group],
+                False, True)
+        versioned = view.add(None, 'versioned attribute', 'name', 'text',
+                u'first', 2)
+        versioned.value = u'second'
+        self.assertEqual(len(perm._field_values), 7)
+        self.assertRaises(siptrackdlib.errors.SiptrackError,
+                perm.users.set, [group])
+        self.assertRaises(AttributeError, setattr, perm, 'read_access', False)
+        yield self.object_store.commit([view_tree, um, user, group, view,
+            perm, versioned])
+
+        object_store = siptrackdlib.ObjectStore(make_storage(self.config))
+        yield object_store.init()
+        other_perm = object_store.getOID(perm.oid)
+        other_user = object_store.getOID(user.oid)
+        self.assertEqual(other_perm.ctime.get(), perm.ctime.get())
+        self.assert_(other_perm.read_access.get())
+        self.assertFalse(other_perm.write_access.get())
+        self.assert_(other_perm.recursive.get())
+        self.assertEqual(other_perm.users.get(), [other_user])
+        self.assert_(other_perm.matchesUser(other_user))
+        self.assert_(other_user.authenticate(u'secret'))
+        self.assertFalse(other_user.administrator)
+        self.assertEqual(object_store.getOID(group.oid).users.get(),
+                [other_user])
+        self.assertEqual(object_store.getOID(versioned.oid).values,
+                [u'first', u'second'])
+        other_user.remove(recursive = True)
+        self.assertEqual(other_perm.users.get(), [])
+
+    @defer.inlineCallbacks
+    def testNodeCache(self):
+        view = self.object_store.view_tree.add(None, 'view')
+        attrs = [view.add(None, 'attribute', 'attr-%d' % n, 'int', n)
+                 for n in range(40)]
+        yield self.object_store.commit([self.object_store.view_tree, view] + attrs)
+        object_store = siptrackdlib.ObjectStore(make_storage(self.config),
+                preload = False, node_cache_size = 10)
+        yield object_store.init()
+        held = object_store.getOID(attrs[0].oid)
+        for attr in attrs:
+            self.assertEqual(object_store.getOID(attr.oid).value, attr.value)
+        stats = object_store.getStats()['node_cache']
+        self.assert_(stats['evictions'] > 0)
+        self.assert_(stats['loaded'] <= 10)
+        self.assert_(stats['held'] > 0)
+        self.assert_(object_store.getOID(attrs[0].oid) is held)
+        changed = object_store.getOID(attrs[1].oid)
+        changed.value = 100
+        changed_oid = changed.oid
+        changed = None
+        for attr in attrs[2:]:
+            self.assertEqual(object_store.getOID(attr.oid).value, attr.value)
+        self.assertEqual(object_store.getOID(changed_oid).value, 100)
+        stats = object_store.getStats()['node_cache']
+        self.assert_(stats['hits'] > 0)
+        self.assert_(stats['misses'] + stats['prefetch_hits'] > len(attrs))
+        # Siblings are read along with a missed node.
+        self.assert_(stats['prefetch_hits'] > stats['misses'])
+        # The attribute name index doesn't keep the attributes loaded.
+        cached_view = object_store.getOID(view.oid)
+        self.assertEqual(cached_view.getAttributeValue('attr-5'), 5)
+        evictions = stats['evictions']
+        for attr in attrs[2:]:
+            self.assertEqual(object_store.getOID(attr.oid).value, attr.value)
+        stats = object_store.getStats()['node_cache']
+        self.assert_(stats['evictions'] > evictions)
+        self.assert_(stats['loaded'] <= 10)
+        self.assertEqual(cached_view.getAttributeValue('attr-5'), 5)
+
+    @defer.inlineCallbacks
+    def testNodeCachePrefetchChanged(self):
+        view = self.object_store.view_tree.add(None, 'view')
+        attrs = [view.add(None, 'attribute', 'attr-%d' % n, 'int', n)
+                 for n in range(5)]
+        yield self.object_store.commit([self.object_store.view_tree, view] + attrs)
+        # Large enough for the prefetched data of the nodes of earlier
+        # tests sharing the database.
+        object_store = siptrackdlib.ObjectStore(make_storage(self.config),
+                preload = False, node_cache_size = 1000)
+        yield object_store.init()
+        self.assertEqual(object_store.getOID(attrs[0].oid).value, 0)
+        self.assert_(attrs[1].oid in object_store.node_cache.prefetched)
+        # Changed by another object store after it was prefetched.
+        attrs[1].value = 100
+        yield self.object_store.commit(attrs[1])
+        yield object_store.applyJournal()
+        self.assertFalse(attrs[1].oid in object_store.node_cache.prefetched)
+        self.assertEqual(object_store.getOID(attrs[1].oid).value, 100)
+        self.assertEqual(object_store.getOID(attrs[2].oid).value, 2)
+
+    @defer.inlineCallbacks
+    def testStreamPreload(self):
+        view = self.object_store.view_tree.add(None, 'view')
+        attrs = [view.add(None, 'attribute', 'attr-%d' % n, 'int', n)
+                 for n in range(25)]
+        yield self.object_store.commit([self.object_store.view_tree, view] + attrs)
+        object_store = siptrackdlib.ObjectStore(make_storage(self.config),
+                stream_preload = True)
+        yield object_store.init()
+        for attr in attrs:
+            self.assertEqual(object_store.getOID(attr.oid).value, attr.value)
+        self.assertEqual(object_store.getOID(view.oid).ctime.get(),
+                view.ctime.get())
+
+    @defer.inlineCallbacks
+    def testSnapshot(self):
+        view_1 = self.object_store.view_tree.add(None, 'view')
+        view_2 = self.object_store.view_tree.add(None, 'view')
+        attr = view_1.add(None, 'attribute', 'name', 'text', u'first')
+        removed = view_2.add(None, 'attribute', 'count', 'int', 1)
+        yield self.object_store.commit([self.object_store.view_tree,
+            view_1, view_2, attr, removed])
+        path = os.path.join(self.tempdir, 'snapshot')
+        seq = yield self.object_store.writeSnapshot(path)
+        self.assert_(seq > 0)
+
+        attr.value = u'second'
+        view_1.associate(view_2)
+        removed_oid = removed.oid
+        removed.remove(recursive = True)
+        added = view_2.add(None, 'attribute', 'count', 'int', 2)
+        yield self.object_store.commit([view_1, view_2, attr, removed, added])
+
+        object_store = siptrackdlib.ObjectStore(make_storage(self.config),
+                snapshot_path = path)
+        yield object_store.init()
+        stats = object_store.getStats()['load']
+        self.assertEqual(stats['source'], 'snapshot')
+        self.assert_(stats['replayed_oids'] > 0)
+        self.assertEqual(object_store.getOID(attr.oid).value, u'second')
+        self.assertEqual(object_store.getOID(added.oid).value, 2)
+        self.assert_(object_store.getOID(view_1.oid).isAssociated(
+            object_store.getOID(view_2.oid)))
+        self.assertRaises(
+            siptrackdlib.errors.NonExistent,
+            object_store.getOID,
+            removed_oid
+        )
+
+    @defer.inlineCallbacks
+    def testJournalTrim(self):
+        self.patch(siptrackdlib.root, 'RELOAD_GRACE_PERIOD', 0)
+        view = self.object_store.view_tree.add(None, 'view')
+        attr = view.add(None, 'attribute', 'name', 'text', u'first')
+        yield self.object_store.commit([self.object_store.view_tree, view, attr])
+        storage = siptrackdlib.storage.load('stsqlite', self.config,
+                readonly = True)
+        follower = siptrackdlib.ObjectStore(storage, readonly = True)
+        yield follower.init()
+
+        attr.value = u'second'
+        yield self.object_store.commit(attr)
+        self.object_store.journal_retention = 0
+        seq = yield self.object_store.writeSnapshot(
+                os.path.join(self.tempdir, 'snapshot'))
+        journal = yield storage.listJournal(0)
+        self.assertEqual(len(journal), 0)
+        trim_seq = yield storage.getJournalTrimSeq()
+        self.assertEqual(trim_seq, seq)
+        # The follower missed the trimmed entries and needs a full reload.
+        yield self.assertFailure(follower.applyJournal(),
+                siptrackdlib.errors.JournalTrimmed)
+        full = yield follower.reload()
+        self.assert_(full)
+        self.assertEqual(follower.getOID(attr.oid).value, u'second')
+        yield defer.DeferredList(follower.old_trees.values())
+
+    @defer.inlineCallbacks
+    def testJournalTrimOnCommit(self):
+        self.patch(siptrackdlib.root, 'JOURNAL_TRIM_COMMITS', 2)
+        self.object_store.journal_retention = 1
+        storage = self.object_store.storage
+        view = self.object_store.view_tree.add(None, 'view')
+        yield self.object_store.commit([self.object_store.view_tree, view])
+        attr = view.add(None, 'attribute', 'name', 'text', u'first')
+        yield self.object_store.commit([view, attr])
+        # The trim is started by the second commit, without a snapshot.
+        self.assert_(self.object_store.journal_trimming)
+        while self.object_store.journal_trimming:
+            d = defer.Deferred()
+            reactor.callLater(0.05, d.callback, None)
+            yield d
+        seq = yield storage.getJournalSeq()
+        trim_seq = yield storage.getJournalTrimSeq()
+        self.assertEqual(trim_seq, seq - 1)
+        journal = yield storage.listJournal(0)
+        self.assertEqual(len(journal), 1)
+        # Nothing more to trim.
+        trimmed = yield self.object_store.trimJournal()
+        self.assertEqual(trimmed, None)
+        self.object_store.journal_retention = None
+        attr.value = u'second'
+        yield self.object_store.commit(attr)
+        trimmed = yield self.object_store.trimJournal()
+        self.assertEqual(trimmed, None)
+
+    @defer.inlineCallbacks
+    def testIncrementalReload(self):
+        view_1 = self.object_store.view_tree.add(None, 'view')
+        view_2 = self.object_store.view_tree.add(None, 'view')
+        attr = view_1.add(None, 'attribute', 'name', 'text', u'first')
+        moved = view_1.add(None, 'attribute', 'moved', 'int', 1)
+        removed = view_2.add(None, 'attribute', 'removed', 'int', 1)
+        yield self.object_store.commit([self.object_store.view_tree,
+            view_1, view_2, attr, moved, removed])
+
+        other_store = siptrackdlib.ObjectStore(make_storage(self.config))
+        yield other_store.init()
+        other_view_1 = other_store.getOID(view_1.oid)
+        other_view_2 = other_store.getOID(view_2.oid)
+        other_attr = other_store.getOID(attr.oid)
+        other_attr.value = u'second'
+        other_moved = other_store.getOID(moved.oid)
+        other_moved.relocate(other_attr)
+        other_removed = other_store.getOID(removed.oid)
+        other_removed.remove(recursive = True)
+        other_view_1.associate(other_view_2)
+        added = other_view_2.add(None, 'attribute', 'added', 'int', 2)
+        yield other_store.commit([other_view_1, other_view_2, other_attr,
+            other_moved, other_removed, added])
+
+        full = yield self.object_store.reload()
+        self.assertFalse(full)
+        self.assert_(self.object_store.getOID(attr.oid) is attr)
+        self.assertEqual(attr.value, u'second')
+        self.assert_(moved.parent is attr)
+        self.assert_(removed.removed)
+        self.assertRaises(
+            siptrackdlib.errors.NonExistent,
+            self.object_store.getOID,
+            removed.oid
+        )
+        self.assert_(view_1.isAssociated(view_2))
+        self.assertEqual(self.object_store.getOID(added.oid).value, 2)
+        self.assert_(self.object_store.getOID(added.oid).parent is view_2)
+
+    def testTreeSnapshot(self):
+        view_1 = self.object_store.view_tree.add(None, 'view')
+        view_2 = self.object_store.view_tree.add(None, 'view')
+        attr = view_1.add(None, 'attribute', 'name', 'text', u'first')
+        removed = view_1.add(None, 'attribute', 'gone', 'int', 1)
+        snapshot = self.object_store.snapshot(capture = lambda node: node.oid)
+
+        attr.value = u'second'
+        view_1.associate(view_2)
+        removed.remove(recursive = True)
+        added = view_1.add(None, 'attribute', 'added', 'int', 2)
+        self.assertEqual(list(view_1.listChildren()), [attr, added])
+        self.assertEqual(list(view_1.traverse(include_self = False,
+            snapshot = snapshot)), [attr, removed])
+        self.assertEqual(snapshot.parent(removed), view_1)
+        self.assertEqual(snapshot.associations(view_1), [])
+        self.assertEqual(snapshot.references(view_2), [])
+        self.assertEqual(snapshot.state(attr), ('name', 'text', u'first'))
+        self.assertEqual(snapshot.data(attr), attr.oid)
+        self.assertEqual(snapshot.data(added), None)
+        self.assertEqual(list(view_1.search('first')), [])
+        self.assertEqual(list(view_1.search('first', snapshot = snapshot)),
+                [view_1])
+
+        snapshot.close()
+        self.assertFalse(self.object_store.object_tree.snapshots)
+
+    @defer.inlineCallbacks
+    def testCensus(self):
+        view = self.object_store.view_tree.add(None, 'view')
+        for n in range(5):
+            view.add(None, 'attribute', 'attr-%d' % n, 'int', n)
+        result = yield self.object_store.census(step = 2)
+        attributes = result['nodes']['classes']['attribute']
+        self.assert_(attributes['count'] >= 5)
+        self.assert_(attributes['loaded'] >= 5)
+        self.assert_(attributes['bytes'] > 0)
+        self.assertEqual(result['oid_class_mapping']['entries'],
+                len(self.object_store.oid_class_mapping))
+        self.assertEqual(result['snapshots']['open'], 0)
+        xmlrpclib.dumps((result,), methodresponse = True)
+        # Byte counts of large trees are past the XML-RPC int limit.
+        node_census = siptrackdlib.census.NodeCensus()
+        node_census.bytes = 2 ** 31 + 1
+        xmlrpclib.loads(xmlrpclib.dumps((node_census.asDict(),),
+            methodresponse = True))
+
+    def testPermissionIndex(self):
+        perm_cache = siptrackdlib.treenodes.perm_cache
+        view_tree = self.object_store.view_tree
+        um = view_tree.add(None, 'user manager local')
+        user = um.add(None, 'user local', u'permuser', u'secret', False)
+        view = view_tree.add(None, 'view')
+        tree = view.add(None, 'device tree')
+        first = tree.add(None, 'device category')
+        deep = first.add(None, 'device')
+        second = tree.add(None, 'device category')
+        top = view.add(None, 'permission', True, False, [user], [], False,
+                True)
+        self.assertEqual(deep.getPermission(user), top)
+        self.assertEqual(second.getPermission(user), top)
+        self.assert_(perm_cache.entries[deep.oid] is
+                perm_cache.entries[second.oid])
+
+        local = first.add(None, 'permission', False, False, [user], [],
+                False, False)
+        # Only first and the nodes below it are dropped.
+        self.assertEqual(perm_cache.history[-1]['dropped'], 2)
+        self.assert_(second.oid in perm_cache.entries)
+        self.assertEqual(first.getPermission(user), local)
+        self.assertEqual(deep.getPermission(user), top)
+        self.assertEqual(perm_cache.history[-1]['rebuilt'], 2)
+
+        local.remove(recursive = True)
+        self.assertEqual(first.getPermission(user), top)
+        deep.relocate(second)
+        self.assertEqual(deep.getPermission(user), top)
+
+    def testPermissionGroups(self):
+        perm_cache = siptrackdlib.treenodes.perm_cache
+        view_tree = self.object_store.view_tree
+        um = view_tree.add(None, 'user manager local')
+        user = um.add(None, 'user local', u'groupuser', u'secret', False)
+        other = um.add(None, 'user local', u'otheruser', u'secret', False)
+        group = um.add(None, 'user group', [user])
+        view = view_tree.add(None, 'view')
+        perm = view.add(None, 'permission', True, False, [], [group], False,
+                True)
+        self.assert_(perm.matchesUser(user))
+        self.assertFalse(perm.matchesUser(other))
+        self.assertEqual(perm_cache.groupsOf(user, self.object_store),
+                frozenset([group.oid]))
+        self.assert_(perm_cache.matches[user.oid][perm.oid])
+        instance = siptrackdlib.user.UserInstance(user, u'secret')
+        attr = view.add(None, 'attribute', 'name', 'text', u'value')
+        self.assert_(view.hasReadPermission(instance))
+        self.assert_(attr.hasReadPermission(instance))
+        self.assertEqual(perm_cache.entries[view.oid].readable,
+                {(user.oid, True): True, (user.oid, False): True})
+        self.assertFalse(perm.hasReadPermission(instance))
+
+        group.users.set([other])
+        self.assert_(user.oid not in perm_cache.matches)
+        self.assertFalse(perm.matchesUser(user))
+        self.assert_(perm.matchesUser(other))
+        self.assertFalse(attr.hasReadPermission(instance))
+        self.assertEqual(list(view.traverse(user = instance)), [])
+        group.remove(recursive = True)
+        self.assertFalse(perm.matchesUser(other))
+        self.assertEqual(perm_cache.groupsOf(other, self.object_store),
+                frozenset())
+
+    def testRemoveLDAPUser(self):
+        user = siptrackdlib.user
+        registry = siptrackdlib.objectregistry.object_registry
+        # The LDAP classes are only registered when python-ldap is
+        # installed, but adding and removing users doesn't use it.
+        if registry.getClassById(user.UserLDAP.class_id) is None:
+            registry.object_classes[siptrackdlib.view.ViewTree.class_id].\
+                    registerChild(user.UserManagerLDAP)
+            registry.registerClass(user.UserManagerLDAP).registerChild(
+                    user.UserLDAP)
+            registry.registerClass(user.UserLDAP)
+        view_tree = self.object_store.view_tree
+        um = view_tree.add(None, 'user manager ldap', u'ldap',
+                u'localhost', u'389', u'dc=example', [])
+        ldap_user = um.add(None, 'user ldap', u'ldapuser', False)
+        view = view_tree.add(None, 'view')
+        perm = view.add(None, 'permission', True, False, [ldap_user], [],
+                False, True)
+        self.assert_(perm.matchesUser(ldap_user))
+        ldap_user.remove(recursive = True)
+        self.assert_(ldap_user.removed)
+        self.assert_(ldap_user.oid not in
+                siptrackdlib.treenodes.perm_cache.matches)
+        self.assertFalse(perm.matchesUser(ldap_user))
+
+    @defer.inlineCallbacks
+    def testMemorySearch(self):
+        searcher = siptrackdlib.search.get_searcher('memory')
+        object_store = siptrackdlib.ObjectStore(make_storage(self.config),
+                searcher = searcher)
+        yield object_store.init()
+        view = object_store.view_tree.add(None, 'view')
+        device_tree = view.add(None, 'device tree')
+        device = device_tree.add(None, 'device')
+        name = device.add(None, 'attribute', 'name', 'text',
+                u'core-switch1.example.com')
+        description = device.add(None, 'attribute', 'description', 'text',
+                u'Core switch in rack 4')
+        yield object_store.commit([object_store.view_tree, view,
+            device_tree, device, name, description])
+        fields = ['name', 'description']
+        def search(query, fuzzy = True):
+            return list(searcher.search(query, fuzzy, fields))
+        self.assertEqual(search('switch1'), [device.oid])
+        self.assertEqual(search('rack'), [device.oid])
+        self.assertEqual(search('name:core-switch1.example.com', False),
+                [device.oid])
+        self.assertEqual(search('name:core*', False), [device.oid])
+        # name is matched as a whole, description by its terms.
+        self.assertEqual(search('name:switch1', False), [])
+        self.assertEqual(search('"switch in rack"', False), [device.oid])
+        self.assertEqual(search('core NOT rack', False), [])
+        self.assertEqual(search('missing OR rack', False), [device.oid])
+        self.assertEqual(list(searcher.searchHostnames(
+            u'core-switch1.example.com')), [device.oid])
+
+        name.value = u'edge-router1.example.com'
+        yield object_store.commit([name])
+        self.assertEqual(search('switch1'), [])
+        self.assertEqual(search('router1'), [device.oid])
+        yield searcher.reloaded(object_store)
+        self.assertEqual(search('router1'), [device.oid])
+        device.remove(recursive = True)
+        yield object_store.commit([device, name, description])
+        self.assertEqual(search('router1'), [])
+        self.assertEqual(searcher.census()['documents'],
+                len(searcher.documents))
+
+    @defer.inlineCallbacks
+    def testMemorySearchRebuildRemoved(self):
+        object_store = siptrackdlib.ObjectStore(make_storage(self.config),
+                searcher = siptrackdlib.search.get_searcher('memory'))
+        yield object_store.init()
+        view = object_store.view_tree.add(None, 'view')
+        device_tree = view.add(None, 'device tree')
+        devices = [device_tree.add(None, 'device') for n in range(5)]
+        yield object_store.commit([object_store.view_tree, view,
+            device_tree] + devices)
+        # The tree changes in between build steps.
+        index = siptrackdlib.search.MemorySearch()
+        build = index._iterBuildIndex(object_store, 1,
+                object_store.object_tree.snapshot())
+        while devices[1].oid not in index.documents:
+            build.next()
+        devices[1].remove(recursive = True)
+        yield object_store.commit(devices[1])
+        for _ in build:
+            pass
+        for device in devices[:1] + devices[2:]:
+            self.assert_(device.oid in index.documents)
+        self.assertEqual(len(object_store.object_tree.snapshots), 0)
+
+    @defer.inlineCallbacks
+    def testSearchTermIndex(self):
+        terms = siptrackdlib.search.TermIndex()
+        terms.add('name', u'core-switch1')
+        terms.add('description', u'switch')
+        terms.add('name', u'core-switch1')
+        self.assertEqual(terms.terms, 2)
+        self.assertEqual(sorted(terms.match(u'*switch*')),
+                [('description', u'switch'), ('name', u'core-switch1')])
+        self.assertEqual(terms.match(u'*itc?1', ['name']),
+                [('name', u'core-switch1')])
+        self.assertEqual(terms.match(u'*[ab]x*'), None)
+        terms.remove('description', u'switch')
+        self.assertEqual(terms.match(u'*switch', ['description']), [])
+
+        searcher = self.object_store.searcher
+        view = self.object_store.view_tree.add(None, 'view')
+        device_tree = view.add(None, 'device tree')
+        device = device_tree.add(None, 'device')
+        name = device.add(None, 'attribute', 'name', 'text',
+                u'edge-router7.example.com')
+        # Wait for the searcher commit, ObjectStore.commit doesn't.
+        yield searcher.commit([device, name])
+        self.assert_(searcher.terms.match(u'*router7*', ['name']))
+        self.assertEqual(set(searcher.search('router7', True, ['name'])),
+                set([device.oid]))
+        self.assertEqual(list(searcher.search('xrouter7', True, ['name'])), [])
+
+    @defer.inlineCallbacks
+    def testBackgroundReload(self):
+        self.patch(siptrackdlib.root, 'RELOAD_GRACE_PERIOD', 0)
+        view = self.object_store.view_tree.add(None, 'view')
+        attr = view.add(None, 'attribute', 'name', 'text', u'first')
+        yield self.object_store.commit([self.object_store.view_tree, view, attr])
+
+        other_store = siptrackdlib.ObjectStore(make_storage(self.config))
+        yield other_store.init()
+        other_attr = other_store.getOID(attr.oid)
+        other_attr.value = u'second'
+        yield other_store.commit(other_attr)
+
+        d = self.object_store.reload(full = True)
+        # The live tree is used until the new one is swapped in, and
+        # changes committed while reloading end up in the new tree.
+        self.assert_(self.object_store.getOID(view.oid) is view)
+        added = view.add(None, 'attribute', 'added', 'int', 1)
+        yield self.object_store.commit([view, added])
+        full = yield d
+        self.assert_(full)
+        self.assertFalse(self.object_store.reloading)
+        new_view = self.object_store.getOID(view.oid)
+        self.assert_(new_view is not view)
+        self.assertEqual(self.object_store.getOID(attr.oid).value, u'second')
+        self.assertEqual(self.object_store.getOID(added.oid).value, 1)
+        self.assert_(self.object_store.getOID(added.oid).parent is new_view)
+        self.assert_(self.object_store.view_tree is self.object_store.getOID('0'))
+        stats = self.object_store.getStats()
+        self.assert_(stats['load']['max_rss_mb'] > 0)
+        xmlrpclib.dumps((stats,), methodresponse = True)
+        yield defer.DeferredList(self.object_store.old_trees.values())
+
+    @defer.inlineCallbacks
+    def testBackgroundReloadOldNodes(self):
+        self.patch(siptrackdlib.root, 'RELOAD_GRACE_PERIOD', 0.5)
+        view = self.object_store.view_tree.add(None, 'view')
+        attr = view.add(None, 'attribute', 'name', 'text', u'first')
+        yield self.object_store.commit([self.object_store.view_tree, view, attr])
+
+        # A request holding nodes fetched before the swap.
+        yield self.object_store.reload(full = True)
+        self.assertEqual(len(self.object_store.old_trees), 1)
+        new_attr = self.object_store.getOID(attr.oid)
+        self.assert_(new_attr is not attr)
+        attr.value = u'second'
+        added = view.add(None, 'attribute', 'added', 'int', 1)
+        yield self.object_store.commit([view, attr, added])
+        self.assertEqual(new_attr.value, u'second')
+        self.assertEqual(self.object_store.getOID(added.oid).value, 1)
+        self.assert_(self.object_store.getOID(added.oid).parent is
+                self.object_store.getOID(view.oid))
+        # Freed after the grace period, the last changes are kept.
+        attr.value = u'third'
+        yield self.object_store.commit(attr)
+        yield defer.DeferredList(self.object_store.old_trees.values())
+        self.assertEqual(self.object_store.old_trees, {})
+        self.assert_(attr.branch is None)
+        self.assertEqual(self.object_store.getOID(attr.oid).value, u'third')
+
+    @defer.inlineCallbacks
+    def testBackgroundReloadCommitInFlight(self):
+        self.patch(siptrackdlib.root, 'RELOAD_GRACE_PERIOD', 0)
+        view = self.object_store.view_tree.add(None, 'view')
+        attr = view.add(None, 'attribute', 'name', 'text', u'first')
+        yield self.object_store.commit([self.object_store.view_tree, view, attr])
+
+        # Hold the next commit back until after the new tree is swapped in.
+        storage = self.object_store.storage
+        gate = defer.Deferred()
+        interact = storage.interact
+        def held_interact(*args, **kwargs):
+            storage.interact = interact
+            return gate.addCallback(lambda _: interact(*args, **kwargs))
+        storage.interact = held_interact
+        attr.value = u'second'
+        commit_d = self.object_store.commit(attr)
+        reactor.callLater(0.2, gate.callback, None)
+        yield self.object_store.reload(full = True)
+        yield commit_d
+        new_attr = self.object_store.getOID(attr.oid)
+        self.assert_(new_attr is not attr)
+        self.assertEqual(new_attr.value, u'second')
+        yield defer.DeferredList(self.object_store.old_trees.values())
+
+    @defer.inlineCallbacks
+    def testFollower(self):
+        view = self.object_store.view_tree.add(None, 'view')
+        attr = view.add(None, 'attribute', 'name', 'text', u'first')
+        yield self.object_store.commit([self.object_store.view_tree, view, attr])
+
+        storage = siptrackdlib.storage.load('stsqlite', self.config,
+                readonly = True)
+        follower = siptrackdlib.ObjectStore(storage, readonly = True)
+        yield follower.init()
+        follower_view = follower.getOID(view.oid)
+        children = len(list(follower_view.listChildren()))
+        self.assertRaises(siptrackdlib.errors.ReadOnly,
+                follower_view.add, None, 'attribute', 'new', 'int', 1)
+        self.assertEqual(len(list(follower_view.listChildren())), children)
+        follower_attr = follower.getOID(attr.oid)
+        def set_value():
+            follower_attr.value = u'rejected'
+        self.assertRaises(siptrackdlib.errors.ReadOnly, set_value)
+        self.assertEqual(follower_attr.value, u'first')
+        ctime = follower_view.ctime.get()
+        self.assertRaises(siptrackdlib.errors.ReadOnly,
+                follower_view.ctime.set, ctime + 1)
+        self.assertEqual(follower_view.ctime.get(), ctime)
+        # Changes made before the storage action are undone right away.
+        follower_attr._value = u'changed'
+        self.assertRaises(siptrackdlib.errors.ReadOnly,
+                follower_attr.storageAction, 'write_data',
+                {'name': 'attr-value', 'value': u'changed'})
+        self.assertEqual(follower_attr.value, u'first')
+
+        attr.value = u'second'
+        added = view.add(None, 'attribute', 'added', 'int', 2)
+        yield self.object_store.commit([view, attr, added])
+        count = yield follower.applyJournal()
+        self.assert_(count > 0)
+        self.assertEqual(follower_attr.value, u'second')
+        self.assertEqual(follower.getOID(added.oid).value, 2)
+
+    @defer.inlineCallbacks
+    def testOIDAllocation(self):
+        other = siptrackdlib.ObjectStore(make_storage(self.config))
+        yield other.init()
+        first = self.object_store.view_tree.add(None, 'view')
+        second = other.view_tree.add(None, 'view')
+        self.assertNotEqual(first.oid, second.oid)
+        yield self.object_store.commit([self.object_store.view_tree, first])
+        yield other.commit([other.view_tree, second])
+
+        allocator = siptrackdlib.root.OIDAllocator(self.object_store.storage,
+                block_size = 4)
+        yield allocator.init()
+        if allocator.reserving:
+            yield allocator.reserving
+        oids = [int(allocator.allocate()) for n in range(8)]
+        # Both blocks are used up and the next one isn't reserved yet.
+        self.assertRaises(siptrackdlib.errors.OIDsExhausted,
+                allocator.allocate)
+        self.assert_(allocator.block_size > 4)
+        yield allocator.reserving
+        oids.append(int(allocator.allocate()))
+        self.assertEqual(len(set(oids)), 9)
+        start = yield self.object_store.storage.reserveOIDs(1)
+        self.assert_(start > max(oids))
+
+    @defer.inlineCallbacks
+    def testOIDAllocationBulkCreate(self):
+        other = siptrackdlib.ObjectStore(make_storage(self.config))
+        yield other.init()
+        # More creates in a single turn than fit in the reserved blocks.
+        views = []
+        def create(count):
+            try:
+                for n in range(count):
+                    views.append(self.object_store.view_tree.add(None, 'view'))
+            except siptrackdlib.errors.OIDsExhausted:
+                return False
+            return True
+        self.assertFalse(create(2500))
+        self.assert_(len(views) >= 1000)
+        other_views = [other.view_tree.add(None, 'view') for n in range(10)]
+        allocator = self.object_store.oid_allocator
+        self.assert_(allocator.block_size > 1000)
+        # Retrying once the next block has been reserved works.
+        for n in range(3):
+            if allocator.reserving:
+                yield allocator.reserving
+            if create(2500 - len(views)):
+                break
+        self.assertEqual(len(views), 2500)
+        oids = set([view.oid for view in views])
+        self.assertEqual(len(oids), len(views))
+        for view in other_views:
+            self.assertFalse(view.oid in oids)
+        yield self.object_store.commit([self.object_store.view_tree] + views)
+        yield other.commit([other.view_tree] + other_views)
+
     # TODO: Figure out this later.
     #def testPersistentObjects(self):
     #    oid = self.object_store.view_tree.add(None, 'view').oid
@@ -0,0 +1,42 @@
+from twisted.internet import defer
+from utils import BasicTestCase
+from siptrackd_twisted import sessions
+from siptrackd_twisted import gatherer
+# Register the node data extractors used by the gatherer.
+from siptrackd_twisted import view
+from siptrackd_twisted import attribute
+
+
+class TestSessions(BasicTestCase):
+    @defer.inlineCallbacks
+    def testAbandonedIterator(self):
+        view = self.object_store.view_tree.add(None, 'view')
+        attrs = [view.add(None, 'attribute', 'attr-%d' % n, 'int', n)
+                 for n in range(20)]
+        yield self.object_store.commit([self.object_store.view_tree, view] + attrs)
+        captured = []
+        def capture(node):
+            captured.append(node.oid)
+        data_iterators = sessions.DataIterators(max_iterators = 2)
+        listcreators = []
+        for n in range(3):
+            listcreator = gatherer.ListCreator(self.object_store, None,
+                    snapshot = True)
+            listcreator.snapshot.capture = capture
+            listcreators.append(listcreator)
+            # Fetch the first page only, like a client that never
+            # fetches the rest.
+            data_iterators.add(listcreator.iterBuild([view], -1, False,
+                False, False))
+        # The oldest iterator made room for the last one.
+        self.assertEqual(len(data_iterators.iterators), 2)
+        self.assert_(listcreators[0].snapshot is None)
+        attrs[0].value = 100
+        self.assertEqual(len(captured), 2)
+
+        data_iterators.idle_timeout = -1
+        data_iterators.expire()
+        self.assertEqual(len(data_iterators.iterators), 0)
+        self.assertEqual(len(self.object_store.object_tree.snapshots), 0)
+        attrs[1].value = 100
+        self.assertEqual(len(captured), 2)
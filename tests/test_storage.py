@@ -1,5 +1,11 @@
+import os
+import cPickle as pickle
+from ConfigParser import RawConfigParser
+from sqlite3 import dbapi2 as sqlite
+
 from twisted.internet import defer
 from siptrackdlib.upgrade import perform_upgrade
+from siptrackdlib.storage import datatypes
 from utils import BasicTestCase, make_storage
 
 
@@ -11,3 +17,65 @@ class TestStorage(BasicTestCase):
         yield perform_upgrade(
             storage
         )
+
+    def testDataTypes(self):
+        values = [0, 17, -3, 2 ** 70, True, False, u'text \xe5', 'bin\x00ary',
+                  None, 1.5, [], ['1', u'22'], [1, 'a'], {'a': [1, 2]}]
+        for value in values:
+            dtype, data = datatypes.encode(value)
+            decoded = datatypes.decode(dtype, buffer(data))
+            self.assertEqual(decoded, value)
+            self.assertEqual(type(decoded), type(value))
+        self.assertEqual(datatypes.encode(True)[0], 'bool')
+        self.assertEqual(datatypes.encode(u'x')[0], 'text')
+        self.assertEqual(datatypes.encode(['1', '2'])[0], 'oidlist')
+        self.assertEqual(datatypes.encode({})[0], 'pickle')
+
+    @defer.inlineCallbacks
+    def testConvertDataTypes(self):
+        storage = self.object_store.storage
+        q = """replace into nodedata (oid, name, datatype, data) values (?, ?, ?, ?)"""
+        yield storage.db.runOperation(q, ('9999', 'legacy', 'pickle',
+            sqlite.Binary(pickle.dumps(u'legacy value'))))
+        value = yield storage.readData('9999', 'legacy')
+        self.assertEqual(value, u'legacy value')
+        yield storage.convertDataTypes(batch_size = 2)
+        dtype = yield storage._fetchSingle(
+            """select datatype from nodedata where oid = ? and name = ?""",
+            ('9999', 'legacy'))
+        self.assertEqual(dtype, 'text')
+        value = yield storage.readData('9999', 'legacy')
+        self.assertEqual(value, u'legacy value')
+
+    @defer.inlineCallbacks
+    def testWAL(self):
+        config = RawConfigParser()
+        config.add_section('sqlite')
+        config.set('sqlite', 'filename', os.path.join(self.tempdir, 'wal.sqlite'))
+        config.set('sqlite', 'wal', 'yes')
+        config.set('sqlite', 'cache_size', '-2000')
+        config.set('sqlite', 'temp_store', 'memory')
+        storage = make_storage(config)
+        yield storage.initialize('4')
+        self.assert_(storage.read_db is not storage.db)
+        mode = yield storage._fetchSingle("""pragma journal_mode""")
+        self.assertEqual(mode, 'wal')
+        yield storage.interact(lambda txn: storage.writeDataMany(
+            [('1', 'name', u'value')], txn))
+        value = yield storage.readData('1', 'name')
+        self.assertEqual(value, u'value')
+
+    @defer.inlineCallbacks
+    def testJournalSeq(self):
+        storage = self.object_store.storage
+        seq = yield storage.getJournalSeq()
+        yield storage.interact(lambda txn: storage.journalOIDs(
+            ['101', '102'], 'first', txn))
+        yield storage.interact(lambda txn: storage.journalOIDs(
+            ['103'], 'second', txn))
+        journal = yield storage.listJournal(seq)
+        self.assertEqual([tuple(row) for row in journal],
+                [(seq + 1, '101', 'first'), (seq + 2, '102', 'first'),
+                 (seq + 3, '103', 'second')])
+        last = yield storage.getJournalSeq()
+        self.assertEqual(last, seq + 3)
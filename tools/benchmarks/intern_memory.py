@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+"""Report the memory saved by interning on the load path.
+
+Reads the idmap and node data rows of an existing storage and compares
+the size of the strings kept after loading without interning (one
+object per row) and with interning (see siptrackdlib.interning):
+  * oids, one per node (str instead of the unicode some backends return)
+  * class ids, one per node
+  * attribute names and types, one each per attribute
+  * node data names, one per node data row while loading
+
+usage: intern_memory.py -b stsqlite -s storage.cfg
+"""
+
+import sys
+from argparse import ArgumentParser
+from ConfigParser import RawConfigParser
+
+from twisted.internet import defer
+from twisted.internet import reactor
+
+import siptrackdlib.storage
+from siptrackdlib import interning
+from siptrackdlib.storage import datatypes
+
+PAGE_SIZE = 10000
+ATTRIBUTE_CLASSES = ['CA', 'VA', 'ENCA']
+
+class Counter(object):
+    def __init__(self, name):
+        self.name = name
+        self.count = 0
+        self.before = 0
+        self.after = {}
+
+    def add(self, raw, interned):
+        self.count += 1
+        self.before += sys.getsizeof(raw)
+        self.after[id(interned)] = interned
+
+    def report(self):
+        after = sum(sys.getsizeof(value) for value in self.after.itervalues())
+        print '%-24s %10d strings %12d -> %12d bytes, %12d saved' % (
+                self.name, self.count, self.before, after, self.before - after)
+        return self.before - after
+
+@defer.inlineCallbacks
+def run(storage):
+    yield storage.initialize('4')
+    oids = Counter('oids')
+    class_ids = Counter('class ids')
+    attr_names = Counter('attribute names/types')
+    data_names = Counter('node data names (load)')
+    classes = {}
+    for parent_oid, oid, class_id in (yield storage.listOIDMap()):
+        oids.add(oid, interning.intern_id(oid))
+        class_ids.add(class_id, interning.intern_id(class_id))
+        classes[oid] = class_id
+    after_oid = ''
+    while True:
+        rows = yield storage.getOIDDataPage(after_oid, PAGE_SIZE)
+        if not rows:
+            break
+        for oid, name, dtype, data in rows:
+            data_names.add(name, interning.intern_id(name))
+            if name in ['attr-name', 'attr-type'] and \
+                    classes.get(oid) in ATTRIBUTE_CLASSES:
+                value = datatypes.decode(dtype, data)
+                attr_names.add(value, interning.intern_text(value))
+        after_oid = rows[-1][0]
+    saved = 0
+    for counter in [oids, class_ids, attr_names]:
+        saved += counter.report()
+    print '%-24s %58d saved' % ('retained total', saved)
+    data_names.report()
+
+@defer.inlineCallbacks
+def main(storage):
+    try:
+        yield run(storage)
+    finally:
+        reactor.stop()
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description = 'Report interning memory savings.')
+    parser.add_argument('-b', '--storage-backend', default = 'stsqlite')
+    parser.add_argument('-s', '--storage-options', required = True,
+            type = open)
+    args = parser.parse_args()
+    config = RawConfigParser()
+    config.readfp(args.storage_options)
+    storage = siptrackdlib.storage.load(args.storage_backend, config,
+            readonly = True)
+    reactor.callWhenRunning(main, storage)
+    reactor.run()
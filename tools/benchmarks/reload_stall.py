@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+"""Reactor stalls during a full object store reload.
+
+Loads an existing storage, then runs a full reload while a looping call
+ticks every 5ms, and reports the longest time the reactor was unable to
+run it (the longest a request would have had to wait).
+
+usage: reload_stall.py -b stsqlite -s storage.cfg
+"""
+
+import time
+from argparse import ArgumentParser
+from ConfigParser import RawConfigParser
+
+from twisted.internet import defer
+from twisted.internet import reactor
+from twisted.internet import task
+
+import siptrackdlib
+import siptrackdlib.storage
+
+TICK = 0.005
+
+class StallMeter(object):
+    def __init__(self):
+        self.last = time.time()
+        self.worst = 0.0
+
+    def tick(self):
+        now = time.time()
+        self.worst = max(self.worst, now - self.last)
+        self.last = now
+
+@defer.inlineCallbacks
+def run(storage):
+    object_store = siptrackdlib.ObjectStore(storage)
+    yield object_store.init()
+    meter = StallMeter()
+    loop = task.LoopingCall(meter.tick)
+    loop.start(TICK)
+    start = time.time()
+    yield object_store.reload(full = True)
+    elapsed = time.time() - start
+    loop.stop()
+    print 'full reload %.2fs, worst reactor stall %.3fs' % (elapsed, meter.worst)
+
+@defer.inlineCallbacks
+def main(storage):
+    try:
+        yield run(storage)
+    finally:
+        reactor.stop()
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description = 'Report reactor stalls during a full reload.')
+    parser.add_argument('-b', '--storage-backend', default = 'stsqlite')
+    parser.add_argument('-s', '--storage-options', required = True,
+            type = open)
+    args = parser.parse_args()
+    config = RawConfigParser()
+    config.readfp(args.storage_options)
+    storage = siptrackdlib.storage.load(args.storage_backend, config)
+    reactor.callWhenRunning(main, storage)
+    reactor.run()
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+"""Concurrent read throughput for the sqlite storage during a large commit.
+
+Runs a single large write transaction and counts how many readData
+calls complete while it is running, once with the default rollback
+journal and once in wal mode.
+
+usage: sqlite_wal.py [rows]
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+from ConfigParser import RawConfigParser
+
+from twisted.internet import defer
+from twisted.internet import reactor
+
+from siptrackdlib.storage.stsqlite.base import Storage
+
+READ_OIDS = 1000
+
+def make_config(path, wal):
+    config = RawConfigParser()
+    config.add_section('sqlite')
+    config.set('sqlite', 'filename', path)
+    if wal:
+        config.set('sqlite', 'wal', 'yes')
+    return config
+
+@defer.inlineCallbacks
+def run(tempdir, wal, rows):
+    storage = Storage(make_config(os.path.join(tempdir, 'wal-%s.db' % (wal)), wal))
+    yield storage.initialize('4')
+    seed = [(str(oid), 'name', u'node %d' % (oid)) for oid in range(READ_OIDS)]
+    yield storage.interact(lambda txn: storage.writeDataMany(seed, txn))
+
+    data = [(str(READ_OIDS + oid), 'value', 'x' * 100) for oid in range(rows)]
+    state = {'running': True, 'reads': 0}
+    def commit(txn):
+        start = time.time()
+        storage.writeDataMany(data, txn)
+        return time.time() - start
+    @defer.inlineCallbacks
+    def reader(n):
+        while state['running']:
+            yield storage.readData(str(state['reads'] % READ_OIDS), 'name')
+            state['reads'] += 1
+    readers = [reader(n) for n in range(storage.readers)]
+    start = time.time()
+    commit_time = yield storage.interact(commit)
+    elapsed = time.time() - start
+    state['running'] = False
+    yield defer.DeferredList(readers)
+    print '%-8s commit %6.2fs, %7d reads during commit, %8.0f reads/s' % (
+            wal and 'wal' or 'default', elapsed, state['reads'],
+            state['reads'] / elapsed)
+
+@defer.inlineCallbacks
+def main(rows):
+    tempdir = tempfile.mkdtemp()
+    try:
+        yield run(tempdir, False, rows)
+        yield run(tempdir, True, rows)
+    finally:
+        shutil.rmtree(tempdir)
+        reactor.stop()
+
+if __name__ == '__main__':
+    rows = 200000
+    if len(sys.argv) > 1:
+        rows = int(sys.argv[1])
+    reactor.callWhenRunning(main, rows)
+    reactor.run()
@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+"""Recursive delete of a large subtree.
+
+Builds a view holding a flat list of text attributes in an empty
+sqlite backed object store, loads every node and times removing the
+view recursively. Also times relocating every other attribute, last
+first, to another attribute in the same view.
+
+usage: tree_delete.py [nodes]
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+from ConfigParser import RawConfigParser
+
+from twisted.internet import defer
+from twisted.internet import reactor
+
+import siptrackdlib
+from siptrackdlib.storage.stsqlite.base import Storage
+
+@defer.inlineCallbacks
+def build(tempdir, nodes):
+    config = RawConfigParser()
+    config.add_section('sqlite')
+    config.set('sqlite', 'filename', os.path.join(tempdir, 'tree.db'))
+    object_store = siptrackdlib.ObjectStore(Storage(config))
+    yield object_store.init()
+    data = {'ctime': 0, 'attr-name': u'name', 'attr-type': 'text',
+            'attr-value': u'value'}
+    rows = [('0', '1000000', 'V'), ('1000000', '1000001', 'CA')]
+    rows += [('1000000', str(oid), 'CA') for oid in range(2000000, 2000000 + nodes)]
+    for parent_oid, oid, class_id in rows:
+        object_store.oid_class_mapping[oid] = class_id
+    object_store.object_tree.loadBranches(rows)
+    object_store.call_loaded = False
+    for parent_oid, oid, class_id in rows:
+        object_store.object_tree.getBranch(oid).ext_data._loaded(data)
+    object_store.call_loaded = True
+    defer.returnValue(object_store)
+
+@defer.inlineCallbacks
+def main(nodes):
+    tempdir = tempfile.mkdtemp()
+    try:
+        object_store = yield build(tempdir, nodes)
+        view = object_store.getOID('1000000')
+        other = object_store.getOID('1000001')
+        children = [child for child in view.listChildren() if child is not other]
+        relocate = children[::2]
+        relocate.reverse()
+        start = time.time()
+        for child in relocate:
+            child.relocate(other)
+        print 'relocate %d nodes: %.2fs' % (len(relocate), time.time() - start)
+        start = time.time()
+        view.remove(recursive = True)
+        print 'recursive delete %d nodes: %.2fs' % (nodes, time.time() - start)
+    finally:
+        shutil.rmtree(tempdir)
+        reactor.stop()
+
+if __name__ == '__main__':
+    nodes = 100000
+    if len(sys.argv) > 1:
+        nodes = int(sys.argv[1])
+    reactor.callWhenRunning(main, nodes)
+    reactor.run()
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+"""Memory used per node by the object tree.
+
+Builds a synthetic tree of views holding text attributes in an empty
+sqlite backed object store, loads every node (as a preload would) and
+reports the resident memory growth per node.
+
+usage: tree_memory.py [nodes]
+"""
+
+import gc
+import os
+import shutil
+import sys
+import tempfile
+import time
+from ConfigParser import RawConfigParser
+
+from twisted.internet import defer
+from twisted.internet import reactor
+
+import siptrackdlib
+from siptrackdlib.storage.stsqlite.base import Storage
+
+ATTRIBUTES_PER_VIEW = 1000
+
+def rss():
+    """Return the resident set size of the process in bytes."""
+    with open('/proc/self/statm') as f:
+        pages = int(f.read().split()[1])
+    return pages * os.sysconf('SC_PAGE_SIZE')
+
+def iter_rows(nodes, first_oid):
+    """Yield (parent_oid, oid, class_id) idmap rows for the tree."""
+    oid = first_oid
+    view_oid = None
+    for n in range(nodes):
+        if n % (ATTRIBUTES_PER_VIEW + 1) == 0:
+            view_oid = str(oid)
+            yield ('0', view_oid, 'V')
+        else:
+            yield (view_oid, str(oid), 'CA')
+        oid += 1
+
+@defer.inlineCallbacks
+def run(tempdir, nodes):
+    config = RawConfigParser()
+    config.add_section('sqlite')
+    config.set('sqlite', 'filename', os.path.join(tempdir, 'tree.db'))
+    object_store = siptrackdlib.ObjectStore(Storage(config))
+    yield object_store.init()
+    data = {'ctime': 0, 'attr-name': u'name', 'attr-type': 'text',
+            'attr-value': u'value'}
+    first_oid = 1000000
+    gc.collect()
+    start_rss = rss()
+    start = time.time()
+    for parent_oid, oid, class_id in iter_rows(nodes, first_oid):
+        object_store.oid_class_mapping[oid] = class_id
+    object_store.object_tree.loadBranches(iter_rows(nodes, first_oid))
+    object_store.call_loaded = False
+    for branch in object_store.object_tree.traverse():
+        if int(branch.oid) >= first_oid:
+            branch.ext_data._loaded(data)
+    object_store.call_loaded = True
+    gc.collect()
+    used = rss() - start_rss
+    print '%d nodes, %.1fs, %.1f MB, %d bytes per node' % (nodes,
+            time.time() - start, used / 1024.0 / 1024, used / nodes)
+
+@defer.inlineCallbacks
+def main(nodes):
+    tempdir = tempfile.mkdtemp()
+    try:
+        yield run(tempdir, nodes)
+    finally:
+        shutil.rmtree(tempdir)
+        reactor.stop()
+
+if __name__ == '__main__':
+    nodes = 1000000
+    if len(sys.argv) > 1:
+        nodes = int(sys.argv[1])
+    reactor.callWhenRunning(main, nodes)
+    reactor.run()